@@ -1,8 +1,25 @@
-from flask import Flask, request, jsonify, send_from_directory, after_this_request
+import hashlib
+import hmac
+import json
+import math
+import os
+import time
+from contextlib import closing
+from itertools import product
+
+from flask import Flask, Response, request, jsonify, send_from_directory, after_this_request
 from optimize import *
 
 
 app = Flask(__name__)
+# the maximum number of requests in a batch
+MAX_BATCH = 1024
+# the bearer token authorizing market updates and reloads, which are disabled when it is unset
+MARKET_TOKEN = os.environ.get("MARKET_TOKEN")
+# the seconds between checks of the shops file for changes, which is not watched when it is unset
+SHOPS_WATCH_INTERVAL = os.environ.get("SHOPS_WATCH_INTERVAL")
+# the statuses of results that do not depend on the load of the workers, which are cached and can be revalidated
+REUSABLE_STATUSES = ("optimal", "heuristic")
 
 
 class BadRequestException(Exception):
@@ -53,7 +70,7 @@ def retrieve_locations():
     filter_regex = ".*"
     if "filter" in request.args:
         filter_regex = request.args["filter"]
-    locs = get_valid_shops(filter_regex)
+    locs = get_valid_shops(filter_regex, request.args.get("prefix"))
     return jsonify(locs)
 
 
@@ -62,45 +79,35 @@ def retrieve_commodities():
     filter_regex = ".*"
     if "filter" in request.args:
         filter_regex = request.args["filter"]
-    coms = get_valid_coms(filter_regex)
+    coms = get_valid_coms(filter_regex, request.args.get("prefix"))
     return jsonify(coms)
 
 
 @app.route("/<ops>/stocks", methods=["POST"])
 def retrieve_stock(ops):
-    result = {}
-    try:
-        stock_request = request.json
-        for loc in stock_request:
-            buy_idx = shop_buy_index[loc]
-            sell_idx = shop_sell_index[loc]
-            result[loc] = {}
-
-            for com in stock_request[loc]:
-                com_lookup = buy_idx
-                if ops == "buy":
-                    pass
-                elif ops == "sell":
-                    com_lookup = sell_idx
-                else:
-                    raise BadRequestException
-
-                shop_idx, com_idx = com_lookup[com]
-                if ops == "buy":
-                    result[loc][com] = shops[shop_idx].sells[com_idx].stock
-                else:
-                    result[loc][com] = shops[shop_idx].buys[com_idx].stock
-        return jsonify(result)
+    current, version = current_state()
+    # the stocks only change with the data and the market, so the raw request identifies the response along with them
+    # and the process, whose market version starts over on a restart
+    etag = hashlib.sha1(("%s:%s:%d:%d:%s:" % (PROCESS_NONCE, current.digest, current.version, version,
+                                                ops)).encode() + request.get_data()).hexdigest()
 
-    except (KeyError, ValueError):
-        raise BadRequestException()
+    @after_this_request
+    def add_header(response):
+        response.cache_control.no_cache = True
+        response.set_etag(etag)
+        return response
 
+    if request.if_none_match.contains(etag):
+        return "", 304
 
-@app.route('/optimize', methods=["POST"])
-def optimize():
     try:
-        trade_info = request.json
+        return jsonify(get_stocks(ops, request.json, current))
+    except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+        raise BadRequestException()
 
+
+def parse_trade_info(trade_info):
+    try:
         max_range = int(trade_info["max_range"])
         max_cargo = int(trade_info["max_cargo"])
         stops = int(trade_info["stops"])
@@ -120,25 +127,279 @@ def optimize():
         filter_regex = r".*"
         if "filter" in trade_info:
             filter_regex = trade_info["filter"]
-    except (KeyError, ValueError):
+
+        budget = None
+        if any(k in trade_info for k in ("time_limit", "mip_gap", "node_limit")):
+            budget = SolveBudget(
+                time_limit=float(trade_info["time_limit"]) if "time_limit" in trade_info else None,
+                mip_gap=float(trade_info["mip_gap"]) if "mip_gap" in trade_info else None,
+                node_limit=int(trade_info["node_limit"]) if "node_limit" in trade_info else None)
+
+        alternatives = 1
+        if "alternatives" in trade_info:
+            alternatives = int(trade_info["alternatives"])
+
+        mode = "exact"
+        if "mode" in trade_info:
+            mode = trade_info["mode"]
+    except (KeyError, ValueError, TypeError):
         raise BadRequestException()
     if max_range < 0:
         raise BadRequestException()
+    if budget is not None and any(v is not None and v < 0 for v in budget):
+        raise BadRequestException()
+    if not 1 <= alternatives <= MAX_ALTERNATIVES + 1:
+        raise BadRequestException()
+    if mode not in ("exact", "fast", "decompose"):
+        raise BadRequestException()
+    return (filter_regex, max_cargo, stops, max_range, blk_locs, max_commodities, restrictions, budget, alternatives,
+            mode)
+
+
+def convert_status(status):
+    return {
+        "optimal": status.optimal,
+        "bound": status.bound,
+        "gap": status.gap
+    }
 
-    plan, routes = get_solver(filter_regex)(max_cargo, stops, max_range, blk_locs, max_commodities, restrictions)
 
-    final_map = {
+def convert_result(result):
+    plan, routes, status, alternatives = result
+    if all(s.optimal for s in status.values()):
+        label = "optimal"
+    elif "fast" in status:
+        # the fast mode is not bounded by a budget but does not prove its plans optimal either
+        label = "heuristic"
+    else:
+        label = "truncated"
+    return {
         "plan": convert_plan(plan),
-        "routes": convert_route(routes)
+        "routes": convert_route(routes),
+        "status": label,
+        "solves": {k: convert_status(s) for k, s in status.items()},
+        "alternatives": [{"plan": convert_plan(p), "routes": convert_route(r)} for p, r in alternatives]
     }
 
+
+@app.route('/optimize', methods=["POST"])
+def optimize():
+    start = time.perf_counter()
+    trade_info = parse_trade_info(request.json)
+    etag = result_cache.key(*trade_info)
+    timing = []
+    final_map = None
+
     @after_this_request
     def add_header(response):
         response.cache_control.no_cache = True
+        # only cached results are served again as they are, so only they can be revalidated
+        if final_map is not None and final_map["status"] in REUSABLE_STATUSES:
+            response.set_etag(etag)
+        elapsed = time.perf_counter() - start
+        timing.append("total;dur=%.1f" % (elapsed * 1000))
+        response.headers["Server-Timing"] = ", ".join(timing)
+        metrics.observe("scopt_request_seconds", elapsed, endpoint="optimize")
         return response
 
+    final_map = result_cache.get(etag)
+    if final_map is not None and request.if_none_match.contains(etag):
+        timing.append('cache;desc="revalidated"')
+        return "", 304
+
+    if final_map is None:
+        result, timings = job_manager.run(*trade_info)
+        if timings is not None:
+            timing.append(server_timing(timings))
+        final_map = convert_result(result)
+        if final_map["status"] in REUSABLE_STATUSES:
+            result_cache.put(etag, final_map)
+    else:
+        timing.append('cache;desc="hit"')
+
     return jsonify(final_map)
 
 
+def server_event(kind, data):
+    return "event: %s\ndata: %s\n\n" % (kind, json.dumps(data))
+
+
+@app.route("/optimize/stream", methods=["POST"])
+def optimize_stream():
+    # the incumbents are sent as they are found and the result last, while closing the connection cancels the solve
+    trade_info = parse_trade_info(request.json)
+    etag = result_cache.key(*trade_info)
+
+    def stream():
+        final_map = result_cache.get(etag)
+        if final_map is None:
+            with closing(job_manager.stream(*trade_info)) as events:
+                for kind, value in events:
+                    if kind == "incumbent":
+                        profit, bound, gap, seconds, plan = value
+                        yield server_event("incumbent", {"profit": profit, "bound": bound, "gap": gap,
+                                                         "time": seconds, "plan": convert_plan(plan)})
+                    elif kind == "heartbeat":
+                        # a comment, so that a closed connection is noticed while no incumbent is found
+                        yield ": heartbeat\n\n"
+                    else:
+                        final_map = convert_result(value[0])
+                        if final_map["status"] in REUSABLE_STATUSES:
+                            result_cache.put(etag, final_map)
+        yield server_event("result", final_map)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    return response
+
+
+def expand_batch(batch_info):
+    """
+    Expands a batch into its requests, either listed under "requests" or as the product of the values listed under
+    "sweep" applied over the request under "base".
+    """
+    try:
+        if "requests" in batch_info:
+            batch = list(batch_info["requests"])
+        else:
+            names = list(batch_info["sweep"])
+            values = [list(batch_info["sweep"][n]) for n in names]
+            if math.prod(len(v) for v in values) > MAX_BATCH:
+                raise BadRequestException()
+            batch = [dict(batch_info.get("base", {}), **dict(zip(names, v))) for v in product(*values)]
+    except (KeyError, TypeError, AttributeError):
+        raise BadRequestException()
+    if len(batch) > MAX_BATCH:
+        raise BadRequestException()
+    return batch
+
+
+@app.route("/optimize/batch", methods=["POST"])
+def optimize_batch():
+    batch = expand_batch(request.json)
+    trade_infos = [parse_trade_info(t) for t in batch]
+    keys = [result_cache.key(*t) for t in trade_infos]
+
+    def stream():
+        pending = []
+        for i, key in enumerate(keys):
+            final_map = result_cache.get(key)
+            if final_map is None:
+                pending.append(i)
+            else:
+                yield json.dumps({"index": i, "request": batch[i], "result": final_map}) + "\n"
+
+        for j, result in job_manager.run_batch([trade_infos[i] for i in pending]):
+            i = pending[j]
+            final_map = convert_result(result)
+            if final_map["status"] in REUSABLE_STATUSES:
+                result_cache.put(keys[i], final_map)
+            yield json.dumps({"index": i, "request": batch[i], "result": final_map}) + "\n"
+
+    response = Response(stream(), mimetype="application/x-ndjson")
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_market_updates(market_info):
+    """
+    Flattens market updates given as the new values by location and commodity under any of MARKET_KINDS.
+    """
+    try:
+        updates = [(kind, com, loc, float(value))
+                   for kind in MARKET_KINDS if kind in market_info
+                   for loc, values in market_info[kind].items()
+                   for com, value in values.items()]
+    except (KeyError, ValueError, TypeError, AttributeError):
+        raise BadRequestException()
+    if len(updates) == 0 or any(k not in MARKET_KINDS for k in market_info):
+        raise BadRequestException()
+    return updates
+
+
+def authorize():
+    """
+    Checks the bearer token of an administrative request.
+    :return: the response refusing the request, or None if it is authorized
+    """
+    if MARKET_TOKEN is None:
+        return "Forbidden", 403
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), ("Bearer " + MARKET_TOKEN).encode()):
+        return "Unauthorized", 401, {"WWW-Authenticate": "Bearer"}
+    return None
+
+
+@app.route("/market", methods=["POST"])
+def update_market():
+    refused = authorize()
+    if refused is not None:
+        return refused
+
+    updates = parse_market_updates(request.json)
+    try:
+        version = apply_market_updates(updates)
+    except (KeyError, ValueError):
+        raise BadRequestException()
+    return jsonify({"market_version": version, "updates": len(updates)})
+
+
+@app.route("/market/reload", methods=["POST"])
+def reload_market():
+    refused = authorize()
+    if refused is not None:
+        return refused
+
+    force = request.args.get("force", "false").lower() == "true"
+    try:
+        current = reload_snapshot(force=force)
+    except (OSError, ValueError, TypeError):
+        return "Shops file could not be loaded", 500
+    return jsonify({"data_version": current.version, "digest": current.digest, "shops": len(current.shops)})
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    job_id = job_manager.submit(*parse_trade_info(request.json))
+    return jsonify({"id": job_id}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def retrieve_job(job_id):
+    try:
+        status, result = job_manager.status(job_id)
+    except KeyError:
+        return "Not Found", 404
+
+    job = {"id": job_id, "status": status}
+    if result is not None:
+        job["result"] = convert_result(result)
+
+    @after_this_request
+    def add_header(response):
+        response.cache_control.no_cache = True
+        return response
+
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    try:
+        job_manager.cancel(job_id)
+    except KeyError:
+        return "Not Found", 404
+    return "", 204
+
+
+@app.route("/metrics")
+def retrieve_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+if SHOPS_WATCH_INTERVAL is not None:
+    watch_snapshot(float(SHOPS_WATCH_INTERVAL))
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000)
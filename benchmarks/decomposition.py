@@ -0,0 +1,60 @@
+"""
+Compares the latency of the exact mode, which solves stage one over every shop at once, against the decompose mode,
+which solves the clusters a plan can lie in on separate worker processes, over synthetic universes of growing size
+spread across several systems. Both modes run through the worker processes, once cold and then warm.
+Run from the repository root with: python -m benchmarks.decomposition
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_universe
+from optimize import JobManager, SolveBudget, decompose, reload_snapshot
+
+
+def solve(manager: JobManager, mode: str, cargo: int, n_stop: int, max_level: int, budget: SolveBudget):
+    start = time.perf_counter()
+    (plan, _, status, _), _ = manager.run(r".*", cargo, n_stop, max_level, [], {}, {}, budget, 1, mode)
+    return plan.revenue - plan.cost, status["plan"].optimal, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shops", type=int, nargs="+", default=[200, 400, 800], help="the numbers of shops")
+    parser.add_argument("--systems", type=int, default=4, help="the number of systems")
+    parser.add_argument("--depth", type=int, default=4, help="the number of segments of every path")
+    parser.add_argument("--commodities", type=int, default=40, help="the number of commodities")
+    parser.add_argument("--stops", type=int, default=3, help="the number of stops")
+    parser.add_argument("--cargo", type=int, default=696, help="the cargo capacity")
+    parser.add_argument("--max-level", type=int, default=3, help="the maximum travel cost between stops")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="the number of worker processes")
+    parser.add_argument("--time-limit", type=float, default=120, help="the seconds each solve may take")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the universes")
+    args = parser.parse_args()
+
+    budget = SolveBudget(time_limit=args.time_limit)
+    print("%-6s %-8s %-10s %12s %8s %8s %8s" % ("shops", "clusters", "mode", "profit", "optimal", "cold", "warm"))
+    with tempfile.TemporaryDirectory() as directory:
+        for n_shops in args.shops:
+            path = os.path.join(directory, "shops-%d.json" % n_shops)
+            with open(path, "w") as fp:
+                json.dump(generate_universe(args.seed, args.systems, args.depth, n_shops, args.commodities), fp)
+            reload_snapshot(path)
+            clusters = len(decompose(r".*", args.max_level, args.stops))
+
+            for mode in ("exact", "decompose"):
+                # a fresh pool of workers for every mode, so that the cold run includes building the planners
+                manager = JobManager(max_workers=args.workers)
+                try:
+                    _, _, cold = solve(manager, mode, args.cargo, args.stops, args.max_level, budget)
+                    profit, optimal, warm = solve(manager, mode, args.cargo, args.stops, args.max_level, budget)
+                finally:
+                    manager.shutdown()
+                print("%-6d %-8d %-10s %12.2f %8s %8.2f %8.2f" % (n_shops, clusters, mode, profit, optimal, cold,
+                                                                 warm))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares the latency and the profit of the fast heuristic mode against the exact two-stage MIP on the bundled
+shops.json, along with the LP bound the fast mode reports.
+Run from the repository root with: python -m benchmarks.fast_mode
+"""
+import argparse
+import time
+
+from optimize import TwoStagePlanner, current_snapshot
+
+REQUESTS = [
+    {"cargo": 32, "n_stop": 2, "max_level": 2},
+    {"cargo": 456, "n_stop": 3, "max_level": 2},
+    {"cargo": 456, "n_stop": 4, "max_level": 3},
+    {"cargo": 696, "n_stop": 4, "max_level": 3},
+    {"cargo": 696, "n_stop": 6, "max_level": 4},
+]
+
+
+def run_exact(planner: TwoStagePlanner, request):
+    start = time.perf_counter()
+    _, plan = planner.plan_stage_one(request["cargo"], max_percent=1, max_level=request["max_level"],
+                                     n_stop=request["n_stop"], warm_start=False)
+    profit = 0
+    if plan is not None and len(plan.buy) > 0:
+        profit, _ = planner.plan_refinement(plan, request["cargo"], max_percent=1)
+    return profit, time.perf_counter() - start
+
+
+def run_fast(planner: TwoStagePlanner, request):
+    start = time.perf_counter()
+    profit, plan, _, bound = planner.plan_fast(request["cargo"], max_percent=1, max_commodity=None,
+                                               blk_locations=(), max_com_loc=None, max_level=request["max_level"],
+                                               n_stop=request["n_stop"])
+    return (profit if plan is not None else 0), bound, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3, help="the number of times to run every request per mode")
+    parser.add_argument("--backend", default="scip", choices=("cvxpy", "scip"), help="the backend of the exact mode")
+    args = parser.parse_args()
+
+    planner = TwoStagePlanner(current_snapshot().shops, solver="SCIP", backend=args.backend)
+    print("%-6s %-6s %-6s %10s %8s %10s %8s %10s %7s" % ("cargo", "stops", "level", "exact", "time", "fast", "time",
+                                                      "bound", "ratio"))
+    for request in REQUESTS:
+        for _ in range(args.repeat):
+            exact, exact_time = run_exact(planner, request)
+            fast, bound, fast_time = run_fast(planner, request)
+            ratio = "%7.3f" % (fast / exact) if exact > 0 else "%7s" % "-"
+            print("%-6d %-6d %-6d %10.2f %8.3f %10.2f %8.3f %10.2f %s" % (
+                request["cargo"], request["n_stop"], request["max_level"], exact, exact_time, fast, fast_time,
+                bound, ratio))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Compares serving every location filter from a single planner over all the shops, which only masks the shops a filter
+selects, against a planner per filter as the pool kept before, for the latency of the requests and the memory of the
+planners. Every filter is requested cold, which includes building its planner when there is none yet, and then warm,
+and both ways must find the same profits. Each way runs in a fresh process, so that the resident memory of one is not
+counted against the other.
+Run from the repository root with: python -m benchmarks.filters
+or over a synthetic universe with: python -m benchmarks.filters --shops 800
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import generate_universe
+from optimize import SOLVER_BACKEND, TwoStagePlanner, current_snapshot, reload_snapshot
+
+WAYS = ("per-filter", "masked")
+
+
+def measure(way: str, path: str, filters, cargo: int, n_stop: int, max_level: int, backend: str):
+    """
+    Plans every filter cold and then warm in one way.
+    :return: a tuple of the profits of the warm requests, the seconds of the cold and of the warm requests, the number
+    of planners, their estimated size and the growth of the peak resident memory in bytes
+    """
+    current = reload_snapshot(path) if path is not None else current_snapshot()
+    masks = []
+    for f in filters:
+        mask = np.zeros(len(current.shops), dtype=bool)
+        mask[current.locations.indices(current.locations.query(f)[0])] = True
+        masks.append(mask)
+    # ru_maxrss is in kilobytes on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    planners = {}
+    profits, seconds = None, {"cold": [], "warm": []}
+    for run in ("cold", "warm"):
+        profits = []
+        for mask in masks:
+            start = time.perf_counter()
+            key, shops, options = None, current.shops, {"available": mask}
+            if way == "per-filter":
+                key, options = tuple(np.nonzero(mask)[0]), {}
+                shops = [current.shops[i] for i in key]
+            if key not in planners:
+                planners[key] = TwoStagePlanner(shops, solver="SCIP", ignore_dpp=False, backend=backend)
+            ranked, _ = planners[key].plan_alternatives(1, cargo, max_percent=1, n_stop=n_stop, max_level=max_level,
+                                                        **options)
+            seconds[run].append(time.perf_counter() - start)
+            profits.append(ranked[0][0] if len(ranked) > 0 else 0.0)
+
+    resident = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    return profits, seconds["cold"], seconds["warm"], len(planners), sum(p.nbytes for p in planners.values()), \
+        resident
+
+
+def default_filters(path: str):
+    """
+    :return: the filter matching every shop along with one matching the second segment of every path
+    """
+    current = reload_snapshot(path) if path is not None else current_snapshot()
+    names = sorted({s.path.split(">")[1].strip() for s in current.shops if ">" in s.path})
+    return [r".*"] + [re.escape(n) for n in names]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shops", type=int, default=None, help="the number of shops of a synthetic universe, "
+                                                                "defaults to the bundled shops.json")
+    parser.add_argument("--systems", type=int, default=4, help="the number of systems of the synthetic universe")
+    parser.add_argument("--filters", nargs="+", default=None, help="the filters, defaults to one per second segment")
+    parser.add_argument("--stops", type=int, default=3, help="the number of stops")
+    parser.add_argument("--cargo", type=int, default=456, help="the cargo capacity")
+    parser.add_argument("--max-level", type=int, default=2, help="the maximum travel cost between stops")
+    parser.add_argument("--backend", default=SOLVER_BACKEND, choices=("cvxpy", "scip"),
+                        help="the backend of the planners, defaults to the one of the server")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the synthetic universe")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = None
+        if args.shops is not None:
+            path = os.path.join(directory, "shops.json")
+            with open(path, "w") as fp:
+                json.dump(generate_universe(args.seed, args.systems, 4, args.shops), fp)
+        filters = args.filters or default_filters(path)
+
+        results = {}
+        for way in WAYS:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[way] = executor.submit(measure, way, path, filters, args.cargo, args.stops, args.max_level,
+                                               args.backend).result()
+
+    print("%d filters" % len(filters))
+    print("%-11s %8s %10s %10s %10s %9s %12s %12s" % ("way", "planners", "cold", "warm mean", "warm max", "matches",
+                                                     "planners MB", "resident MB"))
+    expected = results[WAYS[0]][0]
+    for way in WAYS:
+        profits, cold, warm, n_planners, nbytes, resident = results[way]
+        matches = sum(abs(a - b) <= 1e-2 for a, b in zip(profits, expected))
+        print("%-11s %8d %10.2f %10.3f %10.3f %9s %12.1f %12.1f" % (way, n_planners, sum(cold), np.mean(warm),
+                                                                   max(warm), "%d/%d" % (matches, len(filters)),
+                                                                   nbytes / 2 ** 20, resident / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
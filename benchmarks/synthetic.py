@@ -0,0 +1,180 @@
+"""
+Times every phase of the planner over a grid of seeded synthetic universes laid out like shops.json, writing one JSON
+line per run so that the results of two commits can be compared.
+Run from the repository root with: python -m benchmarks.synthetic --output results.jsonl
+and compare two runs with: python -m benchmarks.synthetic --compare before.jsonl after.jsonl
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from optimize import TwoStagePlanner, Shop, Commodity, SolveBudget
+
+try:
+    from optimize import collect_timings
+except ImportError:
+    # commits before the per-stage timings only report the time of every stage
+    @contextlib.contextmanager
+    def collect_timings():
+        yield argparse.Namespace(phases={})
+
+PHASES = ("construction", "stage_one", "refinement", "params", "canonicalization", "solve", "sequencing",
+          "extraction")
+
+
+def generate_universe(seed: int, systems: int = 2, depth: int = 4, shops: int = 100, commodities: int = 40,
+                      density: float = 0.15):
+    """
+    Generates a universe in the layout of shops.json, a list of the path, the goods bought and the goods sold of every
+    shop, where every good is the name, the price, the stock and the refresh rate.
+    :param seed: the seed of the generator
+    :param systems: the number of systems at the top of the paths
+    :param depth: the number of segments of every path, the last of which names the shop
+    :param shops: the number of shops
+    :param commodities: the number of commodities
+    :param density: the probability that a shop trades a given commodity
+    :return: the universe
+    """
+    rng = np.random.default_rng(seed)
+    # every level between the system and the shop splits evenly enough to spread the shops over the tree
+    branching = max(2, math.ceil((shops / systems) ** (1 / max(depth - 2, 1)))) if depth > 2 else 1
+    base = np.exp(rng.normal(3, 1.2, commodities))
+    universe = []
+    for i in range(shops):
+        path = ["System %d" % rng.integers(systems)]
+        path += ["Level %d-%d" % (level, rng.integers(branching)) for level in range(1, depth - 1)]
+        path.append("Shop %d" % i)
+
+        buys, sells = [], []
+        for c in np.nonzero(rng.random(commodities) < density)[0]:
+            good = ["Commodity %d" % c, round(float(base[c] * rng.uniform(0.8, 1.2)), 2),
+                    float(rng.integers(100, 5000)), round(float(rng.uniform(0.5, 20)), 2)]
+            (buys if rng.random() < 0.5 else sells).append(good)
+        universe.append([" > ".join(path), buys, sells])
+    return universe
+
+
+def to_shops(universe):
+    return [Shop(path, [Commodity(*b) for b in buys], [Commodity(*s) for s in sells]) for path, buys, sells in universe]
+
+
+def run(shops, cargo: int, n_stop: int, max_level: int, backend: str, budget: SolveBudget):
+    """
+    Plans one request over the shops through the public stages, timing the phases of both together.
+    :return: a tuple of the seconds spent per phase, the profit, whether both solves were optimal and how the
+    refinement was solved, either by enumerating the orders of the stops or as a MIP
+    """
+    planner = TwoStagePlanner(shops, solver="SCIP", ignore_dpp=False, backend=backend)
+    with collect_timings() as timings:
+        start = time.perf_counter()
+        profit, plan = planner.plan_stage_one(cargo, max_percent=1, max_level=max_level, n_stop=n_stop,
+                                              budget=budget, warm_start=False)
+        timings.phases["stage_one"] = time.perf_counter() - start
+        optimal = planner.solve_status.optimal
+        refinement = None
+        if plan is not None and len(plan.buy) > 0:
+            stops = len({t.loc for t in list(plan.buy) + list(plan.sell)})
+            refinement = "enumeration" if stops <= getattr(planner, "sequence_stops", 0) else "mip"
+            start = time.perf_counter()
+            profit, _ = planner.plan_refinement(plan, cargo, max_percent=1, budget=budget)
+            timings.phases["refinement"] = time.perf_counter() - start
+            optimal = optimal and planner.solve_status.optimal
+        elif plan is not None:
+            profit = 0.0
+    phases = dict(timings.phases)
+    phases["total"] = phases["stage_one"] + phases.get("refinement", 0.0)
+    return phases, (profit if math.isfinite(profit) else None), optimal, refinement
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before: str, after: str):
+    """
+    Prints the ratio of the median seconds of every phase between two result files, matched by configuration.
+    """
+    def load(path):
+        runs = {}
+        with open(path) as fp:
+            for line in fp:
+                row = json.loads(line)
+                runs.setdefault(json.dumps(row["config"], sort_keys=True), []).append(row)
+        return runs
+
+    old, new = load(before), load(after)
+    print("%-60s %s" % ("config", " ".join("%16s" % p for p in PHASES + ("total",))))
+    for key in sorted(set(old) & set(new)):
+        cells = []
+        for phase in PHASES + ("total",):
+            a = np.median([r["phases"].get(phase, 0.0) for r in old[key]])
+            b = np.median([r["phases"].get(phase, 0.0) for r in new[key]])
+            cells.append("%16s" % ("%.3f>%.3f" % (a, b) if a > 0 else "-"))
+        config = json.loads(key)
+        print("%-60s %s" % (" ".join("%s=%s" % kv for kv in config.items())[:60], " ".join(cells)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shops", type=int, nargs="+", default=[50, 100, 200], help="the numbers of shops")
+    parser.add_argument("--commodities", type=int, nargs="+", default=[40], help="the numbers of commodities")
+    parser.add_argument("--systems", type=int, default=2, help="the number of systems")
+    parser.add_argument("--depth", type=int, default=4, help="the number of segments of every path")
+    parser.add_argument("--density", type=float, default=0.15, help="the probability a shop trades a commodity")
+    parser.add_argument("--stops", type=int, nargs="+", default=[2, 3, 6],
+                        help="the numbers of stops, refinements over more stops than the planner enumerates are "
+                             "solved as MIPs")
+    parser.add_argument("--cargo", type=int, nargs="+", default=[96, 696], help="the cargo capacities")
+    parser.add_argument("--max-level", type=int, default=3, help="the maximum travel cost between stops")
+    parser.add_argument("--backend", default="cvxpy", choices=("cvxpy", "scip"), help="the backend to solve with")
+    parser.add_argument("--time-limit", type=float, default=60, help="the seconds each solve may take")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the first universe")
+    parser.add_argument("--repeat", type=int, default=1, help="the number of seeds per configuration")
+    parser.add_argument("--output", help="the file to append results to, defaults to standard output")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compares two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit = _commit()
+    budget = SolveBudget(time_limit=args.time_limit)
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for n_shops, n_coms, seed in itertools.product(args.shops, args.commodities,
+                                                       range(args.seed, args.seed + args.repeat)):
+            shops = to_shops(generate_universe(seed, args.systems, args.depth, n_shops, n_coms, args.density))
+            # the travel costs are cached by path, so only the first planner over a universe is built cold
+            start = time.perf_counter()
+            planner = TwoStagePlanner(shops, solver="SCIP", ignore_dpp=False, backend=args.backend)
+            construction = time.perf_counter() - start
+            for n_stop, cargo in itertools.product(args.stops, args.cargo):
+                phases, profit, optimal, refinement = run(shops, cargo, n_stop, args.max_level, args.backend, budget)
+                phases["construction"] = construction
+                config = {"shops": n_shops, "commodities": n_coms, "systems": args.systems, "depth": args.depth,
+                          "density": args.density, "seed": seed, "stops": n_stop, "cargo": cargo,
+                          "max_level": args.max_level, "backend": args.backend}
+                out.write(json.dumps({"commit": commit, "config": config,
+                                      "listings": len(planner.supply_listings) + len(planner.demand_listings),
+                                      "phases": phases, "profit": profit, "optimal": optimal,
+                                      "refinement": refinement}) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares cold and warm started solves over a session of single knob changes on the bundled shops.json.
+Only stage one is warm started, the refinements are always solved cold and are timed for reference.
+Run from the repository root with: python -m benchmarks.warm_start
+"""
+import argparse
+import time
+
+from optimize import TwoStagePlanner, current_snapshot
+
+# every step changes one knob of the previous request, the way users tweak a search
+SESSION = [
+    {},
+    {"cargo": 576},
+    {"n_stop": 4},
+    {"max_level": 3},
+    {"cargo": 696},
+    {"n_stop": 3},
+]
+DEFAULTS = {"cargo": 456, "n_stop": 3, "max_level": 2, "blk_locations": ()}
+
+
+def run_session(warm_start: bool, session=SESSION):
+    planner = TwoStagePlanner(current_snapshot().shops, solver="SCIP", backend="scip")
+    request = dict(DEFAULTS)
+    rows = []
+    for step, change in enumerate(session):
+        request.update(change)
+        start = time.perf_counter()
+        _, plan = planner.plan_stage_one(request["cargo"], max_percent=1, max_level=request["max_level"],
+                                         n_stop=request["n_stop"], blk_locations=request["blk_locations"],
+                                         warm_start=warm_start)
+        stage_one = planner.solve_status
+        refinement = None
+        if plan is not None and len(plan.buy) > 0:
+            planner.plan_refinement(plan, request["cargo"], max_percent=1, blk_locations=request["blk_locations"])
+            refinement = planner.solve_status
+        rows.append((step, change, stage_one, refinement, time.perf_counter() - start))
+    return rows
+
+
+def _format(status):
+    if status is None or status.time is None:
+        return "%8s %8s" % ("-", "-")
+    first = "-" if status.first_time is None else "%.3f" % status.first_time
+    return "%8s %8.3f" % (first, status.time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3, help="the number of sessions to run per mode")
+    args = parser.parse_args()
+
+    print("%-5s %-4s %-22s %17s %17s %8s" % ("mode", "step", "change", "stage one", "refinement", "wall"))
+    print("%-5s %-4s %-22s %8s %8s %8s %8s %8s" % ("", "", "", "first", "total", "first", "total", ""))
+    for _ in range(args.repeat):
+        for warm_start in (False, True):
+            for step, change, stage_one, refinement, wall in run_session(warm_start):
+                print("%-5s %-4d %-22s %s %s %8.3f" % ("warm" if warm_start else "cold", step, change or "initial",
+                                                      _format(stage_one), _format(refinement), wall))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+Converts a shops file in the JSON layout into a columnar market, a directory of .npy files that servers memory-map
+instead of parsing. Point SHOPS_PATH at the directory to serve it.
+Run from the repository root with: python convert_shops.py shops.json shops.market
+"""
+import argparse
+
+from optimize import convert_shops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="the shops file in the JSON layout")
+    parser.add_argument("target", help="the directory to write the columnar market to")
+    args = parser.parse_args()
+
+    market = convert_shops(args.source, args.target)
+    print("converted %d shops and %d commodities into %d bytes of columns" % (len(market), len(market.commodities),
+                                                                             market.nbytes))
+
+
+if __name__ == "__main__":
+    main()
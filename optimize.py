@@ -1,22 +1,320 @@
+import bisect
+import copy
+import hashlib
 import json
-from collections import namedtuple
-from typing import Iterable, Dict, Tuple, List
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, CancelledError, Future, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from collections import namedtuple, OrderedDict, defaultdict
+from typing import Iterable, Iterator, Dict, Tuple, List, Union
 
 import cvxpy as cp
 import numpy as np
-from itertools import zip_longest
-from itertools import product
+import pyscipopt as scip
+import scipy.sparse as sp
+from scipy.optimize import linprog
+from itertools import permutations, product
 import math
 import re
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 Shop = namedtuple("Shop", "path buys sells")
 Commodity = namedtuple("Commodity", "name price stock refresh")
 EPSILON = 0.001
+# the number of compiled refinement problems a planner keeps, one per plan shape
+MAX_REFINEMENTS = 32
+# the number of plans stage one can be asked to differ from, see plan_alternatives
+MAX_ALTERNATIVES = 8
+# the largest number of stops a refinement orders by enumerating every order instead of solving the MIP, see
+# TwoStagePlanner._solve_refinement_orders
+SEQUENCE_STOPS = 5
+# the share of the time left that a budgeted stage one solve may use, the rest is kept for refining its plan
+STAGE_ONE_SHARE = 0.7
+# the options of plan_stage_one that carry over to plan_refinement
+_REFINEMENT_OPTIONS = ("max_percent", "max_commodity", "blk_locations", "max_com_loc", "backend", "budget",
+                       "available")
+# the longest location filter accepted, the most points a filter may backtrack over, see compile_filter, and the
+# seconds a filter may spend matching the shops, which is checked between the shops
+MAX_FILTER_LENGTH = 256
+MAX_FILTER_BACKTRACKING = 3
+FILTER_TIME_LIMIT = 0.1
+# the seconds between checks of whether a streamed solve was cancelled while SCIP runs, see stream_incumbents
+CANCEL_POLL_INTERVAL = 0.05
+# whether worker processes time the phases of every request, see collect_timings
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+# the values of the market that can be updated live, the stock and the price of the goods shops sell and buy
+MARKET_KINDS = ("supply", "buy_price", "demand", "sell_price")
+
+
+class Listings:
+
+    def __init__(self, shape: Tuple[int, int], coms: Iterable[int], shops: Iterable[int], price: Iterable[float],
+                 stock: Iterable[float]):
+        """
+        The listings of commodities at shops in compressed sparse row form, with a row per commodity and a column per
+        shop. Listings repeated for the same commodity and shop keep the last one.
+        :param shape: the number of commodities and of shops
+        :param coms: the commodity of every listing
+        :param shops: the shop of every listing
+        :param price: the price of every listing
+        :param stock: the stock of every listing
+        """
+        coms = np.asarray(coms, dtype=np.int64)
+        shops = np.asarray(shops, dtype=np.int64)
+        # unique sorts by commodity then shop, and picks the last repeat through the reversed order
+        _, last = np.unique((coms * shape[1] + shops)[::-1], return_index=True)
+        keep = len(coms) - 1 - last
+        self.shape = shape
+        self.com = coms[keep]
+        self.shop = shops[keep]
+        self.price = np.asarray(price, dtype=float)[keep]
+        self.stock = np.asarray(stock, dtype=float)[keep]
+        self.indptr = np.searchsorted(self.com, np.arange(shape[0] + 1))
+
+    @classmethod
+    def from_sorted(cls, shape: Tuple[int, int], coms: np.ndarray, shops: np.ndarray, price: np.ndarray,
+                    stock: np.ndarray) -> "Listings":
+        """
+        Wraps listings already sorted by commodity then shop without repeats, such as the columns of a ColumnarMarket,
+        without copying them.
+        :param shape: the number of commodities and of shops
+        :param coms: the commodity of every listing
+        :param shops: the shop of every listing
+        :param price: the price of every listing
+        :param stock: the stock of every listing
+        :return: the listings
+        """
+        keys = np.asarray(coms, dtype=np.int64) * shape[1] + shops
+        if np.any(keys[1:] <= keys[:-1]):
+            raise ValueError("listings are not sorted by commodity then shop")
+        listings = cls.__new__(cls)
+        listings.shape = shape
+        listings.com = coms
+        listings.shop = shops
+        listings.price = price
+        listings.stock = stock
+        listings.indptr = np.searchsorted(coms, np.arange(shape[0] + 1))
+        return listings
+
+    def copy(self) -> "Listings":
+        """
+        :return: listings sharing the commodities and shops of these, with their own copy of the prices and stocks
+        """
+        listings = copy.copy(self)
+        listings.price = np.array(self.price)
+        listings.stock = np.array(self.stock)
+        return listings
+
+    def __len__(self):
+        return len(self.com)
+
+    @property
+    def nbytes(self) -> int:
+        return self.com.nbytes + self.shop.nbytes + self.price.nbytes + self.stock.nbytes + self.indptr.nbytes
+
+    def find(self, com: int, shop: int) -> int:
+        """
+        Finds a listing.
+        :param com: the commodity
+        :param shop: the shop
+        :return: the position of the listing
+        """
+        start, end = self.indptr[com], self.indptr[com + 1]
+        pos = start + np.searchsorted(self.shop[start:end], shop)
+        if pos == end or self.shop[pos] != shop:
+            raise KeyError((com, shop))
+        return int(pos)
+
+    def find_many(self, coms: np.ndarray, shops: np.ndarray) -> np.ndarray:
+        """
+        Finds many listings at once.
+        :param coms: the commodity of every listing
+        :param shops: the shop of every listing
+        :return: the position of every listing, -1 where it is not listed
+        """
+        # the listings are sorted by commodity then shop, and so by this key
+        keys = self.com.astype(np.int64) * self.shape[1] + self.shop
+        wanted = np.asarray(coms, dtype=np.int64) * self.shape[1] + np.asarray(shops, dtype=np.int64)
+        if len(keys) == 0:
+            return np.full(len(wanted), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        return np.where(keys[pos] == wanted, pos, -1)
+
+    def to_dense(self, values: np.ndarray) -> np.ndarray:
+        """
+        Expands values over the listings into a commodities x shops matrix, which is zero where nothing is listed.
+        :param values: the value of every listing
+        :return: the matrix
+        """
+        result = np.zeros(self.shape)
+        result[self.com, self.shop] = values
+        return result
+
+    def per_com(self) -> sp.csr_matrix:
+        """
+        :return: the commodities x listings matrix summing the listings of every commodity
+        """
+        return sp.csr_matrix((np.ones(len(self)), (self.com, np.arange(len(self)))), shape=(self.shape[0], len(self)))
+
+    def per_shop(self) -> sp.csr_matrix:
+        """
+        :return: the shops x listings matrix summing the listings of every shop
+        """
+        return sp.csr_matrix((np.ones(len(self)), (self.shop, np.arange(len(self)))), shape=(self.shape[1], len(self)))
+
+
+class ColumnarMarket:
+    # the sides of a shop, the goods it buys and the goods it sells, and the columns kept for the goods of each
+    SIDES = ("buys", "sells")
+    FIELDS = ("shop", "com", "price", "stock", "refresh", "position")
+    # written last by save, so a complete snapshot is one with a manifest
+    MANIFEST = "manifest.json"
+    # the version of the layout of the columns, markets saved in another layout are converted again
+    FORMAT = 2
+
+    def __init__(self, paths: np.ndarray, commodities: np.ndarray, columns: Dict[str, np.ndarray], digest: str = None,
+                 path: str = None):
+        """
+        The shops in columnar form, a table of the paths of the shops and one of the names of the commodities along
+        with a column per field of the goods on every side of the shops. The goods are sorted by commodity then shop,
+        the order of Listings, so planners wrap the columns as they are, and the position of a good among the goods of
+        its shop keeps the order they are listed in.
+        :param paths: the path of every shop
+        :param commodities: the name of every commodity
+        :param columns: the columns by side and field joined by an underscore, such as sells_price, see SIDES and
+        FIELDS
+        :param digest: the digest of the data the market was converted from if known
+        :param path: the directory the columns are memory-mapped from, None if they are held in memory
+        """
+        self.paths = paths
+        self.commodities = commodities
+        self.columns = columns
+        self.digest = digest
+        self.path = path
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def nbytes(self) -> int:
+        return self.paths.nbytes + self.commodities.nbytes + sum(c.nbytes for c in self.columns.values())
+
+    @classmethod
+    def from_shops(cls, shops: Iterable[Shop], digest: str = None) -> "ColumnarMarket":
+        """
+        Converts shops into columns, where a good listed twice at a shop keeps the last listing as in Listings.
+        :param shops: the shops
+        :param digest: the digest of the data the shops were loaded from if known
+        :return: the market
+        """
+        shops = list(shops)
+        # the commodities are numbered in the order RoutePlanner numbers them
+        commodities = {}
+        for s in shops:
+            for c in s.buys + s.sells:
+                commodities.setdefault(c.name, len(commodities))
+        columns = {}
+        for side in cls.SIDES:
+            rows = [(i, commodities[c.name], c.price, c.stock, c.refresh, j)
+                    for i, s in enumerate(shops) for j, c in enumerate(getattr(s, side))]
+            shop, com, price, stock, refresh, position = zip(*rows) if rows else ([], [], [], [], [], [])
+            shop, com = np.array(shop, dtype=np.int32), np.array(com, dtype=np.int32)
+            # unique sorts by commodity then shop, and picks the last repeat through the reversed order
+            _, last = np.unique((com.astype(np.int64) * len(shops) + shop)[::-1], return_index=True)
+            keep = len(rows) - 1 - last
+            columns[side + "_shop"] = shop[keep]
+            columns[side + "_com"] = com[keep]
+            columns[side + "_price"] = np.array(price, dtype=np.float64)[keep]
+            columns[side + "_stock"] = np.array(stock, dtype=np.float64)[keep]
+            columns[side + "_refresh"] = np.array(refresh, dtype=np.float64)[keep]
+            columns[side + "_position"] = np.array(position, dtype=np.int32)[keep]
+        return cls(np.array([s.path for s in shops], dtype=np.str_), np.array(list(commodities), dtype=np.str_),
+                   columns, digest)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "ColumnarMarket":
+        """
+        Loads a market saved by save.
+        :param path: the directory of the market
+        :param mmap: whether to memory-map the columns read-only, so that processes loading the same market share its
+        pages instead of holding copies
+        :return: the market
+        """
+        with open(os.path.join(path, cls.MANIFEST), "r") as fp:
+            manifest = json.load(fp)
+        if manifest.get("format") != cls.FORMAT:
+            raise ValueError("%s holds a market of format %s rather than %d, convert the shops again"
+                             % (path, manifest.get("format"), cls.FORMAT))
+        mode = "r" if mmap else None
+        paths = np.load(os.path.join(path, "paths.npy"), mmap_mode=mode)
+        commodities = np.load(os.path.join(path, "commodities.npy"), mmap_mode=mode)
+        columns = {"%s_%s" % (side, field): np.load(os.path.join(path, "%s_%s.npy" % (side, field)), mmap_mode=mode)
+                   for side in cls.SIDES for field in cls.FIELDS}
+        return cls(paths, commodities, columns, manifest.get("digest"), path if mmap else None)
+
+    def writable(self, column: str) -> np.ndarray:
+        """
+        :param column: the name of the column, such as sells_stock
+        :return: a column the caller may write to without changing the market, which is a copy-on-write mapping of
+        the file when the market is memory-mapped, so that only the pages written to stop being shared, and a copy
+        otherwise
+        """
+        if self.path is None:
+            return np.array(self.columns[column])
+        return np.load(os.path.join(self.path, column + ".npy"), mmap_mode="c")
+
+    def save(self, path: str):
+        """
+        Saves the market as a directory of .npy files. Every file is replaced atomically and the manifest is written
+        last, so processes that memory-mapped the previous files keep reading them.
+        :param path: the directory of the market
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = dict(self.columns, paths=self.paths, commodities=self.commodities)
+        for name, array in arrays.items():
+            target = os.path.join(path, name + ".npy")
+            with open(target + ".tmp", "wb") as fp:
+                np.save(fp, np.asarray(array))
+            os.replace(target + ".tmp", target)
+        target = os.path.join(path, self.MANIFEST)
+        with open(target + ".tmp", "w") as fp:
+            json.dump({"format": self.FORMAT, "digest": self.digest, "shops": len(self)}, fp)
+        os.replace(target + ".tmp", target)
+
+    def to_shops(self) -> Tuple[Shop, ...]:
+        """
+        :return: the shops as Shop and Commodity tuples, with the goods of every shop in the order they were listed
+        """
+        goods = {}
+        for side in self.SIDES:
+            order = np.lexsort((self.columns[side + "_position"], self.columns[side + "_shop"]))
+            shop = self.columns[side + "_shop"][order]
+            names = self.commodities[self.columns[side + "_com"][order]].tolist()
+            values = zip(names, self.columns[side + "_price"][order].tolist(),
+                         self.columns[side + "_stock"][order].tolist(), self.columns[side + "_refresh"][order].tolist())
+            bounds = np.searchsorted(shop, np.arange(len(self) + 1))
+            rows = [Commodity(*v) for v in values]
+            goods[side] = [tuple(rows[bounds[i]:bounds[i + 1]]) for i in range(len(self))]
+        return tuple(Shop(path, goods["buys"][i], goods["sells"][i]) for i, path in enumerate(self.paths.tolist()))
 
 
 class RoutePlanner:
 
-    def __init__(self, shops: Iterable[Shop]):
+    def __init__(self, shops: Union[Iterable[Shop], ColumnarMarket]):
+        if isinstance(shops, ColumnarMarket):
+            self._init_columnar(shops)
+            return
+
         # builds indices to quickly transfer in and out of matrix forms
         self.shops_idx = {s.path: i for i, s in enumerate(shops)}
         self.shops_rev_idx = {i: s.path for i, s in enumerate(shops)}
@@ -35,29 +333,54 @@ class RoutePlanner:
 
         self.commodities_rev_idx = {i: v for v, i in self.commodities_idx.items()}
 
-        # Initializes the P, D, B, S matrices
-        self.supply = np.zeros((len(self.commodities_idx), len(self.shops_idx)))
-        self.demand = np.zeros((len(self.commodities_idx), len(self.shops_idx)))
-        self.buy_price = np.zeros((len(self.commodities_idx), len(self.shops_idx)))
-        self.sell_price = np.zeros((len(self.commodities_idx), len(self.shops_idx)))
+        # Initializes the listings holding P and B for the goods shops sell, and D and S for the goods they buy
+        shape = (len(self.commodities_idx), len(self.shops_idx))
+        sold = [(self.commodities_idx[sl.name], self.shops_idx[s.path], sl.price, sl.stock)
+                for s in shops for sl in s.sells]
+        bought = [(self.commodities_idx[b.name], self.shops_idx[s.path], b.price, b.stock)
+                  for s in shops for b in s.buys]
+        self.supply_listings = Listings(shape, *(zip(*sold) if sold else ([], [], [], [])))
+        self.demand_listings = Listings(shape, *(zip(*bought) if bought else ([], [], [], [])))
+
+    def _init_columnar(self, market: ColumnarMarket):
+        # the listings wrap the columns of the market, which are already in their order, and only the prices and
+        # stocks the market updates write to are mapped apart, see ColumnarMarket.writable
+        paths = market.paths.tolist()
+        self.shops_idx = {p: i for i, p in enumerate(paths)}
+        self.shops_rev_idx = dict(enumerate(paths))
+        self.commodities_idx = {c: i for i, c in enumerate(market.commodities.tolist())}
+        self.commodities_rev_idx = {i: v for v, i in self.commodities_idx.items()}
 
-        for s in shops:
-            if s.path not in self.shops_idx:
-                continue
-            for b in s.buys:
-                self.demand[self.commodities_idx[b.name], self.shops_idx[s.path]] = b.stock
-                self.sell_price[self.commodities_idx[b.name], self.shops_idx[s.path]] = b.price
-            for sl in s.sells:
-                self.supply[self.commodities_idx[sl.name], self.shops_idx[s.path]] = sl.stock
-                self.buy_price[self.commodities_idx[sl.name], self.shops_idx[s.path]] = sl.price
+        shape = (len(self.commodities_idx), len(self.shops_idx))
+        self.supply_listings = Listings.from_sorted(shape, market.columns["sells_com"], market.columns["sells_shop"],
+                                                    market.writable("sells_price"), market.writable("sells_stock"))
+        self.demand_listings = Listings.from_sorted(shape, market.columns["buys_com"], market.columns["buys_shop"],
+                                                    market.writable("buys_price"), market.writable("buys_stock"))
+
+    @property
+    def supply(self) -> np.ndarray:
+        return self.supply_listings.to_dense(self.supply_listings.stock)
+
+    @property
+    def demand(self) -> np.ndarray:
+        return self.demand_listings.to_dense(self.demand_listings.stock)
+
+    @property
+    def buy_price(self) -> np.ndarray:
+        return self.supply_listings.to_dense(self.supply_listings.price)
+
+    @property
+    def sell_price(self) -> np.ndarray:
+        return self.demand_listings.to_dense(self.demand_listings.price)
 
     def create_weights(self) -> Tuple:
         """
         Creates buy and sell weights according to the inverse demand and supply weighting scheme.
-        :return: buy weights and sell weights as a tuple
+        :return: buy weights over the supply listings and sell weights over the demand listings as a tuple
         """
-        buy_weight = np.divide(1, self.supply, out=np.zeros_like(self.supply), where=self.supply != 0)
-        sell_weight = np.divide(1, self.demand, out=np.zeros_like(self.demand), where=self.demand != 0)
+        supply, demand = self.supply_listings.stock, self.demand_listings.stock
+        buy_weight = np.divide(1, supply, out=np.zeros_like(supply), where=supply != 0)
+        sell_weight = np.divide(1, demand, out=np.zeros_like(demand), where=demand != 0)
         return buy_weight, sell_weight
 
     def update_supply(self, good, location, amount):
@@ -67,15 +390,8 @@ class RoutePlanner:
         :param location: the name of the location
         :param amount: the new amount of goods
         """
-        if good not in self.commodities_idx:
-            raise KeyError("%s not found" % good)
-        if location not in self.shops_idx:
-            raise KeyError("%s not found" % location)
-        if amount < 0:
-            raise ValueError("amount cannot be negative")
-        good_idx = self.commodities_idx[good]
-        location_idx = self.shops_idx[location]
-        self.supply[good_idx, location_idx] = amount
+        self.set_market("supply", good, location, amount)
+        bump_market_version()
 
     def update_demand(self, good, location, amount):
         """
@@ -84,15 +400,67 @@ class RoutePlanner:
         :param location: the name of location
         :param amount: the new amount
         """
+        self.set_market("demand", good, location, amount)
+        bump_market_version()
+
+    def update_buy_price(self, good, location, price):
+        """
+        updates the price of buying good at a given location
+        :param good: the name of the good
+        :param location: the name of the location
+        :param price: the new price
+        """
+        self.set_market("buy_price", good, location, price)
+        bump_market_version()
+
+    def update_sell_price(self, good, location, price):
+        """
+        updates the price of selling good at a given location
+        :param good: the name of the good
+        :param location: the name of the location
+        :param price: the new price
+        """
+        self.set_market("sell_price", good, location, price)
+        bump_market_version()
+
+    def set_market(self, kind, good, location, value):
+        """
+        Sets one value of the market in place without bumping the market version, see MARKET_KINDS.
+        The parameters of the compiled problems are bound from the listings before every solve, so the next solve sees
+        the value without any rebuild.
+        :param kind: the kind of value, one of MARKET_KINDS
+        :param good: the name of the good
+        :param location: the name of the location
+        :param value: the new value
+        """
         if good not in self.commodities_idx:
             raise KeyError("%s not found" % good)
         if location not in self.shops_idx:
             raise KeyError("%s not found" % location)
-        if amount < 0:
-            raise ValueError("amount cannot be negative")
-        good_idx = self.commodities_idx[good]
-        location_idx = self.shops_idx[location]
-        self.demand[good_idx, location_idx] = amount
+        if not value >= 0 or not math.isfinite(value):
+            raise ValueError("%s cannot be negative" % kind)
+        sold = kind in ("supply", "buy_price")
+        listings = self.supply_listings if sold else self.demand_listings
+        try:
+            listing = listings.find(self.commodities_idx[good], self.shops_idx[location])
+        except KeyError:
+            raise KeyError("%s is not %s at %s" % (good, "sold" if sold else "bought", location))
+        values = listings.stock if kind in ("supply", "demand") else listings.price
+        values[listing] = value
+
+    def updated(self, updates: Iterable[Tuple[str, str, str, float]]) -> "RoutePlanner":
+        """
+        Copies the planner with market updates applied, see set_market. The copy shares everything with the planner but
+        the prices and the stocks.
+        :param updates: the kind, the good, the location and the new value of every update
+        :return: the copy
+        """
+        planner = copy.copy(self)
+        planner.supply_listings = self.supply_listings.copy()
+        planner.demand_listings = self.demand_listings.copy()
+        for kind, good, location, value in updates:
+            planner.set_market(kind, good, location, value)
+        return planner
 
 
 RoutePath = namedtuple("RoutePath", ["start", "end", "buy", "sell"])
@@ -100,35 +468,193 @@ Transaction = namedtuple("Transaction", ["loc", "com", "amount"])
 
 HighLevelPlan = namedtuple("HighLevelPlan", ['cost', 'revenue', 'buy', 'sell'])
 
+# limits on a solve, None leaves the limit unset
+SolveBudget = namedtuple("SolveBudget", ["time_limit", "mip_gap", "node_limit"], defaults=(None, None, None))
+# whether a solve proved its result optimal, along with the best proven bound, the relative gap and the seconds spent in
+# total and until the first solution when known
+SolveStatus = namedtuple("SolveStatus", ["optimal", "bound", "gap", "time", "first_time"], defaults=(None, None))
+# the number of commodities, shops and listings before and after presolve
+PresolveReport = namedtuple("PresolveReport", ["commodities", "shops", "listings", "kept_commodities", "kept_shops",
+                                               "kept_listings"])
+
+
+class Timings:
+
+    def __init__(self):
+        """
+        The seconds spent per phase and the models solved while planning a request, see collect_timings.
+        """
+        self.phases = defaultdict(float)
+        self.models = []
+        # the stage the models solved next belong to, either plan, route or fast
+        self.stage = None
+
+    def to_dict(self) -> Dict:
+        return {"phases": dict(self.phases), "models": list(self.models)}
+
+
+_collecting = threading.local()
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects the timings of everything planned by the current thread within the context, which is only timed then.
+    :return: the Timings
+    """
+    previous = getattr(_collecting, "timings", None)
+    _collecting.timings = Timings()
+    try:
+        yield _collecting.timings
+    finally:
+        _collecting.timings = previous
+
+
+@contextmanager
+def timed(phase: str):
+    timings = getattr(_collecting, "timings", None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[phase] += time.perf_counter() - start
+
+
+def timed_phase(phase: str):
+    """
+    Times every call of the decorated function as the given phase, see timed.
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def add_time(phase: str, seconds: float):
+    timings = getattr(_collecting, "timings", None)
+    if timings is not None and seconds is not None:
+        # solvers report their times as numpy scalars or arrays, which do not pickle into plain floats
+        timings.phases[phase] += float(seconds)
+
+
+def set_stage(stage: str):
+    timings = getattr(_collecting, "timings", None)
+    if timings is not None:
+        timings.stage = stage
+
+
+def record_model(variables: int, constraints: int, nonzeros: int, profit: float, status: SolveStatus):
+    """
+    Records the size of a model solved in the current stage and the outcome of the solve, which is optimal, truncated
+    when a solution was found without proving it optimal, or none.
+    :param variables: the number of variables
+    :param constraints: the number of constraints
+    :param nonzeros: the number of nonzero coefficients of the constraints, None if unknown
+    :param profit: the objective value found
+    :param status: the status of the solve
+    """
+    timings = getattr(_collecting, "timings", None)
+    if timings is not None:
+        outcome = "none" if not math.isfinite(profit) else ("optimal" if status.optimal else "truncated")
+        timings.models.append({"stage": timings.stage, "variables": variables, "constraints": constraints,
+                               "nonzeros": nonzeros, "status": outcome})
+
+
+PathTree = namedtuple("PathTree", ["levels", "depth"])
+
+
+def tokenize_paths(paths: Iterable[str]) -> PathTree:
+    """
+    Tokenizes the ">" separated full paths of locations into a path tree.
+    Each distinct prefix of a path receives an integer id, so two locations share their ancestor at a given level
+    exactly when their ids at that level are equal.
+    :param paths: the full paths of the locations
+    :return: the path tree holding a locations x levels matrix of prefix ids, -1 past the end of a path, and the depth
+    of every path
+    """
+    parts = [path.split(">") for path in paths]
+    depth = np.array([len(p) for p in parts], dtype=np.int64)
+    levels = np.full((len(parts), depth.max(initial=0)), -1, dtype=np.int64)
+    prefix_ids = {}
+    for i, p in enumerate(parts):
+        parent = -1
+        for level, name in enumerate(p):
+            parent = prefix_ids.setdefault((parent, name.strip()), len(prefix_ids))
+            levels[i, level] = parent
+    return PathTree(levels, depth)
+
+
+def _subtree_incidence(tree: PathTree) -> Tuple[sp.csr_matrix, np.ndarray]:
+    """
+    Builds the incidence between locations and the subtrees of the path tree they belong to.
+    Besides one subtree per distinct path prefix, there is a root holding every location and one group per distinct
+    full path holding only the locations at exactly that path.
+    :param tree: the path tree of the locations
+    :return: a tuple of the locations x subtrees incidence matrix and the level of every subtree, which is 0 for the
+    root and -1 for the full path groups
+    """
+    n_paths = len(tree.depth)
+    has_level = tree.levels >= 0
+    prefixes, prefix_col = np.unique(tree.levels[has_level], return_inverse=True)
+    prefix_level = np.zeros(len(prefixes), dtype=np.int64)
+    prefix_level[prefix_col] = np.nonzero(has_level)[1] + 1
+    full_paths, full_col = np.unique(tree.levels[np.arange(n_paths), tree.depth - 1], return_inverse=True)
+
+    path_rows = np.arange(n_paths)
+    rows = np.concatenate([np.nonzero(has_level)[0], path_rows, path_rows])
+    cols = np.concatenate([prefix_col, len(prefixes) + full_col,
+                           np.full(n_paths, len(prefixes) + len(full_paths))])
+    incidence = sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                              shape=(n_paths, len(prefixes) + len(full_paths) + 1))
+    subtree_level = np.concatenate([prefix_level, np.full(len(full_paths), -1), [0]])
+    return incidence, subtree_level
+
+
+# the number of matrix cells compared at once, which bounds the temporaries for very large location sets
+_TRAVEL_COST_BLOCK = 1 << 22
+
+
+@lru_cache(maxsize=8)
+def _path_tree_cost(paths: Tuple[str, ...]) -> np.ndarray:
+    tree = tokenize_paths(paths)
+    n_paths, max_level = tree.levels.shape
+    result = np.zeros((n_paths, n_paths))
+    block = max(1, _TRAVEL_COST_BLOCK // max(n_paths, 1))
+    for start in range(0, n_paths, block):
+        rows = slice(start, start + block)
+        # prefix ids are unique per level, so the number of equal levels is the level of the lowest common ancestor
+        common = np.zeros((len(tree.depth[rows]), n_paths), dtype=np.int16)
+        for level in range(max_level):
+            ids = tree.levels[rows, level, None]
+            common += (ids == tree.levels[None, :, level]) & (ids >= 0)
+        cost = max_level - common
+        cost[common == np.maximum(tree.depth[rows, None], tree.depth[None, :])] = 0
+        result[rows] = cost
+    result.setflags(write=False)
+    return result
+
 
 def compute_travel_cost(paths: List[str], path_idx: Dict[str, int]):
     """
     Computes placeholder travel costs between locations.
-    It performs string matching between the full path of the locations and
-    sets the cost roughly as the depth of the full path tree - the level of the lowest common ancestor between two locations.
+    It sets the cost roughly as the depth of the full path tree - the level of the lowest common ancestor between two
+    locations. Results are cached by the list of locations and are read-only.
     :param paths: the list of locations to compute the cost for
     :param path_idx: the path index mapping to convert to matrix form
     :return: the R matrix
     """
+    cost = _path_tree_cost(tuple(paths))
+    idx = [path_idx[p] for p in paths]
+    if idx == list(range(len(paths))):
+        return cost
     result = np.zeros((len(paths), len(paths)))
-    max_level = -1
-    for p in paths:
-        p_pars = p.split(">")
-        if len(p_pars) >= max_level:
-            max_level = len(p_pars)
-
-    for shop_a, shop_b in product(paths, paths):
-        ix_a, ix_b = path_idx[shop_a], path_idx[shop_b]
-        if shop_a == shop_b:
-            result[ix_a, ix_b] = 0
-        parts_a = shop_a.split(">")
-        parts_b = shop_b.split(">")
-        curr_level = max_level
-        for a, b in zip_longest(parts_a, parts_b, fillvalue="-1"):
-            if a.strip() != b.strip():
-                result[ix_a, ix_b] = curr_level
-                break
-            curr_level = curr_level - 1
+    result[np.ix_(idx, idx)] = cost
     return result
 
 
@@ -159,27 +685,58 @@ def build_idx(transactions: List[Transaction]) -> Tuple:
 
 class TwoStagePlanner(RoutePlanner):
 
-    def __init__(self, shops: Iterable[Shop], solver: str = None, ignore_dpp=None):
+    def __init__(self, shops: Union[Iterable[Shop], ColumnarMarket], solver: str = None, ignore_dpp=None,
+                 backend: str = "cvxpy"):
         """
         initializes the planner
-        :param shops: the shops to operate over
+        :param shops: the shops to operate over, either as Shop tuples or in columnar form
         :param solver: the name of the solver
         :param ignore_dpp: whether to apply the DPP ruleset
+        :param backend: the default backend, either "cvxpy" or "scip" to build the models natively for SCIP
         """
 
         RoutePlanner.__init__(self, shops)
-        self._buy_weight, self._sell_weight = self.create_weights()
+        self._trv_c = compute_travel_cost([self.shops_rev_idx[i] for i in range(len(self.shops_idx))], self.shops_idx)
+        tree = tokenize_paths(self.shops_rev_idx[i] for i in range(len(self.shops_idx)))
+        self._subtrees, self._subtree_level = _subtree_incidence(tree)
+        # the depth of every shop, the deepest of the shops available to a solve sets its subtrees and travel costs
+        self._depth = tree.depth
         self.init_solve = self._formulate_step_one()
-        self._trv_c = compute_travel_cost([s.path for s in shops], self.shops_idx)
         self.solver = solver
-        self._init_supply = np.array(self.supply)
+        self.backend = backend
         self.ignore_dpp = ignore_dpp
-        self._init_demand = np.array(self.demand)
+        # a planner binds its parameters before every solve, so concurrent callers must take turns
+        self.lock = threading.Lock()
+        self._refinements = OrderedDict()
+        # the latest solution of stage one, which seeds the next solve
+        self._stage_one_start = None
+        # the status of the latest solve, read under the lock
+        self.solve_status = None
+        # the reduction of the latest stage one by presolve, see _presolve
+        self.presolve_report = None
+        # refinements over at most this many stops are solved by enumerating their orders
+        self.sequence_stops = SEQUENCE_STOPS
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Estimates the memory held by the planner, including the variables and parameters of the stage one problem.
+        :return: the estimated size in bytes
+        """
+        size = sum(v.nbytes for v in vars(self).values() if isinstance(v, (np.ndarray, Listings)))
+        size += sum(8 * p.size for p in self.init_solve.parameters())
+        size += sum(8 * v.size for v in self.init_solve.variables())
+        for problem in self._refinements.values():
+            size += sum(8 * p.size for p in problem.parameters())
+            size += sum(8 * v.size for v in problem.variables())
+        return size
 
     def plan_stage_one(self, cargo: int, max_percent=0.2, max_commodity: Dict[str, float] = None,
                        blk_locations: Iterable[str] = (),
-                       max_com_loc: Dict[str, Dict[str, float]] = None, max_level=2, n_stop=3) -> Tuple[
-        float, HighLevelPlan]:
+                       max_com_loc: Dict[str, Dict[str, float]] = None, max_level=2, n_stop=3,
+                       backend: str = None, budget: SolveBudget = None, warm_start: bool = True,
+                       exclude: Iterable[Iterable[str]] = (),
+                       available: np.ndarray = None) -> Tuple[float, HighLevelPlan]:
         """
         creates the high level plan for the given configuration.
         :param cargo: the available cargo spaces
@@ -189,27 +746,41 @@ class TwoStagePlanner(RoutePlanner):
         :param max_com_loc: sets the maximum percentage at a commodity/location level
         :param max_level: sets the maximum travel cost between any pair of locations
         :param n_stop: sets the number of stops to make
+        :param backend: the backend to solve with, defaults to the backend of the planner
+        :param budget: the limits on the solve, the best plan found is returned once one is reached, see solve_status
+        :param warm_start: whether to start from the previous plan
+        :param exclude: sets of locations, the plan may not visit every location of any of them
+        :param available: the mask of the shops the plan may visit, such as the ones selected by a filter, defaults to
+        all of them
         :return: a tuple consisting of the profit and the high level plan, or infinity and None if cannot be solved
         """
+        set_stage("plan")
+        params = self._market_params(cargo, max_percent=max_percent, max_commodity=max_commodity,
+                                     blk_locations=blk_locations, max_com_loc=max_com_loc, available=available)
+        params["T"] = self._allowed_subtrees(max_level, available)
+        params["NS"] = n_stop
+        params["Z"], params["H"] = self._no_good_cuts(exclude)
+        supply_kept, demand_kept, cols = self._presolve(params)
+
+        if (backend or self.backend) == "scip":
+            profit, I, L, self.solve_status = self._solve_stage_one_scip(params, budget, warm_start, supply_kept,
+                                                                         demand_kept, cols)
+        else:
+            for k, v in params.items():
+                self.init_solve.param_dict[k].value = v
+            profit, self.solve_status = self._solve_cvxpy(self.init_solve, budget, ignore_dpp=self.ignore_dpp,
+                                                          warm_start=warm_start)
+            I, L = self.init_solve.var_dict["I"].value, self.init_solve.var_dict["L"].value
 
-        self._init_params(self.init_solve, cargo, max_percent=max_percent, max_commodity=max_commodity,
-                          blk_locations=blk_locations, max_com_loc=max_com_loc)
-        self.init_solve.param_dict["R"].value = self._trv_c
-        self.init_solve.param_dict["ML"].value = max_level
-        self.init_solve.param_dict["NS"].value = n_stop
-
-        profit = self.init_solve.solve(solver=self.solver, ignore_dpp=self.ignore_dpp)
         if math.isfinite(profit):
-            self.init_solve.var_dict["I"].value[np.where(self.init_solve.var_dict["I"].value < EPSILON)] = 0
-            self.init_solve.var_dict["L"].value[np.where(self.init_solve.var_dict["L"].value < EPSILON)] = 0
-            return profit, self._extract_plan(self.shops_rev_idx, self.commodities_rev_idx,
-                                              self.init_solve.var_dict["I"], self.init_solve.var_dict["L"],
-                                              self.init_solve.param_dict["S"],
-                                              self.init_solve.param_dict["B"])
+            I[np.where(I < EPSILON)] = 0
+            L[np.where(L < EPSILON)] = 0
+            return profit, self._extract_plan(I, L, params["S"], params["B"])
         return profit, None
 
     def plan_refinement(self, plan, cargo, max_percent=0.2, max_commodity=None, blk_locations=(),
-                        max_com_loc=None, travel_weight=1e-3) -> Tuple[float, List[RoutePath]]:
+                        max_com_loc=None, travel_weight=1e-3, backend: str = None,
+                        budget: SolveBudget = None, available: np.ndarray = None) -> Tuple[float, List[RoutePath]]:
         """
 
         :param plan: the HighLevelPlan
@@ -219,54 +790,391 @@ class TwoStagePlanner(RoutePlanner):
         :param blk_locations: sets the list of locations to blacklist
         :param max_com_loc: sets the maximum percentage at a commodity/location level
         :param travel_weight: the weight assigned to the travel cost penalty
+        :param backend: the backend to solve with, defaults to the backend of the planner
+        :param budget: the limits on the solve, the best route found is returned once one is reached, see solve_status
+        :param available: the mask of the shops the plan was made over, which sets the travel costs, defaults to all of
+        them
         :return: a tuple consisting of the profit and the route, or infinity and None if cannot be solved
         """
+        set_stage("route")
         shop_idx, shop_rev_idx, com_idx, com_rev_idx = build_idx([t for t in plan.buy] +
                                                                  [t for t in plan.sell])
 
-        if max_commodity is not None:
-            max_commodity = {k: v for k, v in max_commodity.items() if k in com_idx}
+        shop_selector = [self.shops_idx[shop_rev_idx[i]] for i in range(len(shop_idx))]
+        com_selector = [self.commodities_idx[com_rev_idx[i]] for i in range(len(com_idx))]
+        params = self._market_params(cargo, max_percent=max_percent, max_commodity=max_commodity,
+                                     blk_locations=blk_locations, max_com_loc=max_com_loc, rows=com_selector,
+                                     cols=shop_selector)
+        params["R"] = self._cherry_pick_travel(plan, shop_idx, available)
+
+        if len(shop_idx) <= self.sequence_stops:
+            profit, X, I, L, self.solve_status = self._solve_refinement_orders(params, travel_weight)
+        elif (backend or self.backend) == "scip":
+            # the refinements are small enough that SCIP solves them faster cold than from any start, see
+            # benchmarks/warm_start.py
+            profit, X, I, L, self.solve_status = self._solve_refinement_scip(params, travel_weight, budget)
+        else:
+            refinement_prob = self._get_refinement(len(shop_idx), len(com_idx), travel_weight)
+            for k, v in params.items():
+                refinement_prob.param_dict[k].value = v
+            profit, self.solve_status = self._solve_cvxpy(refinement_prob, budget)
+            X, I, L = [refinement_prob.var_dict[k].value for k in ("X", "I", "L")]
 
-        blk_locations = [l for l in blk_locations if l in shop_idx]
+        if math.isfinite(profit):
+            I[np.where(I < EPSILON)] = 0
+            L[np.where(L < EPSILON)] = 0
+            return profit, self._extract_route(X, I, L, shop_rev_idx, com_rev_idx)
+        return profit, None
 
-        if max_com_loc is not None:
-            temp = {}
-            for k, locs in max_com_loc.items():
-                if k not in com_idx:
+    def plan_fast(self, cargo: int, max_percent=0.2, max_commodity: Dict[str, float] = None,
+                  blk_locations: Iterable[str] = (), max_com_loc: Dict[str, Dict[str, float]] = None, max_level=2,
+                  n_stop=3, travel_weight=1e-3, candidates=3,
+                  available: np.ndarray = None) -> Tuple[float, HighLevelPlan, List[RoutePath], float]:
+        """
+        Plans heuristically in place of the two MIPs.
+        The LP relaxation of stage one bounds the profit of any route. Its stops are rounded greedily and by the
+        relaxation, see _round_stops, after which the trades over those stops are repaired with the same LP with X
+        and Y fixed. The stops are then ordered by local search over the trades a route can actually carry, see
+        _simulate_route, and the best route over all the roundings is kept.
+        :param cargo: the available cargo spaces
+        :param max_percent: the maximum percentage of goods to buy and sell with respect to the demand and supply at a given location
+        :param max_commodity: sets the maximum percentage at a commodity level
+        :param blk_locations: sets the list of locations to blacklist
+        :param max_com_loc: sets the maximum percentage at a commodity/location level
+        :param max_level: sets the maximum travel cost between any pair of locations
+        :param n_stop: sets the number of stops to make
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :param candidates: the number of subtrees to round into
+        :param available: the mask of the shops the plan may visit, defaults to all of them
+        :return: a tuple of the profit, the high level plan, the routes and the upper bound on the profit, where the
+        profit is -infinity and the plan and routes are None if cannot be solved
+        """
+        set_stage("fast")
+        params = self._market_params(cargo, max_percent=max_percent, max_commodity=max_commodity,
+                                     blk_locations=blk_locations, max_com_loc=max_com_loc, available=available)
+        params["T"] = self._allowed_subtrees(max_level, available)
+        params["NS"] = n_stop
+        params["Z"], params["H"] = self._no_good_cuts(())
+        supply_kept, demand_kept, cols = self._presolve(params)
+        T = self._stop_subtrees(params)
+        if not np.any(T):
+            return -np.inf, None, None, -np.inf
+        if len(supply_kept) == 0 or len(demand_kept) == 0:
+            return 0.0, HighLevelPlan(0, 0, [], []), [], 0.0
+
+        objective, A_ub, b_ub, A_eq, b_eq, upper, _ = self._stage_one_model(params, T, supply_kept, demand_kept, cols)
+        n_i, n_l, M = len(supply_kept), len(demand_kept), len(cols)
+        n_trades, V = n_i + n_l, len(T)
+
+        # every listing carries at most the cargo, and only at a stop, which tightens the relaxation considerably
+        supply, demand = self.supply_listings, self.demand_listings
+        cap_i = np.minimum(params["P"][supply_kept], cargo)
+        cap_l = np.minimum(params["D"][demand_kept], cargo)
+        stop_i = sp.csr_matrix((-cap_i, (np.arange(n_i), np.searchsorted(cols, supply.shop[supply_kept]))),
+                               shape=(n_i, M))
+        stop_l = sp.csr_matrix((-cap_l, (np.arange(n_l), np.searchsorted(cols, demand.shop[demand_kept]))),
+                               shape=(n_l, M))
+        cuts = sp.bmat([[sp.eye(n_i), None, stop_i, sp.csr_matrix((n_i, V))],
+                        [None, sp.eye(n_l), stop_l, None]])
+        with timed("solve"):
+            relaxed = linprog(-objective, A_ub=sp.vstack([A_ub, cuts]),
+                              b_ub=np.concatenate([b_ub, np.zeros(n_trades)]), A_eq=A_eq, b_eq=b_eq,
+                              bounds=np.c_[np.zeros_like(upper), upper])
+        record_model(len(objective), A_ub.shape[0] + n_trades + A_eq.shape[0], A_ub.nnz + cuts.nnz + A_eq.nnz,
+                     -relaxed.fun if relaxed.status == 0 else -np.inf, SolveStatus(relaxed.status == 0, None, None))
+        if relaxed.status != 0:
+            return -np.inf, None, None, -np.inf
+        bound = -relaxed.fun
+
+        best = (-np.inf, None, None)
+        for v, stops in self._round_stops(params, T, supply_kept, demand_kept, cols,
+                                          relaxed.x[n_trades:n_trades + M], candidates):
+            # repairs the trades over the rounded stops with X and Y fixed
+            fixed = np.zeros_like(upper)
+            fixed[n_trades + stops] = 1
+            fixed[n_trades + M + v] = 1
+            fixed[:n_trades] = upper[:n_trades]
+            lower = np.where(np.arange(len(upper)) < n_trades, 0, fixed)
+            with timed("solve"):
+                repaired = linprog(-objective, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq,
+                                   bounds=np.c_[lower, fixed])
+            if repaired.status != 0:
+                continue
+            I, L = np.zeros(len(supply)), np.zeros(len(demand))
+            I[supply_kept] = repaired.x[:n_i]
+            L[demand_kept] = repaired.x[n_i:n_trades]
+            I[I < EPSILON] = 0
+            L[L < EPSILON] = 0
+            profit, routes = self._sequence_stops(I, L, params["B"], params["S"], cargo, travel_weight,
+                                                  self._available_depth() - self._available_depth(available))
+            if profit > best[0]:
+                best = (profit, self._extract_plan(I, L, params["S"], params["B"]), routes)
+        return best + (bound,)
+
+    def _round_stops(self, params: Dict, T: np.ndarray, supply_kept: np.ndarray, demand_kept: np.ndarray,
+                     cols: np.ndarray, X: np.ndarray, candidates: int) -> List[Tuple[int, np.ndarray]]:
+        """
+        Rounds the stops of the relaxation in two ways over the allowed subtrees with the best candidates.
+        The greedy rounding adds the shops of the most profitable pairs of a buy and a sell listing of the same
+        commodity, valued by their margin per SCU times the amount that can be carried, until NS stops are picked.
+        The relaxed rounding picks the NS shops with the largest X.
+        :param params: the values of the parameters of _formulate_step_one by name
+        :param T: the subtrees the stops may lie in, see _stop_subtrees
+        :param supply_kept: the indices of the supply listings kept by presolve
+        :param demand_kept: the indices of the demand listings kept by presolve
+        :param cols: the indices of the shops kept by presolve
+        :param X: the relaxed stops over the kept shops
+        :param candidates: the number of subtrees to round into for each rounding
+        :return: a list of the subtree and the positions of the stops in cols
+        """
+        supply, demand = self.supply_listings, self.demand_listings
+        n_stop = int(params["NS"])
+        members = self._subtrees[cols].tocsc()
+        allowed = np.nonzero(T)[0]
+
+        # every pair of a supply and a demand listing of the same commodity
+        l_order = np.argsort(demand.com[demand_kept], kind="stable")
+        l_coms = demand.com[demand_kept][l_order]
+        i_coms = supply.com[supply_kept]
+        first = np.searchsorted(l_coms, i_coms, side="left")
+        counts = np.searchsorted(l_coms, i_coms, side="right") - first
+        pair_i = supply_kept[np.repeat(np.arange(len(supply_kept)), counts)]
+        pair_l = demand_kept[l_order[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]]
+        value = (params["S"][pair_l] - params["B"][pair_i]) * np.minimum(
+            np.minimum(params["P"][pair_i], params["D"][pair_l]), params["C"])
+        profitable = value > 0
+        pair_i, pair_l, value = pair_i[profitable], pair_l[profitable], value[profitable]
+        shop_i = np.searchsorted(cols, supply.shop[pair_i])
+        shop_l = np.searchsorted(cols, demand.shop[pair_l])
+        # the subtrees holding both shops of every pair
+        pair_members = members[shop_i].multiply(members[shop_l]).tocsc()
+
+        rounded = []
+        best_pair = np.array([value[pair_members.indices[pair_members.indptr[v]:pair_members.indptr[v + 1]]].max(
+            initial=0) for v in allowed])
+        for v in allowed[np.argsort(-best_pair, kind="stable")[:candidates]]:
+            pairs = pair_members.indices[pair_members.indptr[v]:pair_members.indptr[v + 1]]
+            stops = []
+            for p in pairs[np.argsort(-value[pairs], kind="stable")]:
+                new = {shop_i[p], shop_l[p]} - set(stops)
+                if len(stops) + len(new) <= n_stop:
+                    stops.extend(sorted(new))
+                if len(stops) == n_stop:
+                    break
+            rounded.append((v, np.array(stops, dtype=np.int64)))
+
+        relaxed_score = []
+        for v in allowed:
+            shops = members.indices[members.indptr[v]:members.indptr[v + 1]]
+            stops = shops[np.argsort(-X[shops], kind="stable")[:n_stop]]
+            relaxed_score.append((X[stops].sum(), v, stops))
+        relaxed_score.sort(key=lambda score: score[0], reverse=True)
+        rounded.extend((v, stops) for _, v, stops in relaxed_score[:candidates])
+        return rounded
+
+    @timed_phase("sequencing")
+    def _sequence_stops(self, I: np.ndarray, L: np.ndarray, B: np.ndarray, S: np.ndarray, cargo: int,
+                        travel_weight: float, offset: int = 0) -> Tuple[float, List[RoutePath]]:
+        """
+        Orders the stops of a plan by local search, starting from the net buyers first and moving single stops for as
+        long as the profit of the route net of the travel penalty improves.
+        :param I: the amounts bought over the supply listings
+        :param L: the amounts sold over the demand listings
+        :param B: the buy prices over the supply listings
+        :param S: the sell prices over the demand listings
+        :param cargo: the available cargo space
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :param offset: the amount the travel costs between distinct locations are lowered by, see _cherry_pick_travel
+        :return: a tuple of the profit net of the travel penalty and the routes
+        """
+        supply, demand = self.supply_listings, self.demand_listings
+        buys, sells = defaultdict(list), defaultdict(list)
+        for p in np.nonzero(I)[0]:
+            buys[supply.shop[p]].append((supply.com[p], I[p], B[p]))
+        for p in np.nonzero(L)[0]:
+            sells[demand.shop[p]].append((demand.com[p], L[p], S[p]))
+        stops = sorted(set(buys) | set(sells),
+                       key=lambda stop: sum(a for _, a, _ in sells[stop]) - sum(a for _, a, _ in buys[stop]))
+
+        def evaluate(order):
+            profit, _ = _simulate_route(order, buys, sells, cargo)
+            return profit - travel_weight * sum(max(self._trv_c[a, b] - offset, 0) for a, b in zip(order, order[1:]))
+
+        best = evaluate(stops)
+        improved = True
+        while improved:
+            improved = False
+            for i, j in product(range(len(stops)), repeat=2):
+                if i == j:
                     continue
-                temp[k] = {}
-                for l, amount in locs.items():
-                    if l not in shop_idx:
-                        continue
-                    temp[k][l] = amount
-
-            max_com_loc = temp
+                order = stops[:i] + stops[i + 1:]
+                order.insert(j, stops[i])
+                value = evaluate(order)
+                if value > best + EPSILON:
+                    stops, best, improved = order, value, True
+                    break
+
+        _, trades = _simulate_route(stops, buys, sells, cargo)
+        routes = []
+        start = "start"
+        for stop, (bought, sold) in zip(stops, trades):
+            loc = self.shops_rev_idx[stop]
+            routes.append(RoutePath(start, loc,
+                                    [Transaction(loc, self.commodities_rev_idx[c], a) for c, a in bought],
+                                    [Transaction(loc, self.commodities_rev_idx[c], a) for c, a in sold]))
+            start = loc
+        return best, routes
+
+    def plan_batch(self, requests: Iterable[Dict], **kwargs) -> Iterator[Tuple[int, HighLevelPlan, List[RoutePath]]]:
+        """
+        Plans many configurations in this process over the same compiled problems, for sweeps run outside the server.
+        The requests are solved in sorted order, so that consecutive solves tend to differ in a single option and warm
+        start each other, and yielded as each finishes. /optimize/batch does not use it, as it spreads the requests
+        over the planners of every worker process instead, see JobManager.run_batch, which beats solving them one
+        after the other in a single process.
+        :param requests: the options of plan_stage_one for every configuration, which must include cargo, along with
+        travel_weight for the refinement
+        :param kwargs: the options shared by every configuration
+        :return: an iterator of the index of the request, the high level plan and the routes, where the plan and the
+        routes are None if cannot be solved
+        """
+        requests = [dict(kwargs, **r) for r in requests]
+        order = sorted(range(len(requests)), key=lambda i: json.dumps(requests[i], sort_keys=True, default=str))
+        for i in order:
+            options = dict(requests[i])
+            travel_weight = options.pop("travel_weight", 1e-3)
+            # the lock is only held per configuration, so that the planner serves others while the caller consumes
+            with self.lock:
+                _, plan = self.plan_stage_one(**options)
+                routes = None
+                if plan is not None and len(plan.buy) > 0:
+                    _, routes = self.plan_refinement(plan, options["cargo"], travel_weight=travel_weight,
+                                                     **{k: v for k, v in options.items() if k in _REFINEMENT_OPTIONS})
+            yield i, plan, routes
+
+    def plan_alternatives(self, k: int, cargo: int, travel_weight=1e-3, budget: SolveBudget = None,
+                          **kwargs) -> Tuple[List[Tuple[float, HighLevelPlan, List[RoutePath]]],
+                                             Dict[str, SolveStatus]]:
+        """
+        Plans up to k alternatives visiting distinct sets of locations, each refined into a route.
+        Every stage one solve adds a no-good cut on the stops of the previous plans, so the alternatives reuse the
+        compiled problem and only differ in the values of its parameters.
+        :param k: the number of alternatives, at most MAX_ALTERNATIVES + 1
+        :param cargo: the available cargo spaces
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :param budget: the limits on the solves, where the time limit covers all of them
+        :param kwargs: the further options of plan_stage_one
+        :return: a tuple of the alternatives as the profit, the high level plan and the routes, best first, and the
+        merged status of the plan and of the route solves
+        """
+        if not 1 <= k <= MAX_ALTERNATIVES + 1:
+            raise ValueError("k must be between 1 and %d" % (MAX_ALTERNATIVES + 1))
+        deadline = None
+        if budget is not None and budget.time_limit is not None:
+            deadline = time.monotonic() + budget.time_limit
+        options = {key: v for key, v in kwargs.items() if key in _REFINEMENT_OPTIONS}
+        alternatives = []
+        exclude = []
+        plan_status = []
+        route_status = []
+        for _ in range(k):
+            # a cancelled request keeps the alternatives found so far rather than starting on the next
+            if alternatives and solve_cancelled():
+                break
+            # the time limit covers every solve, so stage one gets a share of what is left and its refinement the rest
+            if deadline is not None:
+                budget = budget._replace(time_limit=max(deadline - time.monotonic(), 0) * STAGE_ONE_SHARE)
+            _, plan = self.plan_stage_one(cargo, budget=budget, exclude=exclude, **kwargs)
+            plan_status.append(self.solve_status)
+            if plan is None or len(plan.buy) == 0:
+                break
+            exclude.append({t.loc for t in plan.buy} | {t.loc for t in plan.sell})
 
-        refinement_prob = self._formulate_refinement(n_locs=len(shop_idx), n_coms=len(com_idx),
-                                                     lambda_weight=travel_weight)
+            if deadline is not None:
+                budget = budget._replace(time_limit=max(deadline - time.monotonic(), 0))
+            profit, routes = self.plan_refinement(plan, cargo, travel_weight=travel_weight, budget=budget, **options)
+            route_status.append(self.solve_status)
+            if routes is None:
+                # a refinement out of time still leaves the plan, visited so that goods are picked up before delivery
+                profit, routes = plan.revenue - plan.cost, self._implied_routes(plan)
+            alternatives.append((profit, plan, routes))
 
-        shop_selector = [self.shops_idx[shop_rev_idx[i]] for i in range(len(shop_idx))]
-        com_selector = [self.commodities_idx[com_rev_idx[i]] for i in range(len(com_idx))]
-        self._init_params(refinement_prob, cargo, max_percent=max_percent, max_commodity=max_commodity,
-                          blk_locations=blk_locations,
-                          max_com_loc=max_com_loc, com_idx=com_idx, shop_idx=shop_idx, rows=com_selector,
-                          cols=shop_selector)
+        alternatives.sort(key=lambda a: a[0], reverse=True)
+        return alternatives, {"plan": _merge_status(plan_status), "route": _merge_status(route_status)}
 
-        refinement_prob.param_dict["R"].value = self._cherry_pick_travel(plan, shop_idx)
-        profit = refinement_prob.solve(solver=self.solver)
-        if math.isfinite(profit):
-            refinement_prob.var_dict["I"].value[np.where(refinement_prob.var_dict["I"].value < EPSILON)] = 0
-            refinement_prob.var_dict["L"].value[np.where(refinement_prob.var_dict["L"].value < EPSILON)] = 0
-            return profit, self._extract_route(refinement_prob.var_dict["X"], refinement_prob.var_dict["I"],
-                                               refinement_prob.var_dict["L"], shop_rev_idx,
-                                               com_rev_idx)
-        return profit, None
+    def _implied_routes(self, plan: HighLevelPlan) -> List[RoutePath]:
+        """
+        :param plan: the HighLevelPlan
+        :return: the routes implied by the plan without a refinement, see _implied_route
+        """
+        shop_idx, shop_rev_idx, com_idx, com_rev_idx = build_idx(list(plan.buy) + list(plan.sell))
+        X, I, L = _implied_route(plan, shop_idx, com_idx)
+        return self._extract_route(X, I, L, shop_rev_idx, com_rev_idx)
 
-    def _cherry_pick_travel(self, plan, new_shop_idx):
+    def _solve_cvxpy(self, problem: cp.Problem, budget: SolveBudget = None, **kwargs) -> Tuple[float, SolveStatus]:
+        """
+        Solves a problem through CVXPY within the given budget.
+        CVXPY does not report the bound of a truncated solve, so the bound and gap are only known when it is optimal.
+        Warm starts are left to CVXPY, which only passes them on to the solvers supporting them.
+        :param problem: the problem
+        :param budget: the limits on the solve
+        :param kwargs: the further options of the solve
+        :return: a tuple of the profit, or -infinity if no solution was found, and the status of the solve
         """
-        Selects a sub-matrix from the travel cost matrix given a plan
+        if budget is not None and self.solver == "SCIP":
+            kwargs["scip_params"] = _scip_limits(budget)
+        start = time.perf_counter()
+        try:
+            profit = problem.solve(solver=self.solver, **kwargs)
+        except cp.SolverError:
+            # the status is left over from the previous solve, so nothing is known about this one
+            add_time("solve", time.perf_counter() - start)
+            return -np.inf, SolveStatus(False, None, None)
+        # CVXPY reports how long it spent compiling, and the solver how long it spent solving when it knows
+        compilation = getattr(problem, "compilation_time", None) or 0.0
+        add_time("canonicalization", compilation)
+        solve_time = problem.solver_stats.solve_time if problem.solver_stats is not None else None
+        add_time("solve", solve_time if solve_time is not None else time.perf_counter() - start - compilation)
+
+        if profit is None:
+            profit, status = -np.inf, SolveStatus(False, None, None)
+        elif problem.status == cp.OPTIMAL:
+            status = SolveStatus(True, profit, 0.0)
+        elif not math.isfinite(profit) or problem.status not in cp.settings.SOLUTION_PRESENT:
+            profit, status = -np.inf, SolveStatus(problem.status in cp.settings.INF_OR_UNB, None, None)
+        else:
+            status = SolveStatus(False, None, None)
+        size = problem.size_metrics
+        record_model(size.num_scalar_variables, size.num_scalar_eq_constr + size.num_scalar_leq_constr, None,
+                     profit, status)
+        return profit, status
+
+    def _get_refinement(self, n_locs, n_coms, travel_weight):
+        """
+        Retrieves the compiled refinement problem of the given shape, formulating it on first use.
+        :param n_locs: the number of locations
+        :param n_coms: the number of commodities
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :return: the problem
+        """
+        key = (n_locs, n_coms, travel_weight)
+        if key in self._refinements:
+            self._refinements.move_to_end(key)
+            return self._refinements[key]
+        problem = self._formulate_refinement(n_locs=n_locs, n_coms=n_coms, lambda_weight=travel_weight)
+        self._refinements[key] = problem
+        if len(self._refinements) > MAX_REFINEMENTS:
+            self._refinements.popitem(last=False)
+        return problem
+
+    def _cherry_pick_travel(self, plan, new_shop_idx, available: np.ndarray = None):
+        """
+        Selects a sub-matrix from the travel cost matrix given a plan.
+        The costs are relative to the deepest shop, so they are lowered to the ones among the available shops alone,
+        which only differ between distinct locations.
         :param plan: the HighLevelPlan
         :param new_shop_idx: the smaller shop index
+        :param available: the mask of the shops the plan was made over, defaults to all of them
         :return: the new cost matrix
         """
         transactions = [t for t in plan.buy] + [t for t in plan.sell]
@@ -274,101 +1182,166 @@ class TwoStagePlanner(RoutePlanner):
         travel_cost_idx = [self.shops_idx[l] for l in locations]
         new_travel_cost_idx = [new_shop_idx[l] for l in locations]
         cost_idx = zip(travel_cost_idx, new_travel_cost_idx)
+        offset = self._available_depth() - self._available_depth(available)
         result = np.zeros((len(new_shop_idx), len(new_shop_idx)))
         for (i, ip), (j, jp) in product(cost_idx, cost_idx):
-            result[ip, jp] = self._trv_c[i, j]
+            result[ip, jp] = max(self._trv_c[i, j] - offset, 0)
         return result
 
-    def _init_params(self, problem: cp.Problem, cargo: int, max_percent=0.2, max_commodity: Dict[str, float] = None,
-                     blk_locations: Iterable[str] = (),
-                     max_com_loc: Dict[str, Dict[str, float]] = None, com_idx: Dict[str, int] = None,
-                     shop_idx: Dict[str, int] = None, rows: List[int] = None, cols: List[int] = None):
+    @timed_phase("params")
+    def _presolve(self, params: Dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Removes what cannot contribute to the profit of stage one.
+        Buying a commodity at a price no lower than anywhere sells it, or selling it at a price no higher than anywhere
+        buys it, never adds profit, so those bounds in P and D are set to zero. Commodities left without a place to buy
+        or to sell, which includes the blacklisted locations and the commodities limited to zero, are dropped along
+        with the shops trading none of the remaining commodities. The report is kept in presolve_report.
+        :param params: the values of the parameters of _formulate_step_one by name, whose P and D are replaced
+        :return: a tuple of the indices of the supply listings, the demand listings and the shops kept
+        """
+        supply, demand = self.supply_listings, self.demand_listings
+        P, D, B, S = params["P"], params["D"], params["B"], params["S"]
+        n_coms, n_shops = supply.shape
+        min_buy = np.full(n_coms, np.inf)
+        np.minimum.at(min_buy, supply.com[P > 0], B[P > 0])
+        max_sell = np.full(n_coms, -np.inf)
+        np.maximum.at(max_sell, demand.com[D > 0], S[D > 0])
+        params["P"] = np.where(B < max_sell[supply.com], P, 0)
+        params["D"] = np.where(S > min_buy[demand.com], D, 0)
+
+        traded = np.zeros(n_coms, dtype=bool)
+        traded[supply.com[params["P"] > 0]] = True
+        sold = np.zeros(n_coms, dtype=bool)
+        sold[demand.com[params["D"] > 0]] = True
+        traded &= sold
+        supply_kept = np.nonzero((params["P"] > 0) & traded[supply.com])[0]
+        demand_kept = np.nonzero((params["D"] > 0) & traded[demand.com])[0]
+        cols = np.union1d(supply.shop[supply_kept], demand.shop[demand_kept])
+        self.presolve_report = PresolveReport(n_coms, n_shops, len(supply) + len(demand), int(traded.sum()),
+                                              len(cols), len(supply_kept) + len(demand_kept))
+        return supply_kept, demand_kept, cols
+
+    def _no_good_cuts(self, exclude: Iterable[Iterable[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Builds the cuts Z @ X <= H keeping stage one from visiting every location of any of the excluded sets.
+        The unused rows are left at zero, which keeps them satisfied.
+        :param exclude: the sets of locations
+        :return: a tuple of the Z and H matrices
         """
-        Initializes the matrices for the given problem
-        :param problem: the optimization problem
+        exclude = [set(e) for e in exclude]
+        if len(exclude) > MAX_ALTERNATIVES:
+            raise ValueError("at most %d sets of locations can be excluded" % MAX_ALTERNATIVES)
+        Z = np.zeros((MAX_ALTERNATIVES, len(self.shops_idx)))
+        H = np.zeros(MAX_ALTERNATIVES)
+        for row, locations in enumerate(exclude):
+            Z[row, [self.shops_idx[l] for l in locations]] = 1
+            H[row] = len(locations) - 1
+        return Z, H
+
+    def _available_depth(self, available: np.ndarray = None) -> int:
+        """
+        :param available: the mask of the available shops, defaults to all of them
+        :return: the depth of the deepest available shop
+        """
+        depth = self._depth if available is None else self._depth[available]
+        return int(depth.max(initial=0))
+
+    def _allowed_subtrees(self, max_level, available: np.ndarray = None):
+        """
+        Selects the subtrees that may hold all the stops of a plan.
+        The travel costs form an ultrametric over the path tree, so the stops are pairwise at most max_level apart
+        exactly when they share an ancestor at the depth of the tree - max_level, or when they are the same location.
+        The tree is the one of the available shops, as if the planner was built over them alone.
+        :param max_level: the maximum travel cost between any pair of locations
+        :param available: the mask of the shops the stops may be, defaults to all of them
+        :return: the mask over the subtrees
+        """
+        depth = math.ceil(self._available_depth(available) - max_level)
+        if depth <= 0:
+            return (self._subtree_level == 0).astype(float)
+        return ((self._subtree_level == depth) | (self._subtree_level == -1)).astype(float)
+
+    @timed_phase("params")
+    def _market_params(self, cargo: int, max_percent=0.2, max_commodity: Dict[str, float] = None,
+                       blk_locations: Iterable[str] = (),
+                       max_com_loc: Dict[str, Dict[str, float]] = None, rows: List[int] = None,
+                       cols: List[int] = None, available: np.ndarray = None) -> Dict:
+        """
+        Computes the parameters for a problem, over the listings for stage one or as dense matrices for a refinement.
+        The percentage limits are folded together with the supply and demand into the upper bounds P and D, so that no
+        parameter multiplies a variable and the problems stay cheap to canonicalize under DPP. The shops outside of
+        the available ones or blacklisted cannot trade, which lets a single planner over every shop serve any filter.
         :param cargo: the available cargo space
         :param max_percent: the maximum percentage of goods to buy and sell with respect to the demand and supply at a given location
         :param max_commodity: sets the maximum percentage at a commodity level
         :param blk_locations: sets the list of locations to blacklist
         :param max_com_loc: sets the maximum percentage at a commodity/location level
-        :param com_idx: the commodity index
-        :param shop_idx: the shop index
-        :param rows: the rows of the matrices to subset if any
-        :param cols: the columns of the matrices to subset if any
-        """
-        buy_price = self.buy_price
-        sell_price = self.sell_price
-        demand = self.demand
-        supply = self.supply
-        buy_weight = self._buy_weight
-        sell_weight = self._sell_weight
-
-        if rows is not None:
-            buy_price = buy_price[rows, :]
-            sell_price = sell_price[rows, :]
-            demand = demand[rows, :]
-            supply = supply[rows, :]
-            buy_weight = buy_weight[rows, :]
-            sell_weight = sell_weight[rows, :]
-
-        if cols is not None:
-            buy_price = buy_price[:, cols]
-            sell_price = sell_price[:, cols]
-            demand = demand[:, cols]
-            supply = supply[:, cols]
-            buy_weight = buy_weight[:, cols]
-            sell_weight = sell_weight[:, cols]
-
-        if com_idx is None:
-            com_idx = self.commodities_idx
-        if shop_idx is None:
-            shop_idx = self.shops_idx
-
-        problem.param_dict["B"].value = buy_price
-        problem.param_dict["S"].value = sell_price
-        problem.param_dict["D"].value = demand
-        problem.param_dict["P"].value = supply
-        problem.param_dict["Wb"].value = buy_weight
-        problem.param_dict["Ws"].value = sell_weight
-        problem.param_dict["C"].value = cargo
-        problem.param_dict["Q"].value = np.ones((len(com_idx), len(shop_idx))) * max_percent
-        if max_commodity is not None:
-            for k, percent in max_commodity.items():
-                problem.param_dict["Q"].value[com_idx[k], :] = percent
-        if max_com_loc is not None:
-            for k, locs in max_com_loc.items():
-                for l, amount in locs.items():
-                    problem.param_dict["Q"].value[com_idx[k], shop_idx[l]] = amount
-        for loc in blk_locations:
-            loc_idx = shop_idx[loc]
-            problem.param_dict["D"].value[:, loc_idx] = 0
-            problem.param_dict["P"].value[:, loc_idx] = 0
-
-    def _extract_plan(self, shop_rev_idx, com_rev_idx, I, L, S, B):
+        :param rows: the commodities to expand dense matrices over if any
+        :param cols: the shops to expand dense matrices over if any
+        :param available: the mask of the shops that may be visited, defaults to all of them
+        :return: the values of the parameters B, S, D, P and C by name, where B and P are over the supply listings and
+        S and D are over the demand listings unless rows and cols are given, along with the mask A over the shops
+        otherwise
+        """
+        closed = np.zeros(len(self.shops_idx), dtype=bool) if available is None else ~available
+        closed[[self.shops_idx[l] for l in blk_locations]] = True
+        params = {"C": cargo}
+        for listings, price, bound in ((self.supply_listings, "B", "P"), (self.demand_listings, "S", "D")):
+            max_trade = np.full(len(listings), float(max_percent))
+            if max_commodity is not None:
+                for k, percent in max_commodity.items():
+                    com = self.commodities_idx[k]
+                    max_trade[listings.indptr[com]:listings.indptr[com + 1]] = percent
+            if max_com_loc is not None:
+                for k, locs in max_com_loc.items():
+                    for l, amount in locs.items():
+                        try:
+                            max_trade[listings.find(self.commodities_idx[k], self.shops_idx[l])] = amount
+                        except KeyError:
+                            continue
+
+            # the weighted limits L * Ws <= Q and I * Wb <= Q with the inverse stock as weights, taken from the live
+            # stock so that market updates move them, where a listing out of stock cannot be traded at all
+            limit = np.minimum(listings.stock, max_trade * listings.stock)
+            limit[closed[listings.shop]] = 0
+            params[price], params[bound] = listings.price, limit
+            if rows is not None and cols is not None:
+                params[price] = listings.to_dense(params[price])[np.ix_(rows, cols)]
+                params[bound] = listings.to_dense(params[bound])[np.ix_(rows, cols)]
+        if rows is None or cols is None:
+            params["A"] = np.ones(len(self.shops_idx)) if available is None else available.astype(float)
+        return params
+
+    @timed_phase("extraction")
+    def _extract_plan(self, I, L, S, B):
         buy_transactions = []
         sell_transactions = []
 
-        for com, loc in zip(*np.nonzero(I.value)):
-            buy_transactions.append(Transaction(shop_rev_idx[loc],
-                                                com_rev_idx[com],
-                                                I.value[com, loc]))
-        for com, loc in zip(*np.nonzero(L.value)):
-            sell_transactions.append(Transaction(shop_rev_idx[loc],
-                                                 com_rev_idx[com],
-                                                 L.value[com, loc]))
-        revenue = np.sum(np.multiply(L.value, S.value))
-        cost = np.sum(np.multiply(I.value, B.value))
+        supply, demand = self.supply_listings, self.demand_listings
+        for p in np.nonzero(I)[0]:
+            buy_transactions.append(Transaction(self.shops_rev_idx[supply.shop[p]],
+                                                self.commodities_rev_idx[supply.com[p]],
+                                                I[p]))
+        for p in np.nonzero(L)[0]:
+            sell_transactions.append(Transaction(self.shops_rev_idx[demand.shop[p]],
+                                                 self.commodities_rev_idx[demand.com[p]],
+                                                 L[p]))
+        revenue = np.dot(L, S)
+        cost = np.dot(I, B)
         return HighLevelPlan(cost, revenue, buy_transactions, sell_transactions)
 
+    @timed_phase("extraction")
     def _extract_route(self, X, I, L, rev_shop_idx: Dict[int, str], rev_com_idx: Dict[int, str]):
-        cur_idx = np.nonzero(X.value[-2, :])[0][0]
+        # the solvers may leave tiny nonzero values on the unused edges
+        X = np.round(X)
+        cur_idx = np.nonzero(X[-2, :])[0][0]
         final_routes = []
 
         cur_start = "start"
         working_dest = ""
         working_buy = []
         working_sell = []
-        while cur_idx != X.value.shape[0] - 1:
+        while cur_idx != X.shape[0] - 1:
             cur_end = rev_shop_idx[cur_idx]
             new_route = cur_end != working_dest
             if new_route:
@@ -376,118 +1349,370 @@ class TwoStagePlanner(RoutePlanner):
                 working_buy = []
                 working_sell = []
 
-            for com in np.nonzero(I.value[:, cur_idx])[0]:
+            for com in np.nonzero(I[:, cur_idx])[0]:
                 working_buy.append(Transaction(rev_shop_idx[cur_idx],
                                                rev_com_idx[com],
-                                               I.value[com, cur_idx]))
-            for com in np.nonzero(L.value[:, cur_idx])[0]:
+                                               I[com, cur_idx]))
+            for com in np.nonzero(L[:, cur_idx])[0]:
                 working_sell.append(Transaction(rev_shop_idx[cur_idx],
                                                 rev_com_idx[com],
-                                                L.value[com, cur_idx]))
+                                                L[com, cur_idx]))
             if new_route:
                 final_routes.append(RoutePath(cur_start, working_dest, working_buy, working_sell))
             cur_start = cur_end
-            cur_idx = np.nonzero(X.value[cur_idx, :])[0][0]
+            cur_idx = np.nonzero(X[cur_idx, :])[0][0]
         return final_routes
 
+    def _solve_stage_one_scip(self, params: Dict, budget: SolveBudget = None, warm_start: bool = True,
+                              supply_kept: np.ndarray = None, demand_kept: np.ndarray = None,
+                              cols: np.ndarray = None) -> Tuple[float, np.ndarray, np.ndarray, SolveStatus]:
+        """
+        Solves stage one natively with SCIP over the variables I, L, X and Y of _formulate_step_one, restricted to the
+        listings and shops kept by presolve.
+        The shops dropped by presolve could only have been visited without trading to make up the number of stops, so
+        the reduced model visits at most NS stops instead, within the allowed subtrees holding at least NS shops.
+        :param params: the values of the parameters of _formulate_step_one by name
+        :param budget: the limits on the solve
+        :param warm_start: whether to start from the previous solution
+        :param supply_kept: the indices of the supply listings to keep, defaults to all of them
+        :param demand_kept: the indices of the demand listings to keep, defaults to all of them
+        :param cols: the indices of the shops to keep, defaults to all of them
+        :return: a tuple of the profit, I and L over all the listings, or -infinity and None if cannot be solved, and
+        the status of the solve
+        """
+        n_supply, n_demand, M_all = len(self.supply_listings), len(self.demand_listings), len(self.shops_idx)
+        supply_kept = np.arange(n_supply) if supply_kept is None else supply_kept
+        demand_kept = np.arange(n_demand) if demand_kept is None else demand_kept
+        cols = np.arange(M_all) if cols is None else cols
+        n_i, n_l, M = len(supply_kept), len(demand_kept), len(cols)
+        V = self._subtrees.shape[1]
+        T = self._stop_subtrees(params)
+        if not np.any(T):
+            return -np.inf, None, None, SolveStatus(True, None, None)
+        if n_i == 0 or n_l == 0:
+            return 0.0, np.zeros(n_supply), np.zeros(n_demand), SolveStatus(True, 0.0, 0.0)
+
+        objective, A_ub, b_ub, A_eq, b_eq, upper, integer = self._stage_one_model(params, T, supply_kept,
+                                                                                  demand_kept, cols)
+
+        # the previous solution is kept over all the listings and shops, since presolve keeps different ones
+        starts = []
+        previous = self._stage_one_start
+        if warm_start and previous is not None:
+            I_all, L_all, X_all = np.split(previous[:-V], [n_supply, n_supply + n_demand])
+            starts.append(np.concatenate([I_all[supply_kept], L_all[demand_kept], X_all[cols], previous[-V:]]))
+
+        on_solution = None
+        streaming = getattr(_streaming, "callbacks", None)
+        if streaming is not None and streaming[0] is not None:
+            def on_solution(value, solution, bound, gap, seconds):
+                I, L = np.zeros(n_supply), np.zeros(n_demand)
+                I[supply_kept] = solution[:n_i]
+                L[demand_kept] = solution[n_i:n_i + n_l]
+                I[I < EPSILON] = 0
+                L[L < EPSILON] = 0
+                streaming[0](value, bound, gap, seconds, self._extract_plan(I, L, params["S"], params["B"]))
+        profit, x, status = _solve_scip(objective, A_ub, b_ub, A_eq, b_eq, upper, integer, budget, starts,
+                                        on_solution)
+        if x is None:
+            return profit, None, None, status
+
+        I, L, X = np.zeros(n_supply), np.zeros(n_demand), np.zeros(M_all)
+        I[supply_kept] = x[:n_i]
+        L[demand_kept] = x[n_i:n_i + n_l]
+        X[cols] = x[n_i + n_l:n_i + n_l + M]
+        self._stage_one_start = np.concatenate([I, L, X, x[-V:]])
+        return profit, I, L, status
+
+    def _stop_subtrees(self, params: Dict) -> np.ndarray:
+        """
+        Selects the allowed subtrees holding at least NS available shops, which are the ones a plan of NS stops can lie
+        in.
+        :param params: the values of the parameters of _formulate_step_one by name
+        :return: the mask over the subtrees
+        """
+        return params["T"] * (self._subtrees.T @ params["A"] >= params["NS"])
+
+    def _stage_one_model(self, params: Dict, T: np.ndarray, supply_kept: np.ndarray, demand_kept: np.ndarray,
+                         cols: np.ndarray) -> Tuple:
+        """
+        Assembles stage one over the kept listings and shops as sparse matrices, see _solve_stage_one_scip.
+        :param params: the values of the parameters of _formulate_step_one by name
+        :param T: the subtrees the stops may lie in, see _stop_subtrees
+        :param supply_kept: the indices of the supply listings to keep, which may not be empty
+        :param demand_kept: the indices of the demand listings to keep, which may not be empty
+        :param cols: the indices of the shops to keep
+        :return: a tuple of the objective, A_ub, b_ub, A_eq, b_eq, the upper bounds and the integrality of the
+        variables I, L, X and Y, see _solve_scip
+        """
+        supply, demand = self.supply_listings, self.demand_listings
+        n_i, n_l, M = len(supply_kept), len(demand_kept), len(cols)
+        V = self._subtrees.shape[1]
+        C = params["C"]
+
+        # renumbers the kept shops and commodities
+        shop_pos = np.full(len(self.shops_idx), -1)
+        shop_pos[cols] = np.arange(M)
+        coms, com_pos = np.unique(np.concatenate([supply.com[supply_kept], demand.com[demand_kept]]),
+                                  return_inverse=True)
+        per_com_i = sp.csr_matrix((np.ones(n_i), (com_pos[:n_i], np.arange(n_i))), shape=(len(coms), n_i))
+        per_com_l = sp.csr_matrix((np.ones(n_l), (com_pos[n_i:], np.arange(n_l))), shape=(len(coms), n_l))
+        per_shop_i = sp.csr_matrix((np.ones(n_i), (shop_pos[supply.shop[supply_kept]], np.arange(n_i))),
+                                   shape=(M, n_i))
+        per_shop_l = sp.csr_matrix((np.ones(n_l), (shop_pos[demand.shop[demand_kept]], np.arange(n_l))),
+                                   shape=(M, n_l))
+
+        A_ub = sp.bmat([[per_shop_i, None, None, None],  # (6)
+                        [None, per_shop_l, None, None],  # (7)
+                        [per_shop_i, per_shop_l, -10 * C * sp.eye(M), None],  # (8)
+                        [None, None, sp.eye(M), -self._subtrees[cols]],  # (9) and (10)
+                        [None, None, None, np.ones((1, V))],
+                        [None, None, np.ones((1, M)), None],  # (11)
+                        [None, None, params["Z"][:, cols], None]])  # (12)
+        b_ub = np.concatenate([np.full(2 * M, C), np.zeros(2 * M), [1, params["NS"]], params["H"]])
+        A_eq = sp.hstack([per_com_i, -per_com_l, sp.csr_matrix((len(coms), M + V))])  # (1)
+        b_eq = np.zeros(len(coms))
+        objective = np.concatenate([-params["B"][supply_kept], params["S"][demand_kept], np.zeros(M + V)])
+        upper = np.concatenate([params["P"][supply_kept], params["D"][demand_kept], np.ones(M), T])
+        integer = np.concatenate([np.zeros(n_i + n_l, dtype=bool), np.ones(M, dtype=bool), np.zeros(V, dtype=bool)])
+        return objective, A_ub, b_ub, A_eq, b_eq, upper, integer
+
+    def _solve_refinement_scip(self, params: Dict, travel_weight: float,
+                               budget: SolveBudget = None) -> Tuple[float, np.ndarray, np.ndarray, np.ndarray,
+                                                                    SolveStatus]:
+        """
+        Solves the refinement natively with SCIP over the variables X, MCF, F, I and L of _formulate_refinement.
+        :param params: the values of the parameters of _formulate_refinement by name
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :param budget: the limits on the solve
+        :return: a tuple of the profit, X, I and L, or -infinity and None if cannot be solved, and the status of the
+        solve
+        """
+        n_coms, n_locs = params["B"].shape
+        n_nodes = n_locs + 2
+        k_range = list(range(0, n_nodes))
+        k_range.remove(n_locs)
+        n_edges, n_flows, n_trades = n_nodes * n_nodes, len(k_range), n_coms * n_locs
+        C = params["C"]
+
+        out_edges, in_edges = _edge_selectors(n_nodes)
+        trade_out, trade_in = _edge_selectors(n_locs)
+        # maps the edges between locations onto the edges of the route
+        tails, heads = np.meshgrid(np.arange(n_locs), np.arange(n_locs), indexing="ij")
+        trade_edges = sp.csr_matrix((np.ones(n_locs * n_locs),
+                                     ((tails + heads * n_locs).ravel(), (tails + heads * n_nodes).ravel())),
+                                    shape=(n_locs * n_locs, n_edges))
+        to_start = sp.csr_matrix((np.ones(n_nodes), (np.arange(n_nodes), np.arange(n_nodes) + n_locs * n_nodes)),
+                                 shape=(n_nodes, n_edges))
+        conservation = sp.kron(sp.eye(n_flows), in_edges - out_edges + to_start).tocsr()
+        conservation = conservation[[c * n_nodes + j for c, k in enumerate(k_range) for j in k_range if j != k], :]
+
+        # columns are X, MCF, F, I and L
+        A_ub = sp.bmat([[-sp.kron(np.ones((n_flows, 1)), sp.eye(n_edges)), sp.eye(n_edges * n_flows), None, None,
+                         None],  # (4)
+                        [-10 * C * sp.kron(np.ones((n_coms, 1)), trade_edges), None,
+                         sp.eye(n_locs * n_locs * n_coms), None, None],  # (8)
+                        [None, None, sp.kron(np.ones((1, n_coms)), trade_out), sp.csr_matrix((n_locs, n_trades)),
+                         sp.csr_matrix((n_locs, n_trades))]])  # (9)
+        b_ub = np.concatenate([np.zeros(n_edges * n_flows + n_locs * n_locs * n_coms), np.full(n_locs, C)])
+        A_eq = sp.bmat([[out_edges[:-1], None, None, None, None],  # (1)
+                        [in_edges[:-2], None, None, None, None],  # (2)
+                        [in_edges[[-1, -2]], None, None, None, None],  # (3)
+                        [out_edges[[-1, -2]], None, None, None, None],
+                        [None, sp.kron(sp.eye(n_flows), out_edges[n_locs]), None, None, None],  # (5)
+                        [None, sp.block_diag([in_edges[k] for k in k_range]), None, None, None],  # (6)
+                        [None, conservation, None, None, None],  # (7)
+                        [None, None, sp.kron(sp.eye(n_coms), trade_out - trade_in), -sp.eye(n_trades),
+                         sp.eye(n_trades)]])  # (10)
+        b_eq = np.concatenate([np.ones(n_nodes - 1 + n_locs), [1, 0, 0, 1], np.ones(2 * n_flows),
+                               np.zeros(conservation.shape[0] + n_trades)])
+        objective = np.concatenate([-travel_weight * (trade_edges.T @ params["R"].ravel(order="F")),
+                                    np.zeros(n_edges * n_flows + n_locs * n_locs * n_coms),
+                                    -params["B"].ravel(), params["S"].ravel()])
+        upper = np.concatenate([np.ones(n_edges), np.full(n_edges * n_flows + n_locs * n_locs * n_coms, np.inf),
+                                params["P"].ravel(), params["D"].ravel()])
+        integer = np.zeros(len(upper), dtype=bool)
+        integer[:n_edges] = True
+
+        profit, x, status = _solve_scip(objective, A_ub, b_ub, A_eq, b_eq, upper, integer, budget)
+        if x is None:
+            return profit, None, None, None, status
+        trades = x[-2 * n_trades:]
+        return (profit, x[:n_edges].reshape((n_nodes, n_nodes), order="F"),
+                trades[:n_trades].reshape((n_coms, n_locs)), trades[n_trades:].reshape((n_coms, n_locs)), status)
+
+    def _solve_refinement_orders(self, params: Dict, travel_weight: float) -> Tuple[float, np.ndarray, np.ndarray,
+                                                                                  np.ndarray, SolveStatus]:
+        """
+        Solves the refinement exactly by enumerating the orders the stops can be visited in, in place of the MIP.
+        Once the order is fixed, the best trades are an LP over the cargo held after every stop, which may not be
+        negative for any commodity nor exceed C in total, and must be sold off by the last stop. The LPs of all the
+        orders are independent blocks of a single LP, so maximizing their sum maximizes each of them, after which the
+        best order net of the travel penalty is picked.
+        :param params: the values of the parameters of _formulate_refinement by name
+        :param travel_weight: the weight assigned to the travel cost penalty
+        :return: a tuple of the profit, X, I and L, or -infinity and None if cannot be solved, and the status of the
+        solve
+        """
+        start = time.perf_counter()
+        n_coms, n_locs = params["B"].shape
+        # the trades the shops offer, where buying adds to the cargo and selling takes from it
+        buy_c, buy_l = np.nonzero(params["P"] > 0)
+        sell_c, sell_l = np.nonzero(params["D"] > 0)
+        coms, locs = np.concatenate([buy_c, sell_c]), np.concatenate([buy_l, sell_l])
+        sign = np.concatenate([np.ones(len(buy_c)), -np.ones(len(sell_c))])
+        objective = np.concatenate([-params["B"][buy_c, buy_l], params["S"][sell_c, sell_l]])
+        upper = np.concatenate([params["P"][buy_c, buy_l], params["D"][sell_c, sell_l]])
+        n_trades = len(sign)
+
+        orders = _permutations(n_locs)
+        n_orders = len(orders)
+        per_com = (coms[None, :] == np.arange(n_coms)[:, None]) * sign
+        # held[o, c, k, v] is what trade v adds to the cargo of commodity c held after the first k + 1 stops of order o
+        after = np.argsort(orders, axis=1)[:, None, locs] <= np.arange(n_locs - 1)[None, :, None]
+        held = per_com[None, :, None, :] * after[:, None, :, :]
+        blocks = np.concatenate([-held.reshape(n_orders, n_coms * (n_locs - 1), n_trades), held.sum(axis=1)], axis=1)
+        n_rows = blocks.shape[1]
+        o, r, v = np.nonzero(blocks)
+        A_ub = sp.csr_matrix((blocks[o, r, v], (o * n_rows + r, o * n_trades + v)),
+                             shape=(n_orders * n_rows, n_orders * n_trades))
+        b_ub = np.tile(np.concatenate([np.zeros(n_coms * (n_locs - 1)), np.full(n_locs - 1, params["C"])]), n_orders)
+        A_eq = sp.kron(sp.eye(n_orders), sp.csr_matrix(per_com), format="csr")
+
+        x = np.zeros((n_orders, n_trades))
+        if n_trades > 0:
+            with timed("solve"):
+                relaxed = linprog(-np.tile(objective, n_orders), A_ub=A_ub, b_ub=b_ub, A_eq=A_eq,
+                                  b_eq=np.zeros(A_eq.shape[0]), bounds=np.c_[np.zeros(x.size), np.tile(upper, n_orders)])
+            if relaxed.status != 0:
+                status = SolveStatus(False, None, None, time.perf_counter() - start)
+                record_model(x.size, A_ub.shape[0] + A_eq.shape[0], A_ub.nnz + A_eq.nnz, -np.inf, status)
+                return -np.inf, None, None, None, status
+            x = relaxed.x.reshape(n_orders, n_trades)
+        value = x @ objective - travel_weight * params["R"][orders[:, :-1], orders[:, 1:]].sum(axis=1)
+        best = int(np.argmax(value))
+        profit = float(value[best])
+        status = SolveStatus(True, profit, 0.0, time.perf_counter() - start)
+        record_model(x.size, A_ub.shape[0] + A_eq.shape[0], A_ub.nnz + A_eq.nnz, profit, status)
+
+        # node n_locs is the start and node n_locs + 1 is the end, as in _formulate_refinement
+        stops = np.concatenate([[n_locs], orders[best], [n_locs + 1]])
+        X = np.zeros((n_locs + 2, n_locs + 2))
+        X[stops[:-1], stops[1:]] = 1
+        I, L = np.zeros((n_coms, n_locs)), np.zeros((n_coms, n_locs))
+        I[buy_c, buy_l] = x[best, :len(buy_c)]
+        L[sell_c, sell_l] = x[best, len(buy_c):]
+        return profit, X, I, L, status
+
     def _formulate_step_one(self):
+        """
+        Formulates the high level plan over the listings, so that I and L only hold the trades shops offer.
+        :return: the problem
+        """
         C = cp.Parameter(nonneg=True, name="C")
-        ML = cp.Parameter(name="ML", nonneg=True)
         NS = cp.Parameter(name="NS", nonneg=True)
         M = len(self.shops_idx)
-        N = len(self.commodities_idx)
-        Q = cp.Parameter((N, M), nonneg=True, name="Q")
-        Wb = cp.Parameter((N, M), nonneg=True, name="Wb")
-        Ws = cp.Parameter((N, M), nonneg=True, name="Ws")
-
-        B = cp.Parameter((N, M), nonneg=True, name="B")
-        S = cp.Parameter((N, M), nonneg=True, name="S")
-        D = cp.Parameter((N, M), nonneg=True, name="D")
-        P = cp.Parameter((N, M), nonneg=True, name="P")
-        R = cp.Parameter((M, M), nonneg=True, name="R")
-
-        I = cp.Variable((N, M), nonneg=True, name="I")
-        L = cp.Variable((N, M), nonneg=True, name="L")
+        supply, demand = self.supply_listings, self.demand_listings
+
+        B = cp.Parameter(len(supply), nonneg=True, name="B")
+        S = cp.Parameter(len(demand), nonneg=True, name="S")
+        D = cp.Parameter(len(demand), nonneg=True, name="D")
+        P = cp.Parameter(len(supply), nonneg=True, name="P")
+        # stops may be paired exactly when they lie in one allowed subtree, see _subtree_incidence
+        G = self._subtrees
+        T = cp.Parameter(len(self._subtree_level), nonneg=True, name="T")
+        # the stops of plans to differ from, see _no_good_cuts
+        Z = cp.Parameter((MAX_ALTERNATIVES, M), nonneg=True, name="Z")
+        H = cp.Parameter(MAX_ALTERNATIVES, nonneg=True, name="H")
+        # the shops that may be visited, so that the compiled problem serves any filter, see _market_params
+        A = cp.Parameter(M, nonneg=True, name="A")
+
+        I = cp.Variable(len(supply), nonneg=True, name="I")
+        L = cp.Variable(len(demand), nonneg=True, name="L")
         X = cp.Variable(M, boolean=True, name="X")
-        A = cp.Variable((M, M), boolean=True, name="A")
+        Y = cp.Variable(len(self._subtree_level), nonneg=True, name="Y")
+
+        objective = cp.Maximize(S @ L - B @ I)
 
-        objective = cp.Maximize(cp.sum(cp.multiply(L, S)) - cp.sum(cp.multiply(I, B)))
+        bought_per_shop, sold_per_shop = supply.per_shop() @ I, demand.per_shop() @ L
 
         constraints = []
 
         # (1)
         constraints.append(
-            cp.sum(I, axis=1) == cp.sum(L, axis=1)
-        )
-
-        # (2)
-        constraints.append(
-            cp.multiply(L, Ws) <= Q
+            supply.per_com() @ I == demand.per_com() @ L
         )
 
-        # (3)
-        constraints.append(
-            cp.multiply(I, Wb) <= Q
-        )
-
-        # (4)
+        # (2), (3), (4) and (5) are bound by P and D, see _market_params
         constraints.append(I <= P)
-
-        # (5)
         constraints.append(L <= D)
 
         # (6)
         constraints.append(
-            cp.sum(I, axis=0) <= C
+            bought_per_shop <= C
         )
 
         # (7)
         constraints.append(
-            cp.sum(L, axis=0) <= C
+            sold_per_shop <= C
         )
 
         # (8)
         constraints.append(
-            cp.sum(L, axis=0) + cp.sum(I, axis=0) <= 10 * C * X
+            sold_per_shop + bought_per_shop <= 10 * C * X
         )
 
-        # (9)
-        for i in range(M):
-            for j in range(i + 1, M):
-                constraints.append((1 - A[i, j]) <= (1 - X[i]) + (1 - X[j]))
+        # (9) and (10), every stop belongs to the single subtree picked by Y
+        constraints.append(X <= G @ Y)
+        constraints.append(Y <= T)
+        constraints.append(cp.sum(Y) <= 1)
+        constraints.append(X <= A)
 
-        # (10)
+        # (11)
         constraints.append(
-            cp.multiply(A, R) <= ML
+            cp.sum(X) == NS
         )
 
-        # (11)
+        # (12)
         constraints.append(
-            cp.sum(X) == NS
+            Z @ X <= H
         )
 
         return cp.Problem(objective, constraints)
 
     def _formulate_refinement(self, n_locs, n_coms, lambda_weight=0.001):
+        """
+        Formulates the routing problem over the locations of a plan.
+        Node n_locs is the start and node n_locs + 1 is the end of the route. The per commodity flows of the
+        connectivity constraints and of the goods are stacked column-wise over the edges of the route, with edge
+        (i, j) at row i + j * nodes to match the column-major order of cp.vec.
+        :param n_locs: the number of locations
+        :param n_coms: the number of commodities
+        :param lambda_weight: the weight assigned to the travel cost penalty
+        :return: the problem
+        """
         B = cp.Parameter((n_coms, n_locs), nonneg=True, name="B")
         S = cp.Parameter((n_coms, n_locs), nonneg=True, name="S")
         D = cp.Parameter((n_coms, n_locs), nonneg=True, name="D")
         P = cp.Parameter((n_coms, n_locs), nonneg=True, name="P")
         R = cp.Parameter((n_locs, n_locs), nonneg=True, name="R")
-        Q = cp.Parameter((n_coms, n_locs), nonneg=True, name="Q")
-        Wb = cp.Parameter((n_coms, n_locs), nonneg=True, name="Wb")
-        Ws = cp.Parameter((n_coms, n_locs), nonneg=True, name="Ws")
         C = cp.Parameter(nonneg=True, name="C")
 
-        MCF = [cp.Variable((n_locs + 2, n_locs + 2), nonneg=True) for _ in
-               range(n_locs + 2)]
-        F = [cp.Variable((n_locs, n_locs), nonneg=True) for _ in range(n_coms)]
-        X = cp.Variable((n_locs + 2, n_locs + 2), boolean=True, name="X")
+        n_nodes = n_locs + 2
+        k_range = list(range(0, n_nodes))
+        k_range.remove(n_locs)
+
+        MCF = cp.Variable((n_nodes * n_nodes, len(k_range)), nonneg=True, name="MCF")
+        F = cp.Variable((n_locs * n_locs, n_coms), nonneg=True, name="F")
+        X = cp.Variable((n_nodes, n_nodes), boolean=True, name="X")
         I = cp.Variable((n_coms, n_locs), nonneg=True, name="I")
         L = cp.Variable((n_coms, n_locs), nonneg=True, name="L")
 
-        objective = cp.Maximize(
-            cp.sum(cp.multiply(L, S)) - cp.sum(cp.multiply(I, B)) - lambda_weight * cp.sum(cp.multiply(X[:-2, :-2], R)))
+        route = cp.vec(X, order="F")
+        trade_route = cp.vec(X[:-2, :-2], order="F")
+        objective = cp.Maximize(cp.vec(S, order="F") @ cp.vec(L, order="F") -
+                                cp.vec(B, order="F") @ cp.vec(I, order="F") -
+                                lambda_weight * cp.vec(R, order="F") @ trade_route)
 
         constraints = []
 
@@ -507,161 +1732,1577 @@ class TwoStagePlanner(RoutePlanner):
         constraints.append(cp.sum(X[-2, :]) == 1)
         constraints.append(cp.sum(X[:, -2]) == 0)
 
-        k_range = list(range(0, n_locs + 2))
-        k_range.remove(n_locs)
+        out_edges, in_edges = _edge_selectors(n_nodes)
+        outflow = out_edges @ MCF
+        inflow = in_edges @ MCF
 
         # (4)
-        for flow in MCF:
-            constraints.append(X >= flow)
+        constraints.append(
+            cp.reshape(route, (n_nodes * n_nodes, 1), order="F") @ np.ones((1, len(k_range))) >= MCF
+        )
 
         # (5)
-        for k in k_range:
-            constraints.append(
-                cp.sum(MCF[k][n_locs, :]) == 1
-            )
+        constraints.append(
+            outflow[n_locs, :] == 1
+        )
 
         # (6)
-        for k in k_range:
-            constraints.append(
-                cp.sum(MCF[k][:, k]) == 1
-            )
+        constraints.append(
+            inflow[k_range, range(len(k_range))] == 1
+        )
 
         # (7)
-        for k in k_range:
-            j_range = list(range(0, n_locs))
-            j_range.append(n_locs + 1)
-            j_range.remove(k)
-            for j in j_range:
-                constraints.append(
-                    cp.sum(MCF[k][:, j]) ==
-                    cp.sum(MCF[k][j, :]) - MCF[k][j, n_locs]
-                )
+        nodes, flows = zip(*[(j, c) for c, k in enumerate(k_range) for j in k_range if j != k])
+        to_start = MCF[[j + n_locs * n_nodes for j in range(n_nodes)], :]
+        constraints.append(
+            (inflow - outflow + to_start)[nodes, flows] == 0
+        )
 
         # (8)
-        for flow in F:
-            constraints.append(10 * C * X[:-2, :-2] >= flow)
+        constraints.append(
+            10 * C * cp.reshape(trade_route, (n_locs * n_locs, 1), order="F") @ np.ones((1, n_coms)) >= F
+        )
+
+        out_edges, in_edges = _edge_selectors(n_locs)
 
         # (9)
-        agg_flow = sum(F)
         constraints.append(
-            cp.sum(agg_flow, axis=1) <= C
+            cp.sum(out_edges @ F, axis=1) <= C
         )
 
         # (10)
-        for g, flow in enumerate(F):
-            for j in range(n_locs):
-                constraints.append(
-                    cp.sum(flow[j, :]) - cp.sum(flow[:, j]) == I[g, j] - L[g, j]
-                )
+        constraints.append(
+            out_edges @ F - in_edges @ F == (I - L).T
+        )
 
-        # (11)
+        # (11) and (14) are bound by P, see _market_params
         constraints.append(I <= P)
-        # (12)
+        # (12) and (13) are bound by D
         constraints.append(L <= D)
-        # (13)
-        constraints.append(
-            cp.multiply(L, Ws) <= Q
-        )
-        # (14)
-        constraints.append(
-            cp.multiply(I, Wb) <= Q
-        )
 
         return cp.Problem(objective, constraints)
 
 
-shops = []
-with open("shops.json", "r") as fp:
-    temp = json.load(fp)
-    for t in temp:
-        path = t[0]
-        buy_temp = t[1]
-        sell_temp = t[2]
-        buys = [Commodity(*b) for b in buy_temp]
-        sells = [Commodity(*s) for s in sell_temp]
+def _merge_status(statuses: List[SolveStatus]) -> SolveStatus:
+    """
+    Merges the status of several solves into one, which is optimal only if every solve is.
+    :param statuses: the status of every solve
+    :return: the merged status, reporting the largest gap, the total time and the first solution of the first solve
+    """
+    if not statuses:
+        return SolveStatus(True, 0.0, 0.0)
+    if len(statuses) == 1:
+        return statuses[0]
+    gaps = [s.gap for s in statuses]
+    times = [s.time for s in statuses]
+    return SolveStatus(all(s.optimal for s in statuses), statuses[0].bound, None if None in gaps else max(gaps),
+                       None if None in times else sum(times), statuses[0].first_time)
+
+
+_streaming = threading.local()
+
+
+@contextmanager
+def stream_incumbents(report, cancelled):
+    """
+    Reports the incumbents of the stage one solves of the current thread within the context as SCIP finds them, and
+    interrupts every SCIP solve once cancelled, which then returns the best solution found so far.
+    :param report: called with the profit, the bound, the gap, the seconds spent and the high level plan of every
+    improved incumbent, where the bound and the gap are None while unknown, or None to only follow the cancellation
+    :param cancelled: returns whether the solves should stop, polled at most every CANCEL_POLL_INTERVAL seconds
+    """
+    previous = getattr(_streaming, "callbacks", None)
+    _streaming.callbacks = report, cancelled
+    try:
+        yield
+    finally:
+        _streaming.callbacks = previous
+
+
+def solve_cancelled() -> bool:
+    """
+    :return: whether the solves of the current thread were cancelled, see stream_incumbents
+    """
+    streaming = getattr(_streaming, "callbacks", None)
+    return streaming is not None and streaming[1]()
+
+
+class _IncumbentHandler(scip.Eventhdlr):
+    EVENTS = scip.SCIP_EVENTTYPE.BESTSOLFOUND | scip.SCIP_EVENTTYPE.NODESOLVED
+
+    def __init__(self, x: np.ndarray, on_solution=None, cancelled=None):
+        """
+        Follows a solve of _solve_scip, passing every improved incumbent on and interrupting the solve once cancelled.
+        :param x: the variables of the model, None where left out
+        :param on_solution: called with the value, the solution, the bound, the gap and the seconds spent of every
+        improved incumbent
+        :param cancelled: returns whether to interrupt the solve
+        """
+        self.x = x
+        self.on_solution = on_solution
+        self.cancelled = cancelled
+        self._polled = time.monotonic()
+
+    def eventinit(self):
+        self.model.catchEvent(self.EVENTS, self)
+
+    def eventexit(self):
+        self.model.dropEvent(self.EVENTS, self)
+
+    def eventexec(self, event):
+        if self.on_solution is not None and event.getType() == scip.SCIP_EVENTTYPE.BESTSOLFOUND:
+            sol = self.model.getBestSol()
+            value = self.model.getSolObjVal(sol)
+            solution = np.array([0.0 if v is None else self.model.getSolVal(sol, v) for v in self.x])
+            # the gap SCIP reports still refers to the previous incumbent, so it is recomputed as SCIP defines it
+            bound, _ = _scip_bound(self.model)
+            gap = None
+            if bound is not None and min(abs(bound), abs(value)) > 0:
+                gap = abs(bound - value) / min(abs(bound), abs(value))
+            self.on_solution(value, solution, bound, gap, self.model.getSolvingTime())
+        # the cancellation may live in another process, so it is only polled now and then
+        if self.cancelled is not None and time.monotonic() - self._polled >= CANCEL_POLL_INTERVAL:
+            self._polled = time.monotonic()
+            if self.cancelled():
+                self.model.interruptSolve()
+
+
+def _scip_limits(budget: SolveBudget) -> Dict[str, float]:
+    """
+    Translates a budget into SCIP parameters.
+    :param budget: the limits on a solve
+    :return: the SCIP parameters by name
+    """
+    limits = {}
+    if budget.time_limit is not None:
+        limits["limits/time"] = max(float(budget.time_limit), 0.0)
+    if budget.mip_gap is not None:
+        limits["limits/gap"] = float(budget.mip_gap)
+    if budget.node_limit is not None:
+        limits["limits/nodes"] = int(budget.node_limit)
+    return limits
+
+
+def _solve_scip(objective: np.ndarray, A_ub: sp.spmatrix, b_ub: np.ndarray, A_eq: sp.spmatrix, b_eq: np.ndarray,
+                upper: np.ndarray, integer: np.ndarray, budget: SolveBudget = None,
+                starts: List[np.ndarray] = (), on_solution=None) -> Tuple[float, np.ndarray, SolveStatus]:
+    """
+    Maximizes objective @ x subject to A_ub @ x <= b_ub, A_eq @ x == b_eq and 0 <= x <= upper natively with SCIP.
+    Continuous variables fixed to zero by their bounds are left out of the model. Once a limit of the budget is
+    reached, the best solution found so far is returned.
+    Every start is clipped into the bounds and handed to SCIP as a partial solution, once whole and once restricted to
+    its integral values, so that SCIP completes the continuous values when the start is no longer feasible.
+    :param objective: the objective coefficients
+    :param A_ub: the inequality constraint matrix
+    :param b_ub: the inequality right hand side
+    :param A_eq: the equality constraint matrix
+    :param b_eq: the equality right hand side
+    :param upper: the upper bounds of the variables
+    :param integer: whether each variable is integral
+    :param budget: the limits on the solve
+    :param starts: the solutions to start from, nan where unknown
+    :param on_solution: called with every improved incumbent while the solve runs, see _IncumbentHandler
+    :return: a tuple of the value and the solution, or -infinity and None if cannot be solved, and the status of the
+    solve
+    """
+    building = time.perf_counter()
+    model = scip.Model()
+    model.hideOutput()
+    if budget is not None:
+        for name, value in _scip_limits(budget).items():
+            model.setParam(name, value)
+    keep = integer | (upper > 0)
+    x = np.full(len(objective), None, dtype=object)
+    for j in np.nonzero(keep)[0]:
+        vtype = "C"
+        if integer[j]:
+            vtype = "B" if upper[j] == 1 else "I"
+        x[j] = model.addVar(lb=0, ub=None if np.isinf(upper[j]) else upper[j], vtype=vtype, obj=objective[j])
+    model.setMaximize()
+
+    nonzeros = 0
+    for A, b, is_eq in ((A_ub.tocsr(), b_ub, False), (A_eq.tocsr(), b_eq, True)):
+        A.sum_duplicates()
+        for r in range(A.shape[0]):
+            cols = A.indices[A.indptr[r]:A.indptr[r + 1]]
+            coefs = A.data[A.indptr[r]:A.indptr[r + 1]]
+            used = keep[cols] & (coefs != 0)
+            if not np.any(used):
+                if (is_eq and b[r] != 0) or b[r] < 0:
+                    record_model(model.getNVars(False), model.getNConss(False), nonzeros, -np.inf,
+                                 SolveStatus(True, None, None))
+                    return -np.inf, None, SolveStatus(True, None, None)
+                continue
+            nonzeros += int(np.count_nonzero(used))
+            expr = scip.quicksum(c * v for c, v in zip(coefs[used], x[cols[used]]))
+            model.addCons(expr == b[r] if is_eq else expr <= b[r])
+
+    for start in starts:
+        start = np.clip(start, 0, upper)
+        start[integer] = np.round(start[integer])
+        for subset in (keep, keep & integer):
+            sol = model.createPartialSol()
+            for j in np.nonzero(subset & ~np.isnan(start))[0]:
+                model.setSolVal(sol, x[j], start[j])
+            model.addSol(sol)
+
+    streaming = getattr(_streaming, "callbacks", None)
+    if on_solution is not None or streaming is not None:
+        model.includeEventhdlr(_IncumbentHandler(x, on_solution, streaming and streaming[1]), "incumbents",
+                               "reports the incumbents and interrupts cancelled solves")
+
+    # building the model is the native counterpart of canonicalization
+    add_time("canonicalization", time.perf_counter() - building)
+    with timed("solve"):
+        model.optimize()
+    result = _scip_result(model, x)
+    record_model(model.getNVars(False), model.getNConss(False), nonzeros, result[0], result[2])
+    return result
+
+
+def _scip_result(model: scip.Model, x: np.ndarray) -> Tuple[float, np.ndarray, SolveStatus]:
+    status = model.getStatus()
+    if model.getNSols() == 0:
+        return -np.inf, None, SolveStatus(status in ("infeasible", "inforunbd"), None, None, model.getSolvingTime())
+    solution = np.array([0.0 if v is None else model.getVal(v) for v in x])
+    times = (model.getSolvingTime(), min(model.getSolTime(sol) for sol in model.getSols()))
+    if status == "optimal":
+        return model.getObjVal(), solution, SolveStatus(True, model.getObjVal(), 0.0, *times)
+    return model.getObjVal(), solution, SolveStatus(False, *_scip_bound(model), *times)
+
+
+def _scip_bound(model: scip.Model) -> Tuple[float, float]:
+    """
+    :return: a tuple of the dual bound and the gap of the solve, either None while SCIP reports its infinity
+    """
+    bound, gap = model.getDualbound(), model.getGap()
+    if model.isInfinity(abs(bound)):
+        return None, None
+    return bound, None if model.isInfinity(gap) else gap
+
+
+def _simulate_route(order: List[int], buys: Dict[int, List[Tuple]], sells: Dict[int, List[Tuple]],
+                    cargo: float) -> Tuple[float, List[Tuple[List, List]]]:
+    """
+    Carries out the trades of a plan along a route, selling what is held before buying what fits into the cargo.
+    A second pass only buys what the first pass managed to sell, so no goods are left over at the end.
+    :param order: the stops in the order they are visited
+    :param buys: the commodity, amount and price of the planned purchases at every stop
+    :param sells: the commodity, amount and price of the planned sales at every stop
+    :param cargo: the available cargo space
+    :return: a tuple of the profit and the commodities and amounts bought and sold at every stop
+    """
+    wanted = None
+    for _ in range(2):
+        held, bought_total, sold_total = defaultdict(float), defaultdict(float), defaultdict(float)
+        load, profit, trades = 0.0, 0.0, []
+        for stop in order:
+            sold = []
+            for com, amount, price in sells.get(stop, ()):
+                amount = min(amount, held[com])
+                if amount > EPSILON:
+                    held[com] -= amount
+                    load -= amount
+                    sold_total[com] += amount
+                    profit += amount * price
+                    sold.append((com, amount))
+            bought = []
+            for com, amount, price in buys.get(stop, ()):
+                if wanted is not None:
+                    amount = min(amount, wanted[com] - bought_total[com])
+                amount = min(amount, cargo - load)
+                if amount > EPSILON:
+                    held[com] += amount
+                    load += amount
+                    bought_total[com] += amount
+                    profit -= amount * price
+                    bought.append((com, amount))
+            trades.append((bought, sold))
+        wanted = sold_total
+    return profit, trades
+
+
+def _implied_route(plan: HighLevelPlan, shop_idx: Dict[str, int], com_idx: Dict[str, int]) -> Tuple[np.ndarray,
+                                                                                                    np.ndarray,
+                                                                                                    np.ndarray]:
+    """
+    Builds the route implied by a plan, visiting the locations by how much more cargo is bought than sold there, so
+    that goods are picked up before they are delivered.
+    :param plan: the HighLevelPlan
+    :param shop_idx: the shop index of the refinement
+    :param com_idx: the commodity index of the refinement
+    :return: a tuple of the X, I and L matrices of the refinement
+    """
+    n_locs = len(shop_idx)
+    I = np.zeros((len(com_idx), n_locs))
+    L = np.zeros((len(com_idx), n_locs))
+    for t in plan.buy:
+        I[com_idx[t.com], shop_idx[t.loc]] += t.amount
+    for t in plan.sell:
+        L[com_idx[t.com], shop_idx[t.loc]] += t.amount
+    order = np.argsort(L.sum(axis=0) - I.sum(axis=0), kind="stable")
+    stops = np.concatenate([[n_locs], order, [n_locs + 1]])
+    X = np.zeros((n_locs + 2, n_locs + 2))
+    X[stops[:-1], stops[1:]] = 1
+    return X, I, L
+
+
+@lru_cache(maxsize=16)
+def _permutations(n: int) -> np.ndarray:
+    """
+    :param n: the number of items
+    :return: the orders x n matrix of every order of n items, read-only
+    """
+    orders = np.array(list(permutations(range(n))), dtype=np.int64).reshape(-1, n)
+    orders.setflags(write=False)
+    return orders
+
+
+def _edge_selectors(n_nodes: int) -> Tuple[sp.csr_matrix, sp.csr_matrix]:
+    """
+    Builds the matrices summing flows over the outgoing and the incoming edges of every node.
+    :param n_nodes: the number of nodes
+    :return: a tuple of the nodes x edges matrices for the outgoing and the incoming edges, where edge (i, j) is at
+    column i + j * n_nodes
+    """
+    tails, heads = np.meshgrid(np.arange(n_nodes), np.arange(n_nodes), indexing="ij")
+    edges = (tails + heads * n_nodes).ravel()
+    ones = np.ones(len(edges))
+    shape = (n_nodes, n_nodes * n_nodes)
+    return (sp.csr_matrix((ones, (tails.ravel(), edges)), shape=shape),
+            sp.csr_matrix((ones, (heads.ravel(), edges)), shape=shape))
+
+# the operators of parsed patterns repeating and wrapping a subpattern, where possessive and atomic ones are recent
+_REPEATS = tuple(getattr(sre_parse, op) for op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+                 if hasattr(sre_parse, op))
+_LOOKAROUNDS = tuple(getattr(sre_parse, op) for op in ("ASSERT", "ASSERT_NOT", "ATOMIC_GROUP") if hasattr(sre_parse, op))
+
+
+def _first_chars(items, fold: bool) -> Tuple[set, bool]:
+    """
+    :param items: the items of a parsed pattern
+    :param fold: whether the pattern ignores case
+    :return: a tuple of the code points a match of the items can start with, None if that can be about any, and of
+    whether the items can match the empty string
+    """
+    chars = set()
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            members = [av]
+        elif op == sre_parse.IN:
+            members = []
+            for member_op, member in av:
+                if member_op == sre_parse.LITERAL:
+                    members.append(member)
+                elif member_op == sre_parse.RANGE and member[1] - member[0] < 256:
+                    members.extend(range(member[0], member[1] + 1))
+                else:
+                    return None, False
+        elif op in _REPEATS or op == sre_parse.SUBPATTERN or op == sre_parse.BRANCH:
+            if op == sre_parse.BRANCH:
+                options = [_first_chars(branch, fold) for branch in av[1]]
+            elif op == sre_parse.SUBPATTERN:
+                options = [_first_chars(av[3], fold or bool(av[1] & sre_parse.SRE_FLAG_IGNORECASE))]
+            else:
+                options = [_first_chars(av[2], fold)]
+            if any(first is None for first, _ in options):
+                return None, False
+            for first, _ in options:
+                chars |= first
+            if not (any(nullable for _, nullable in options) or op in _REPEATS and av[0] == 0):
+                return chars, False
+            continue
+        elif op == sre_parse.AT or op in _LOOKAROUNDS:
+            # assertions match no characters
+            continue
+        else:
+            return None, False
+        chars |= {ord(chr(c).lower()) for c in members} if fold else set(members)
+        return chars, False
+    return chars, True
+
+
+@lru_cache(maxsize=256)
+def compile_filter(regex: str) -> re.Pattern:
+    """
+    Compiles a location filter, refusing the patterns that can backtrack catastrophically. Those are the ones
+    repeating a repetition, repeating a choice between alternatives that can start with the same character, referring
+    back to a group or backtracking over more than MAX_FILTER_BACKTRACKING points, which are repetitions and
+    ambiguous choices outside of repetitions.
+    :param regex: the pattern
+    :return: the compiled pattern
+    """
+    if len(regex) > MAX_FILTER_LENGTH:
+        raise re.error("filter is longer than %d characters" % MAX_FILTER_LENGTH)
+    parsed = sre_parse.parse(regex)
+    points = [0]
+
+    def choose(options, repeated, fold):
+        # the options are the items a match goes on with after every alternative, where those that can match the
+        # empty string could go on with anything after the subpattern
+        firsts = []
+        for option in options:
+            first, nullable = _first_chars(option, fold)
+            firsts.append(None if nullable else first)
+        if any(a is None or b is None or a & b for k, a in enumerate(firsts) for b in firsts[k + 1:]):
+            if repeated:
+                raise re.error("filter repeats overlapping alternatives")
+            points[0] += len(options) - 1
+
+    def check(items, repeated, fold, last=False):
+        for k, (op, av) in enumerate(items):
+            rest = list(items[k + 1:])
+            if op in _REPEATS:
+                if av[1] > 1 and repeated:
+                    raise re.error("filter repeats a repetition")
+                if av[1] > 1:
+                    # a repetition ending the pattern takes what is left and never backtracks
+                    ends = last and all(o == sre_parse.AT for o, _ in rest)
+                    points[0] += not ends
+                elif av[0] == 0:
+                    choose([list(av[2]) + rest, rest], repeated, fold)
+                check(av[2], repeated or av[1] > 1, fold)
+            elif op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+                raise re.error("filter refers back to a group")
+            elif op == sre_parse.SUBPATTERN:
+                check(av[3], repeated, fold or bool(av[1] & sre_parse.SRE_FLAG_IGNORECASE))
+            elif op == sre_parse.BRANCH:
+                choose([list(branch) + rest for branch in av[1]], repeated, fold)
+                for branch in av[1]:
+                    check(branch, repeated, fold)
+            elif op in _LOOKAROUNDS:
+                check(av[-1], repeated, fold)
+
+    check(parsed, False, bool(parsed.state.flags & sre_parse.SRE_FLAG_IGNORECASE), True)
+    if points[0] > MAX_FILTER_BACKTRACKING:
+        raise re.error("filter backtracks over more than %d points" % MAX_FILTER_BACKTRACKING)
+    return re.compile(regex)
+
+
+def _literal_filter(regex: str) -> Tuple[bool, str]:
+    """
+    Recognizes the filters that match a plain string.
+    :param regex: the pattern, which compile_filter accepted
+    :return: a tuple of whether the string is anchored to the start of the path and the string, which is None if the
+    filter is not a plain string
+    """
+    parsed = sre_parse.parse(regex)
+    items = list(parsed)
+    anchored = len(items) > 0 and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING)
+    if anchored:
+        items = items[1:]
+    # inline flags such as (?i) change what the literals match, and every pattern of a str is flagged as unicode
+    if parsed.state.flags & ~sre_parse.SRE_FLAG_UNICODE or any(op != sre_parse.LITERAL for op, _ in items):
+        return anchored, None
+    return anchored, "".join(chr(av) for _, av in items)
+
+
+class LocationIndex:
+
+    def __init__(self, shops: Iterable[Shop], max_results: int = 256):
+        """
+        A trie over the ">" separated segments of the paths of the shops. Every node holds a bitset of the shops under
+        it and a bitset of the commodities they trade, so filters on prefixes and on segment names are answered from
+        the nodes, and the results of every filter are cached.
+        :param shops: the shops
+        :param max_results: the number of filter results to keep
+        """
+        self.paths = [s.path for s in shops]
+        self.commodities = []
+        com_idx = {}
+        self.all = (1 << len(self.paths)) - 1
+        self.max_results = max_results
+
+        # node 0 is the root, and every label lists the nodes named by it
+        self._children = [{}]
+        self._shops = [0]
+        self._coms = [0]
+        self._labels = {}
+        self._shop_coms = []
+        for i, s in enumerate(shops):
+            coms = 0
+            for c in s.buys + s.sells:
+                coms |= 1 << com_idx.setdefault(c.name, len(com_idx))
+            self._shop_coms.append(coms)
+            node = 0
+            self._shops[node] |= 1 << i
+            self._coms[node] |= coms
+            for name in s.path.split(">"):
+                name = name.strip()
+                if name not in self._children[node]:
+                    self._children[node][name] = len(self._children)
+                    self._labels.setdefault(name, []).append(len(self._children))
+                    self._children.append({})
+                    self._shops.append(0)
+                    self._coms.append(0)
+                node = self._children[node][name]
+                self._shops[node] |= 1 << i
+                self._coms[node] |= coms
+        self.commodities = list(com_idx)
+
+        self._sorted = sorted(range(len(self.paths)), key=lambda i: self.paths[i])
+        self._sorted_paths = [self.paths[i] for i in self._sorted]
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def subtree(self, segments: Iterable[str]) -> Tuple[int, int]:
+        """
+        :param segments: the segments of a path prefix, such as ["Stanton", "Crusader"]
+        :return: a tuple of the bitsets of the shops under the prefix and of the commodities they trade, both empty if
+        no shop is under it
+        """
+        node = 0
+        for name in segments:
+            node = self._children[node].get(name.strip())
+            if node is None:
+                return 0, 0
+        return self._shops[node], self._coms[node]
+
+    def match(self, regex: str) -> Tuple[int, int]:
+        """
+        Finds the shops whose path a filter searches successfully, see compile_filter.
+        :param regex: the pattern
+        :return: a tuple of the bitsets of the shops and of the commodities they trade
+        """
+        with self._lock:
+            if regex in self._results:
+                self._results.move_to_end(regex)
+                return self._results[regex]
+
+        result = self._match(regex)
+        with self._lock:
+            self._results[regex] = result
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return result
+
+    def query(self, regex: str = ".*", prefix: str = None) -> Tuple[int, int]:
+        """
+        Finds the shops a filter matches under a path prefix.
+        :param regex: the pattern, see match
+        :param prefix: the ">" separated segments of the prefix, such as "Stanton > Crusader", if any
+        :return: a tuple of the bitsets of the shops and of the commodities they trade
+        """
+        shops, coms = self.match(regex)
+        if prefix is None:
+            return shops, coms
+        under, under_coms = self.subtree(prefix.split(">"))
+        if shops == self.all:
+            return under, under_coms
+        return self._with_coms(shops & under)
+
+    def _match(self, regex: str) -> Tuple[int, int]:
+        pattern = compile_filter(regex)
+        if regex in ("", ".*"):
+            return self.all, self._coms[0]
+
+        anchored, literal = _literal_filter(regex)
+        if literal is not None and anchored:
+            # the paths starting with a string are a range of the sorted paths
+            start = bisect.bisect_left(self._sorted_paths, literal)
+            end = bisect.bisect_left(self._sorted_paths, literal + chr(0x10FFFF))
+            return self._with_coms(sum(1 << self._sorted[k] for k in range(start, end)))
+        if literal is not None and ">" not in literal and literal == literal.strip():
+            # a string without separators or surrounding spaces can only be found within the name of a segment
+            shops, coms = 0, 0
+            for name, nodes in self._labels.items():
+                if literal in name:
+                    for node in nodes:
+                        shops |= self._shops[node]
+                        coms |= self._coms[node]
+            return shops, coms
+
+        deadline = time.monotonic() + FILTER_TIME_LIMIT
+        shops = 0
+        for i, path in enumerate(self.paths):
+            if pattern.search(path):
+                shops |= 1 << i
+            if time.monotonic() > deadline:
+                raise re.error("filter took longer than %.2f seconds" % FILTER_TIME_LIMIT)
+        return self._with_coms(shops)
+
+    def _with_coms(self, shops: int) -> Tuple[int, int]:
+        coms = 0
+        for i in self.indices(shops):
+            coms |= self._shop_coms[i]
+        return shops, coms
+
+    @staticmethod
+    def indices(bits: int) -> List[int]:
+        """
+        :param bits: a bitset
+        :return: the positions of the set bits in increasing order
+        """
+        result = []
+        while bits:
+            low = bits & -bits
+            result.append(low.bit_length() - 1)
+            bits ^= low
+        return result
+
+
+# an immutable view of the shops, their indices by location and commodity into the goods shops sell and buy, their
+# LocationIndex and a RoutePlanner holding their listings as arrays, along with the version, the file and the digest of the data it was loaded from,
+# and the ColumnarMarket the planners wrap when it was loaded from one, None otherwise
+MarketSnapshot = namedtuple("MarketSnapshot", ["version", "path", "digest", "mtime", "shops", "buy_index",
+                                               "sell_index", "locations", "planner", "market"])
+SHOPS_PATH = os.environ.get("SHOPS_PATH", "shops.json")
+
+
+def load_snapshot(path: str, version: int = 0) -> MarketSnapshot:
+    """
+    Loads the shops from a file into a new snapshot.
+    :param path: the path of the shops file, either a JSON file or the directory of a ColumnarMarket, which is
+    memory-mapped instead of parsed
+    :param version: the data version of the snapshot
+    :return: the snapshot
+    """
+    mtime = snapshot_mtime(path)
+    market = None
+    if os.path.isdir(path):
+        market = ColumnarMarket.load(path)
+        shops, digest = market.to_shops(), market.digest
+    else:
+        with open(path, "rb") as fp:
+            raw = fp.read()
+        shops = tuple(Shop(t[0], tuple(Commodity(*b) for b in t[1]), tuple(Commodity(*sl) for sl in t[2]))
+                      for t in json.loads(raw))
+        digest = hashlib.sha1(raw).hexdigest()
+
+    buy_index = {}
+    sell_index = {}
+    for i, s in enumerate(shops):
+        buy_index[s.path] = {}
+        for j, c in enumerate(s.sells):
+            buy_index[s.path].setdefault(c.name, (i, j))
+        sell_index[s.path] = {}
+        for j, c in enumerate(s.buys):
+            sell_index[s.path].setdefault(c.name, (i, j))
+    # the planners over a memory-mapped market share its pages rather than holding their own listings
+    return MarketSnapshot(version, path, digest, mtime, shops, buy_index, sell_index, LocationIndex(shops),
+                          RoutePlanner(shops if market is None else market), market)
+
+
+def snapshot_mtime(path: str) -> float:
+    """
+    :param path: the path of the shops file, or the directory of a ColumnarMarket
+    :return: the modification time of the file, or of the manifest of the market, which is written last
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, ColumnarMarket.MANIFEST)
+    return os.stat(path).st_mtime
+
+
+def convert_shops(source: str, target: str) -> ColumnarMarket:
+    """
+    Converts a shops file in the JSON layout into a ColumnarMarket.
+    :param source: the path of the JSON file
+    :param target: the directory to save the market to
+    :return: the market
+    """
+    loaded = load_snapshot(source)
+    market = ColumnarMarket.from_shops(loaded.shops, loaded.digest)
+    market.save(target)
+    return market
+
+
+# the snapshot requests start from, which is only ever replaced as a whole so that requests holding an older one
+# finish against it, and the old one is reclaimed once the last of them drops it
+snapshot = load_snapshot(SHOPS_PATH)
+# bumped whenever the supply or demand of a planner changes so that results over stale markets are not reused
+market_version = 0
+# a random tag of this process, as the market version starts over on a restart while the ETags issued before it live on
+PROCESS_NONCE = uuid.uuid4().hex
+
 
-        shops.append(Shop(path, buys, sells))
+# the latest value of every live market update since the shops were loaded, keyed by kind, good and location, which
+# worker processes replay to catch up with the server
+market_updates = OrderedDict()
+_market_version_lock = threading.RLock()
+
+
+def current_snapshot() -> MarketSnapshot:
+    return snapshot
+
+
+def current_state() -> Tuple[MarketSnapshot, int]:
+    """
+    :return: the snapshot along with the market version it is at
+    """
+    with _market_version_lock:
+        return snapshot, market_version
 
-shop_buy_index = {}
-for i, s in enumerate(shops):
-    shop_buy_index[s.path] = {}
 
-    for j, c in enumerate(s.sells):
-        if c.name not in shop_buy_index[s.path]:
-            shop_buy_index[s.path][c.name] = (i, j)
+def bump_market_version():
+    global market_version
+    with _market_version_lock:
+        market_version = market_version + 1
 
-shop_sell_index = {}
-for i, s in enumerate(shops):
-    shop_sell_index[s.path] = {}
 
-    for j, c in enumerate(s.buys):
-        if c.name not in shop_sell_index[s.path]:
-            shop_sell_index[s.path][c.name] = (i, j)
+def reload_snapshot(path: str = None, force: bool = False) -> MarketSnapshot:
+    """
+    Loads the shops file into a new snapshot, swapping it in as a new data version unless the file is unchanged.
+    The live market updates applied over the old snapshot are dropped, and planners over it are no longer pooled.
+    :param path: the path of the shops file, defaults to the one of the current snapshot
+    :param force: whether to swap in the snapshot even if the file is unchanged
+    :return: the current snapshot after the reload
+    """
+    global snapshot
+    path = path or snapshot.path
+    # loaded outside the lock so that requests keep going on the current snapshot meanwhile
+    loaded = load_snapshot(path)
+    with _market_version_lock:
+        if not force and loaded.path == snapshot.path and loaded.digest == snapshot.digest:
+            return snapshot
+        snapshot = loaded._replace(version=snapshot.version + 1)
+        market_updates.clear()
+        bump_market_version()
+        planner_pool.discard_stale(snapshot.version)
+        return snapshot
+
+
+def watch_snapshot(interval: float = 5.0) -> threading.Thread:
+    """
+    Starts a daemon thread reloading the shops file whenever its modification time changes.
+    :param interval: the seconds between checks
+    :return: the thread
+    """
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                if snapshot_mtime(snapshot.path) != snapshot.mtime:
+                    reload_snapshot()
+            except (OSError, ValueError, TypeError) as e:
+                # a file caught halfway through being written is picked up again on the next check
+                print(e)
+
+    thread = threading.Thread(target=watch, name="watch-snapshot", daemon=True)
+    thread.start()
+    return thread
+
+
+def apply_market_updates(updates: Iterable[Tuple[str, str, str, float]]) -> int:
+    """
+    Applies a batch of market updates to the snapshot and in place to every pooled planner, then bumps the market
+    version once. The whole batch is validated against the snapshot first, so either all of it or none of it is
+    applied.
+    :param updates: the kind, one of MARKET_KINDS, the good, the location and the new value of every update
+    :return: the new market version
+    """
+    updates = [(kind, good, location, float(value)) for kind, good, location, value in updates]
+    with _market_version_lock:
+        for kind, good, location, value in updates:
+            if kind not in MARKET_KINDS:
+                raise ValueError("%s is not a kind of market value" % kind)
+            index = snapshot.buy_index if kind in ("supply", "buy_price") else snapshot.sell_index
+            if location not in index:
+                raise KeyError("%s not found" % location)
+            if good not in index[location]:
+                raise KeyError("%s is not traded at %s" % (good, location))
+            if not value >= 0 or not math.isfinite(value):
+                raise ValueError("%s cannot be negative" % kind)
+
+        _set_market(updates)
+        for key in updates:
+            market_updates[key[:3]] = key[3]
+            market_updates.move_to_end(key[:3])
+        bump_market_version()
+        return market_version
+
+
+def _set_market(updates: List[Tuple[str, str, str, float]]):
+    # copies the touched shops into a new snapshot of the same data version
+    global snapshot
+    shops = list(snapshot.shops)
+    for kind, good, location, value in updates:
+        sold = kind in ("supply", "buy_price")
+        i, j = (snapshot.buy_index if sold else snapshot.sell_index)[location][good]
+        commodities = list(shops[i].sells if sold else shops[i].buys)
+        field = "stock" if kind in ("supply", "demand") else "price"
+        commodities[j] = commodities[j]._replace(**{field: value})
+        shops[i] = shops[i]._replace(**{"sells" if sold else "buys": tuple(commodities)})
+    snapshot = snapshot._replace(shops=tuple(shops), planner=snapshot.planner.updated(updates))
+
+    # planners not holding a location were filtered away from it and skip its updates
+    for planner in planner_pool.planners():
+        with planner.lock:
+            for kind, good, location, value in updates:
+                if location in planner.shops_idx:
+                    planner.set_market(kind, good, location, value)
+
+
+def sync_state() -> Tuple:
+    """
+    :return: the data version, the path and the digest of the snapshot, along with the market version and every
+    update applied over the snapshot, see sync_worker
+    """
+    with _market_version_lock:
+        return (snapshot.version, snapshot.path, snapshot.digest, market_version,
+                [key + (value,) for key, value in market_updates.items()])
 
 
-def get_valid_shops(filter_regex):
-    paths = set()
+def sync_worker(version: int, path: str, digest: str, market: int, updates: List[Tuple[str, str, str, float]]):
+    """
+    Catches a worker process up with the server, reloading the snapshot if its data version changed and replaying the
+    market updates, which are idempotent.
+    :param version: the data version of the server
+    :param path: the shops file of the server
+    :param digest: the digest of the shops file the server loaded
+    :param market: the market version of the server
+    :param updates: every update applied by the server over its snapshot
+    """
+    global snapshot, market_version
+    with _market_version_lock:
+        if version != snapshot.version or digest != snapshot.digest:
+            loaded = load_snapshot(path)
+            # the file changed again since the server loaded it, so the next job retries once the server reloads
+            snapshot = loaded._replace(version=version if loaded.digest == digest else -1)
+            market_updates.clear()
+            market_version = -1
+            planner_pool.discard_stale(snapshot.version)
+        if market != market_version:
+            _set_market(updates)
+            # kept like on the server, as planners built over a ColumnarMarket replay them, see get_solver
+            market_updates.clear()
+            for update in updates:
+                market_updates[tuple(update[:3])] = update[3]
+            market_version = market
+
+
+def get_valid_shops(filter_regex, prefix=None):
+    locations = snapshot.locations
     try:
-        filter_func = create_filter(filter_regex)
+        shops, _ = locations.query(filter_regex, prefix)
     except re.error:
         return []
-    for s in shops:
-        if filter_func(s.path):
-            paths.add(s.path)
-    return list(paths)
+    return [locations.paths[i] for i in locations.indices(shops)]
 
 
-def get_valid_coms(filter_regex):
-    coms = set()
+def get_valid_coms(filter_regex, prefix=None):
+    locations = snapshot.locations
     try:
-        filter_func = create_filter(filter_regex)
+        _, coms = locations.query(filter_regex, prefix)
     except re.error:
         return []
-    for s in shops:
-        if filter_func(s.path):
-            for c in s.buys:
-                coms.add(c.name)
-            for c in s.sells:
-                coms.add(c.name)
-    return list(coms)
+    return [locations.commodities[i] for i in locations.indices(coms)]
+
+
+def get_stocks(ops: str, stock_request: Dict[str, List[str]],
+               current: MarketSnapshot = None) -> Dict[str, Dict[str, float]]:
+    """
+    Looks up the stock of many commodities at many locations with a single gather over the listings of a snapshot.
+    :param ops: either "buy" for the supply of the goods locations sell, or "sell" for the demand of the goods they buy
+    :param stock_request: the commodities to look up by location
+    :param current: the snapshot to look up, defaults to the current one
+    :return: the stocks by location and commodity
+    """
+    if ops not in ("buy", "sell"):
+        raise ValueError("%s is not buy or sell" % ops)
+    planner = (current or snapshot).planner
+    listings = planner.supply_listings if ops == "buy" else planner.demand_listings
+    pairs = [(loc, com) for loc in stock_request for com in stock_request[loc]]
+    shops = np.fromiter((planner.shops_idx[loc] for loc, _ in pairs), dtype=np.int64, count=len(pairs))
+    coms = np.fromiter((planner.commodities_idx[com] for _, com in pairs), dtype=np.int64, count=len(pairs))
+    pos = listings.find_many(coms, shops)
+    if np.any(pos < 0):
+        loc, com = pairs[int(np.argmax(pos < 0))]
+        raise KeyError("%s is not traded at %s" % (com, loc))
+
+    result = {loc: {} for loc in stock_request}
+    for (loc, com), stock in zip(pairs, listings.stock[pos].tolist()):
+        result[loc][com] = stock
+    return result
 
 
 def create_filter(regex):
-    pattern = re.compile(regex)
+    pattern = compile_filter(regex)
     return lambda text: pattern.search(text)
 
 
-DEFAULT_RESULT = HighLevelPlan(0, 0, [], []), []
+DEFAULT_RESULT = HighLevelPlan(0, 0, [], []), [], {"plan": SolveStatus(True, 0.0, 0.0),
+                                                   "route": SolveStatus(True, 0.0, 0.0)}, []
 
 
-def null_solver(**kwargs):
+def null_solver(*args, **kwargs):
     return DEFAULT_RESULT
 
 
-def get_solver(filter_regex):
+# the backend pooled planners solve with, where the native one reports the bound of truncated solves and warm starts
+SOLVER_BACKEND = os.environ.get("SOLVER_BACKEND", "scip")
+
+
+class PlannerPool:
+
+    def __init__(self, max_planners: int = 16, max_bytes: int = 1 << 30):
+        """
+        A bounded, thread-safe pool of warmed planners with least recently used eviction.
+        :param max_planners: the maximum number of planners to keep
+        :param max_bytes: the maximum estimated memory of all the planners kept
+        """
+        self.max_planners = max_planners
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._planners = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, shops: Union[List[Shop], ColumnarMarket],
+            updates: Iterable[Tuple[str, str, str, float]] = ()) -> "TwoStagePlanner":
+        """
+        Retrieves the planner for the given key, constructing it over the given shops if it is not pooled.
+        :param key: the canonical key of the shops
+        :param shops: the shops to construct the planner over on a miss, either as Shop tuples or in columnar form
+        :param updates: the market updates to apply to a planner constructed on a miss, see RoutePlanner.set_market
+        :return: the planner
+        """
+        with self._lock:
+            if key in self._planners:
+                self._planners.move_to_end(key)
+                self.hits = self.hits + 1
+                return self._planners[key]
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # concurrent misses on the same key wait for a single construction
+        with build_lock:
+            with self._lock:
+                if key in self._planners:
+                    self._planners.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return self._planners[key]
+                self.misses = self.misses + 1
+            try:
+                planner = TwoStagePlanner(shops, solver="SCIP", ignore_dpp=False, backend=SOLVER_BACKEND)
+                for kind, good, location, value in updates:
+                    planner.set_market(kind, good, location, value)
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+            with self._lock:
+                self._planners[key] = planner
+                self._evict()
+        return planner
+
+    def _evict(self):
+        # the newest planner is always kept even if it exceeds the memory cap by itself
+        total = sum(p.nbytes for p in self._planners.values())
+        while len(self._planners) > 1 and (len(self._planners) > self.max_planners or total > self.max_bytes):
+            _, planner = self._planners.popitem(last=False)
+            total = total - planner.nbytes
+            self.evictions = self.evictions + 1
+
+    def discard_stale(self, version: int):
+        """
+        Drops the planners built over another data version than the given one. Solves still holding one finish on it.
+        :param version: the current data version
+        """
+        with self._lock:
+            for key in [k for k in self._planners if k[0] != version]:
+                del self._planners[key]
+
+    def planners(self) -> List["TwoStagePlanner"]:
+        with self._lock:
+            return list(self._planners.values())
+
+    def clear(self):
+        with self._lock:
+            self._planners.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"planners": len(self._planners), "bytes": sum(p.nbytes for p in self._planners.values()),
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+planner_pool = PlannerPool()
+
+
+class ResultCache:
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300):
+        """
+        A bounded, thread-safe cache of optimize results with least recently used eviction.
+        :param max_entries: the maximum number of results to keep
+        :param ttl: the number of seconds a result stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*args) -> str:
+        """
+        Canonicalizes an optimize request together with the current data, the market version and the process, see
+        solve_job for the arguments. Restrictions are compared regardless of order.
+        :return: the key, which doubles as the ETag of the result once it is cached
+        """
+        (filter_regex, max_cargo, max_stops, max_range, blk_locs, com_restricts, restrictions, budget, alternatives,
+         mode) = args
+        canonical = json.dumps([PROCESS_NONCE, snapshot.digest, snapshot.version, market_version, filter_regex,
+                                max_cargo, max_stops, max_range, sorted(set(blk_locs)), com_restricts, restrictions,
+                                budget, alternatives, mode], sort_keys=True)
+        return hashlib.sha1(canonical.encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Retrieves a result that has not expired.
+        :param key: the key of the request
+        :return: the result, or None if it is not cached
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._results.pop(key, None)
+                self.misses = self.misses + 1
+                return None
+            self._results.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[1]
+
+    def put(self, key: str, result):
+        with self._lock:
+            self._results[key] = (time.monotonic(), result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"results": len(self._results), "hits": self.hits, "misses": self.misses}
+
+
+result_cache = ResultCache()
+
+
+class Metrics:
+    # the upper bounds of the buckets of the latency histograms in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    # the type and the help of every metric
+    METRICS = {
+        "scopt_phase_seconds": ("histogram", "Seconds spent per phase of a solve"),
+        "scopt_request_seconds": ("histogram", "Seconds spent serving a request"),
+        "scopt_solves_total": ("counter", "Models solved by stage and outcome"),
+        "scopt_model_variables": ("gauge", "Variables of the latest model solved by stage"),
+        "scopt_model_constraints": ("gauge", "Constraints of the latest model solved by stage"),
+        "scopt_model_nonzeros": ("gauge", "Nonzero coefficients of the latest native model solved by stage"),
+        "scopt_result_cache": ("gauge", "Entries, hits and misses of the result cache"),
+        "scopt_market_version": ("gauge", "The data and the market versions served"),
+    }
+
+    def __init__(self):
+        """
+        A thread-safe registry of counters, gauges and latency histograms, rendered in the Prometheus text format.
+        """
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, count = self._histograms.get(key, ([0] * len(self.BUCKETS), 0.0, 0))
+            # the buckets are cumulative
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.BUCKETS)]
+            self._histograms[key] = (counts, total + value, count + 1)
+
+    def record(self, timings: Dict):
+        """
+        Records the timings of a solve, see Timings.
+        """
+        for phase, seconds in timings["phases"].items():
+            self.observe("scopt_phase_seconds", seconds, phase=phase)
+        for model in timings["models"]:
+            stage = model["stage"] or "unknown"
+            self.inc("scopt_solves_total", stage=stage, status=model["status"])
+            self.set("scopt_model_variables", model["variables"], stage=stage)
+            self.set("scopt_model_constraints", model["constraints"], stage=stage)
+            if model["nonzeros"] is not None:
+                self.set("scopt_model_nonzeros", model["nonzeros"], stage=stage)
+
+    def render(self) -> str:
+        """
+        :return: every metric in the Prometheus text format
+        """
+        current, version = current_state()
+        for key, value in result_cache.stats().items():
+            self.set("scopt_result_cache", value, kind=key)
+        self.set("scopt_market_version", current.version, kind="data")
+        self.set("scopt_market_version", version, kind="market")
+
+        def labels(pairs, *extra):
+            pairs = list(pairs) + list(extra)
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) if pairs else ""
+
+        lines = []
+        with self._lock:
+            for name, (kind, description) in self.METRICS.items():
+                lines += ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, kind)]
+                if kind == "histogram":
+                    for (metric, pairs), (counts, total, count) in sorted(self._histograms.items()):
+                        if metric != name:
+                            continue
+                        for bound, cumulative in zip(self.BUCKETS, counts):
+                            lines.append("%s_bucket%s %d" % (name, labels(pairs, ("le", bound)), cumulative))
+                        lines.append("%s_bucket%s %d" % (name, labels(pairs, ("le", "+Inf")), count))
+                        lines.append("%s_sum%s %r" % (name, labels(pairs), total))
+                        lines.append("%s_count%s %d" % (name, labels(pairs), count))
+                else:
+                    for (metric, pairs), value in sorted(self._values.items()):
+                        if metric == name:
+                            lines.append("%s%s %r" % (name, labels(pairs), value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _record_metrics(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    _, timings = future.result()
+    if timings is not None:
+        metrics.record(timings)
+
+
+def server_timing(timings: Dict) -> str:
+    """
+    Formats the phases of a solve as a Server-Timing header, in milliseconds.
+    :param timings: the timings of the solve, see Timings
+    :return: the header value
+    """
+    return ", ".join("%s;dur=%.1f" % (phase, seconds * 1000) for phase, seconds in timings["phases"].items())
+
+
+
+def get_solver(filter_regex, prefix: str = None):
     try:
-        filter_func = create_filter(filter_regex)
-        filtered_shops = list(filter(lambda s: filter_func(s.path), shops))
-        ts_planner = TwoStagePlanner(filtered_shops, solver="SCIP", ignore_dpp=True)
+        # the solve keeps the snapshot it started from even if a reload swaps in another meanwhile
+        current = snapshot
+        selected = current.locations.indices(current.locations.query(filter_regex, prefix)[0])
+        # a single planner over every shop serves any filter, which only masks the shops a plan may visit, so the
+        # planner indices of the shops are the ones of the snapshot
+        with timed("planner"):
+            if current.market is None:
+                ts_planner = planner_pool.get((current.version,), current.shops)
+            else:
+                # the columns hold the market as it was saved, so a planner built over them replays the updates since
+                with _market_version_lock:
+                    updates = [key + (value,) for key, value in market_updates.items()]
+                ts_planner = planner_pool.get((current.version,), current.market, updates)
+        available = np.zeros(len(current.shops), dtype=bool)
+        available[selected] = True
     except Exception as e:
         print(e)
         return null_solver
 
-    def solve_problem(max_cargo, max_stops, max_range, blk_locs, com_restricts, restrictions):
-        _, plan = ts_planner.plan_stage_one(max_cargo, max_percent=1,
-                                            n_stop=max_stops,
-                                            max_level=max_range,
-                                            blk_locations=blk_locs,
-                                            max_commodity=com_restricts,
-                                            max_com_loc=restrictions)
-        if plan is None or len(plan.buy) == 0:
-            return DEFAULT_RESULT
-        profit, routes = ts_planner.plan_refinement(plan, max_cargo, max_percent=1,
-                                                    blk_locations=blk_locs,
-                                                    max_commodity=com_restricts,
-                                                    max_com_loc=restrictions)
-        if routes is None:
-            return DEFAULT_RESULT
-        return plan, routes
+    def solve_problem(max_cargo, max_stops, max_range, blk_locs, com_restricts, restrictions,
+                      budget: SolveBudget = None, alternatives: int = 1, mode: str = "exact"):
+        if mode == "fast":
+            with ts_planner.lock:
+                profit, plan, routes, bound = ts_planner.plan_fast(max_cargo, max_percent=1,
+                                                                   n_stop=max_stops,
+                                                                   max_level=max_range,
+                                                                   blk_locations=blk_locs,
+                                                                   max_commodity=com_restricts,
+                                                                   max_com_loc=restrictions,
+                                                                   available=available)
+            if plan is None or len(plan.buy) == 0:
+                return DEFAULT_RESULT
+            # the LP bound is on the profit of stage one, which the route pays its travel penalty out of
+            stage_one = plan.revenue - plan.cost
+            gap = max(bound - stage_one, 0.0) / abs(stage_one) if stage_one > 0 else None
+            status = SolveStatus(bool(gap is not None and gap <= EPSILON), float(bound), gap)
+            return plan, routes, {"fast": status}, []
+
+        with ts_planner.lock:
+            ranked, status = ts_planner.plan_alternatives(alternatives, max_cargo, max_percent=1,
+                                                          n_stop=max_stops,
+                                                          max_level=max_range,
+                                                          blk_locations=blk_locs,
+                                                          max_commodity=com_restricts,
+                                                          max_com_loc=restrictions,
+                                                          available=available,
+                                                          budget=budget)
+        if len(ranked) == 0:
+            return DEFAULT_RESULT[0], DEFAULT_RESULT[1], status, []
+        (_, plan, routes), others = ranked[0], ranked[1:]
+        return plan, routes, status, [(p, r) for _, p, r in others]
 
     return solve_problem
+
+
+def solve_job(filter_regex, max_cargo, max_stops, max_range, blk_locs, com_restricts, restrictions,
+              budget: SolveBudget = None, alternatives: int = 1, mode: str = "exact", prefix: str = None):
+    """
+    Solves one optimize request inside a worker process, reusing the planners pooled by that process.
+    :param prefix: the path prefix the shops are restricted to on top of the filter, see decompose
+    :return: a tuple of the best high level plan, its routes, the status of the plan and the route solves and the
+    other alternatives as plans and routes, best first
+    """
+    return get_solver(filter_regex, prefix)(max_cargo, max_stops, max_range, blk_locs, com_restricts, restrictions,
+                                            budget, alternatives, mode)
+
+
+def decompose(filter_regex: str, max_range: int, n_stop: int, current: MarketSnapshot = None) -> List[Tuple[str, int]]:
+    """
+    Splits the shops a filter selects into the clusters a plan can lie in.
+    The stops of a plan share an ancestor at the depth of the tree - max_range, see
+    TwoStagePlanner._allowed_subtrees, so the subtrees at that depth are solved independently and the best of their
+    plans is the plan over all the shops. Clusters with fewer than n_stop shops, or where no commodity is both sold
+    and bought, cannot hold a profitable plan and are left out.
+    :param filter_regex: the location filter
+    :param max_range: the maximum travel cost between any pair of stops
+    :param n_stop: the number of stops
+    :param current: the snapshot to split, defaults to the current one
+    :return: the path prefix of every cluster, or None for all the shops, along with the max_range that confines a
+    solve over the cluster to the same subtrees, largest cluster first
+    """
+    current = current or snapshot
+    locations = current.locations
+    selected = locations.indices(locations.match(filter_regex)[0])
+    paths = [[name.strip() for name in locations.paths[i].split(">")] for i in selected]
+    depth = max((len(p) for p in paths), default=0)
+    level = math.ceil(depth - max_range)
+    if level <= 0 or n_stop <= 1:
+        return [(None, max_range)]
+
+    clusters = {}
+    for i, path in zip(selected, paths):
+        if len(path) < level:
+            continue
+        shop = current.shops[i]
+        size, cluster_depth, sold, bought = clusters.get(tuple(path[:level]), (0, 0, set(), set()))
+        sold.update(c.name for c in shop.sells)
+        bought.update(c.name for c in shop.buys)
+        clusters[tuple(path[:level])] = size + 1, max(cluster_depth, len(path)), sold, bought
+    # a solve over a cluster measures levels from the deepest path of the cluster rather than of all the shops, see
+    # TwoStagePlanner._allowed_subtrees
+    kept = [(size, " > ".join(prefix), max_range - depth + cluster_depth)
+            for prefix, (size, cluster_depth, sold, bought) in clusters.items() if size >= n_stop and sold & bought]
+    kept.sort(key=lambda c: c[0], reverse=True)
+    return [(prefix, cluster_range) for _, prefix, cluster_range in kept]
+
+
+def combine_clusters(results: List[Tuple], alternatives: int = 1) -> Tuple:
+    """
+    Merges the results of solve_job over the clusters of a request, see decompose.
+    :param results: the result of every cluster
+    :param alternatives: the number of alternatives requested
+    :return: the result over all the clusters, where the plans of every cluster compete by the profit of stage one and
+    the bound of the plan is the largest of the clusters
+    """
+    if not results:
+        return DEFAULT_RESULT
+    candidates = []
+    for c, (plan, routes, _, others) in enumerate(results):
+        for p, r in [(plan, routes)] + list(others):
+            if len(p.buy) > 0:
+                candidates.append((p.revenue - p.cost, c, p, r))
+    candidates.sort(key=lambda t: t[0], reverse=True)
+    candidates = candidates[:alternatives]
+    profit = candidates[0][0] if candidates else 0.0
+
+    statuses = [status["plan"] for _, _, status, _ in results]
+    bounds = [s.bound for s in statuses]
+    bound = None if None in bounds else max(bounds)
+    gap = None
+    if bound is not None:
+        gap = 0.0 if bound <= profit else ((bound - profit) / abs(profit) if profit != 0 else None)
+    times = [s.time for s in statuses]
+    first_times = [s.first_time for s in statuses if s.first_time is not None]
+    plan_status = SolveStatus(all(s.optimal for s in statuses), bound, gap, None if None in times else sum(times),
+                              min(first_times, default=None))
+    if not candidates:
+        return DEFAULT_RESULT[0], DEFAULT_RESULT[1], {"plan": plan_status, "route": SolveStatus(True, 0.0, 0.0)}, []
+    _, best, plan, routes = candidates[0]
+    status = {"plan": plan_status, "route": results[best][2]["route"]}
+    return plan, routes, status, [(p, r) for _, _, p, r in candidates[1:]]
+
+
+def combine_timings(timings: List[Dict]) -> Dict:
+    """
+    Merges the timings of the clusters of a request, summing the seconds of every phase over the workers.
+    :param timings: the timings of every cluster, see Timings
+    :return: the merged timings, None if none were collected
+    """
+    timings = [t for t in timings if t is not None]
+    if not timings:
+        return None
+    phases = defaultdict(float)
+    for t in timings:
+        for phase, seconds in t["phases"].items():
+            phases[phase] += seconds
+    return {"phases": dict(phases), "models": [m for t in timings for m in t["models"]]}
+
+
+def _solve_synced(state: Tuple, *args) -> Tuple[object, Dict]:
+    # the worker catches up with the snapshot and the market updates of the server before solving, and reports its
+    # timings along with the result unless they are disabled
+    if not METRICS_ENABLED:
+        sync_worker(*state)
+        return solve_job(*args), None
+    with collect_timings() as timings:
+        with timed("sync"):
+            sync_worker(*state)
+        result = solve_job(*args)
+    return result, timings.to_dict()
+
+
+def _solve_streamed(events, cancel, state: Tuple, *args) -> Tuple[object, Dict]:
+    # the incumbents go back to the server over a queue of its manager process while the solve runs, unless nothing
+    # follows them, and the solves stop once the server sets the cancellation, see JobManager.stream and cancel
+    report = None if events is None else lambda *incumbent: events.put(incumbent)
+    with stream_incumbents(report, cancel.is_set):
+        return _solve_synced(state, *args)
+
+
+def _warm_worker():
+    # builds the planner over every shop up front, which serves the default filter
+    get_solver(r".*")
+
+
+class JobManager:
+
+    def __init__(self, max_workers: int = None, max_jobs: int = 1024):
+        """
+        Runs optimize requests as jobs on a pool of worker processes, each holding its own warmed planners.
+        :param max_workers: the number of worker processes, defaults to the number of cores
+        :param max_jobs: the maximum number of jobs to remember, the oldest finished jobs are forgotten first
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self._executor = None
+        self._manager = None
+        self._jobs = OrderedDict()
+        self._cancelled = set()
+        # the event interrupting the solves of every job that has not been forgotten
+        self._cancels = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # workers are spawned rather than forked since the server process runs threads
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_warm_worker)
+        return self._executor
+
+    def _get_manager(self):
+        # the manager process only starts with the first job or stream, as it holds the events cancelling their solves
+        # and the queues the workers report to
+        if self._manager is None:
+            self._manager = multiprocessing.get_context("spawn").Manager()
+        return self._manager
+
+    def submit(self, *args) -> str:
+        """
+        Queues an optimize request, see solve_job for the arguments.
+        :return: the id of the job
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            cancel = self._get_manager().Event()
+            self._jobs[job_id] = self._dispatch(sync_state(), args, (None, cancel))
+            self._cancels[job_id] = cancel
+            self._forget()
+        return job_id
+
+    def run(self, *args) -> Tuple[object, Dict]:
+        """
+        Solves an optimize request on the worker processes and waits for it, see solve_job for the arguments.
+        :return: a tuple of the result of solve_job and the timings of the worker, see Timings, which are None when
+        disabled
+        """
+        with self._lock:
+            future = self._dispatch(sync_state(), args)
+        return future.result()
+
+    def stream(self, *args, heartbeat: float = 1.0) -> Iterator[Tuple[str, object]]:
+        """
+        Solves an optimize request on the worker processes, following the incumbents of its stage one solves as SCIP
+        finds them, see solve_job for the arguments. Closing the iterator cancels the request and interrupts its
+        solves on the workers right away.
+        :param heartbeat: the seconds to wait for an incumbent before yielding a heartbeat
+        :return: an iterator of the kind and the value of every event, which are incumbent with the profit, the bound,
+        the gap, the seconds spent and the high level plan of every incumbent improving on the ones before, heartbeat
+        with None, and finally result with the result of solve_job and the timings of the workers
+        """
+        with self._lock:
+            manager = self._get_manager()
+        events, cancel = manager.Queue(), manager.Event()
+        with self._lock:
+            future = self._dispatch(sync_state(), args, (events, cancel))
+        best = -np.inf
+        waited = 0.0
+        try:
+            while True:
+                try:
+                    incumbent = events.get(timeout=CANCEL_POLL_INTERVAL)
+                except queue.Empty:
+                    # the workers report every incumbent before their result, so none is left once it is done
+                    if future.done() and events.empty():
+                        break
+                    waited = waited + CANCEL_POLL_INTERVAL
+                    if waited >= heartbeat:
+                        waited = 0.0
+                        yield "heartbeat", None
+                    continue
+                # the solves of other clusters and alternatives report incumbents worse than the best so far
+                if incumbent[0] > best + EPSILON:
+                    best, waited = incumbent[0], 0.0
+                    yield "incumbent", incumbent
+            yield "result", future.result()
+        finally:
+            cancel.set()
+            self._cancel(future)
+
+    def _submit(self, state: Tuple, args: Tuple, streaming: Tuple = None):
+        # every solve is recorded into the metrics as soon as it finishes
+        if streaming is None:
+            future = self._get_executor().submit(_solve_synced, state, *args)
+        else:
+            future = self._get_executor().submit(_solve_streamed, *streaming, state, *args)
+        future.add_done_callback(_record_metrics)
+        return future
+
+    def _dispatch(self, state: Tuple, args: Tuple, streaming: Tuple = None) -> Future:
+        """
+        Submits a request, fanning it out over its clusters in the decompose mode, see decompose.
+        :param streaming: the queue the incumbents are reported to and the event cancelling the solves, if streamed
+        :return: the future of the result of solve_job and the timings of the workers
+        """
+        filter_regex, _, max_stops, max_range, *options = args
+        alternatives = options[4] if len(options) > 4 else 1
+        if (options[5] if len(options) > 5 else "exact") != "decompose":
+            return self._submit(state, args, streaming)
+
+        start = time.perf_counter()
+        clusters = decompose(filter_regex, max_range, max_stops)
+        split = time.perf_counter() - start
+        combined = Future()
+        # the parts are solved as exact requests over the shops of one cluster each
+        combined.parts = [self._submit(state, args[:3] + (cluster_range,) + tuple(options[:5]) + ("exact", prefix),
+                                       streaming)
+                          for prefix, cluster_range in clusters]
+        remaining = [len(combined.parts)]
+        lock = threading.Lock()
+
+        def finish(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            if not combined.set_running_or_notify_cancel():
+                return
+            try:
+                outputs = [part.result() for part in combined.parts]
+            except BaseException as e:
+                combined.set_exception(e)
+                return
+            timings = combine_timings([t for _, t in outputs])
+            if timings is not None:
+                timings["phases"]["decompose"] = split
+            combined.set_result((combine_clusters([r for r, _ in outputs], alternatives), timings))
+
+        if not combined.parts:
+            combined.set_result((DEFAULT_RESULT, None))
+        for part in combined.parts:
+            part.add_done_callback(finish)
+        return combined
+
+    @staticmethod
+    def _cancel(future: Future) -> bool:
+        # a decomposed request only runs in its parts
+        for part in getattr(future, "parts", ()):
+            part.cancel()
+        return future.cancel()
+
+    def run_batch(self, requests: List[Tuple]) -> Iterator[Tuple[int, object]]:
+        """
+        Solves many optimize requests across the worker processes, see solve_job for the arguments of each.
+        Every worker reuses the planner it pooled over the snapshot, so requests of any filter share compiled problems.
+        :param requests: the arguments of every request
+        :return: an iterator of the index of the request and its result, in the order the requests finish
+        """
+        with self._lock:
+            state = sync_state()
+            futures = {self._dispatch(state, args): i for i, args in enumerate(requests)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()[0]
+        finally:
+            # the remaining requests are dropped when the caller stops listening
+            for future in futures:
+                self._cancel(future)
+
+    def status(self, job_id: str) -> Tuple[str, object]:
+        """
+        Retrieves the state of a job.
+        :param job_id: the id of the job
+        :return: a tuple of the status, one of pending, running, done, failed or cancelled, and the result of the job
+        if it is done
+        """
+        with self._lock:
+            future = self._jobs[job_id]
+            cancelled = job_id in self._cancelled
+        if cancelled or future.cancelled():
+            return "cancelled", None
+        if not future.done():
+            running = future.running() or any(part.running() for part in getattr(future, "parts", ()))
+            return ("running" if running else "pending"), None
+        try:
+            return "done", future.result()[0]
+        except CancelledError:
+            return "cancelled", None
+        except Exception:
+            return "failed", None
+
+    def cancel(self, job_id: str):
+        """
+        Cancels a job. A pending job never runs, while the solves of a running job are interrupted and its result is
+        discarded.
+        :param job_id: the id of the job
+        """
+        with self._lock:
+            future = self._jobs[job_id]
+            if not self._cancel(future) and not future.done():
+                self._cancels[job_id].set()
+                self._cancelled.add(job_id)
+
+    def _forget(self):
+        finished = [k for k, f in self._jobs.items() if f.done()]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+            self._cancelled.discard(job_id)
+            self._cancels.pop(job_id, None)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            if self._manager is not None:
+                self._manager.shutdown()
+                self._manager = None
+
+
+job_manager = JobManager(max_workers=int(os.environ.get("SOLVER_WORKERS", 0)) or None)
@@ -0,0 +1,51 @@
+"""
+Checks that a planner over every shop of the bundled shops.json, masked to the shops a filter selects, finds the
+profits of a planner built over only those shops.
+Run from the repository root with: python -m pytest tests
+"""
+import re
+
+import numpy as np
+import pytest
+
+from optimize import TwoStagePlanner, current_snapshot, get_solver
+
+# the filter, the cargo, the number of stops and the maximum range
+CASES = [
+    (r"Crusader", 456, 3, 2),
+    (r"^Stanton > (Crusader|microTech) > .*", 696, 4, 3),
+    (r"Hurston|ArcCorp", 696, 4, 3),
+    (r"Yela", 96, 2, 1),
+]
+
+
+@pytest.fixture(scope="module")
+def planner():
+    return TwoStagePlanner(current_snapshot().shops, solver="SCIP", backend="scip")
+
+
+def plan(planner: TwoStagePlanner, cargo: int, n_stop: int, max_level: int, available: np.ndarray = None):
+    stage_one, plan = planner.plan_stage_one(cargo, max_percent=1, max_level=max_level, n_stop=n_stop,
+                                             warm_start=False, available=available)
+    if len(plan.buy) == 0:
+        return stage_one, None
+    profit, _ = planner.plan_refinement(plan, cargo, max_percent=1, available=available)
+    return stage_one, profit
+
+
+@pytest.mark.parametrize("filter_regex,cargo,n_stop,max_level", CASES)
+def test_masked_planner_matches_filtered(planner, filter_regex, cargo, n_stop, max_level):
+    shops = current_snapshot().shops
+    available = np.array([re.search(filter_regex, s.path) is not None for s in shops])
+    filtered = TwoStagePlanner([s for s in shops if re.search(filter_regex, s.path)], solver="SCIP", backend="scip")
+
+    masked_stage_one, masked_profit = plan(planner, cargo, n_stop, max_level, available)
+    stage_one, profit = plan(filtered, cargo, n_stop, max_level)
+    assert masked_stage_one == pytest.approx(stage_one, abs=1e-4)
+    assert (masked_profit is None) == (profit is None)
+    if profit is not None:
+        assert masked_profit == pytest.approx(profit, abs=1e-4)
+
+    best, _, _, _ = get_solver(filter_regex)(cargo, n_stop, max_level, [], {}, {})
+    assert best.revenue - best.cost == pytest.approx(masked_stage_one if masked_profit is not None else 0, abs=1e-2)
+    assert all(re.search(filter_regex, t.loc) for t in list(best.buy) + list(best.sell))
@@ -0,0 +1,45 @@
+"""
+Checks that the native SCIP backend finds the same optimum as the CVXPY formulation on the bundled shops.json.
+Run from the repository root with: python -m pytest tests
+"""
+import pytest
+
+from optimize import TwoStagePlanner, current_snapshot
+
+# the cargo, the number of stops, the maximum level and the optimal profit after the refinement, None when no trade
+# is profitable
+CASES = [
+    (456, 3, 2, 19831.44),
+    (696, 4, 3, 60804.0),
+    (96, 2, 1, None),
+]
+
+
+@pytest.fixture(scope="module")
+def planners():
+    shops = current_snapshot().shops
+    return {backend: TwoStagePlanner(shops, solver="SCIP", backend=backend) for backend in ("cvxpy", "scip")}
+
+
+def plan(planner: TwoStagePlanner, cargo: int, n_stop: int, max_level: int):
+    stage_one, plan = planner.plan_stage_one(cargo, max_percent=1, max_level=max_level, n_stop=n_stop,
+                                             warm_start=False)
+    if len(plan.buy) == 0:
+        return stage_one, None, None
+    profit, routes = planner.plan_refinement(plan, cargo, max_percent=1)
+    return stage_one, profit, routes
+
+
+@pytest.mark.parametrize("cargo,n_stop,max_level,expected", CASES)
+def test_objectives_match(planners, cargo, n_stop, max_level, expected):
+    cvxpy_stage_one, cvxpy_profit, _ = plan(planners["cvxpy"], cargo, n_stop, max_level)
+    scip_stage_one, scip_profit, routes = plan(planners["scip"], cargo, n_stop, max_level)
+
+    assert scip_stage_one == pytest.approx(cvxpy_stage_one, abs=1e-4)
+    if expected is None:
+        assert cvxpy_profit is None and scip_profit is None
+        assert scip_stage_one == pytest.approx(0, abs=1e-4)
+    else:
+        assert cvxpy_profit == pytest.approx(expected, abs=1e-2)
+        assert scip_profit == pytest.approx(expected, abs=1e-2)
+        assert routes[0].start == "start" and len(routes) <= n_stop
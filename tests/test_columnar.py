@@ -0,0 +1,86 @@
+"""
+Checks that converting the bundled shops.json into a ColumnarMarket and loading it back gives the same snapshot, with
+planners wrapping the memory-mapped columns rather than copying them.
+Run from the repository root with: python -m pytest tests
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from optimize import ColumnarMarket, TwoStagePlanner, convert_shops, load_snapshot
+
+SIDES = {"supply_listings": "sells", "demand_listings": "buys"}
+
+
+@pytest.fixture(scope="module")
+def snapshots(tmp_path_factory):
+    target = str(tmp_path_factory.mktemp("market"))
+    convert_shops("shops.json", target)
+    return load_snapshot("shops.json"), load_snapshot(target)
+
+
+def test_round_trip(snapshots):
+    loaded, mapped = snapshots
+    assert mapped.market is not None and loaded.market is None
+    assert mapped.shops == loaded.shops
+    assert mapped.digest == loaded.digest
+    assert mapped.buy_index == loaded.buy_index and mapped.sell_index == loaded.sell_index
+    assert mapped.planner.shops_idx == loaded.planner.shops_idx
+    assert mapped.planner.commodities_idx == loaded.planner.commodities_idx
+    for name in SIDES:
+        expected, listings = getattr(loaded.planner, name), getattr(mapped.planner, name)
+        for field in ("com", "shop", "price", "stock", "indptr"):
+            assert np.array_equal(getattr(listings, field), getattr(expected, field))
+
+
+def test_planners_wrap_the_columns(snapshots):
+    _, mapped = snapshots
+    planner = TwoStagePlanner(mapped.market, solver="SCIP", backend="scip")
+    for name, side in SIDES.items():
+        listings = getattr(planner, name)
+        assert listings.com is mapped.market.columns[side + "_com"]
+        assert listings.shop is mapped.market.columns[side + "_shop"]
+        assert isinstance(listings.stock, np.memmap) and isinstance(listings.price, np.memmap)
+
+
+def test_updates_stay_in_their_planner(snapshots):
+    loaded, mapped = snapshots
+    first = TwoStagePlanner(mapped.market, solver="SCIP", backend="scip")
+    second = TwoStagePlanner(mapped.market, solver="SCIP", backend="scip")
+    shop = loaded.shops[0]
+    good = shop.sells[0]
+    first.set_market("supply", good.name, shop.path, good.stock + 1)
+
+    pos = first.supply_listings.find(first.commodities_idx[good.name], first.shops_idx[shop.path])
+    assert first.supply_listings.stock[pos] == good.stock + 1
+    assert second.supply_listings.stock[pos] == good.stock
+    assert mapped.planner.supply_listings.stock[pos] == good.stock
+    assert load_snapshot(mapped.path).shops == loaded.shops
+
+
+def test_planners_agree(snapshots):
+    loaded, mapped = snapshots
+    profits = []
+    for shops in (loaded.shops, mapped.market):
+        planner = TwoStagePlanner(shops, solver="SCIP", backend="scip")
+        profit, _ = planner.plan_stage_one(456, max_percent=1, n_stop=3, max_level=2, warm_start=False)
+        profits.append(profit)
+    assert profits[0] == pytest.approx(profits[1], abs=1e-6)
+
+
+def test_other_formats_are_refused(snapshots):
+    _, mapped = snapshots
+    with open(os.path.join(mapped.path, ColumnarMarket.MANIFEST), "r") as fp:
+        manifest = json.load(fp)
+    manifest["format"] = 1
+    with open(os.path.join(mapped.path, ColumnarMarket.MANIFEST), "w") as fp:
+        json.dump(manifest, fp)
+    try:
+        with pytest.raises(ValueError):
+            ColumnarMarket.load(mapped.path)
+    finally:
+        manifest["format"] = ColumnarMarket.FORMAT
+        with open(os.path.join(mapped.path, ColumnarMarket.MANIFEST), "w") as fp:
+            json.dump(manifest, fp)
@@ -0,0 +1,41 @@
+"""
+Checks that the decompose mode fans a request out over its clusters and finds the profit of the exact mode on the
+bundled shops.json.
+Run from the repository root with: python -m pytest tests
+"""
+import pytest
+
+from optimize import JobManager, decompose, sync_state
+
+# the filter, the cargo, the number of stops and the maximum range
+CASES = [
+    (r".*", 456, 3, 2),
+    (r".*", 696, 3, 3),
+    (r"Crusader", 456, 2, 2),
+]
+
+
+@pytest.fixture(scope="module")
+def job_manager():
+    manager = JobManager(max_workers=1)
+    yield manager
+    manager.shutdown()
+
+
+def request(filter_regex, cargo, n_stop, max_range, mode):
+    return filter_regex, cargo, n_stop, max_range, [], {}, {}, None, 1, mode
+
+
+@pytest.mark.parametrize("filter_regex,cargo,n_stop,max_range", CASES)
+def test_decompose_matches_exact(job_manager, filter_regex, cargo, n_stop, max_range):
+    clusters = decompose(filter_regex, max_range, n_stop)
+    assert len(clusters) > 1
+
+    future = job_manager._dispatch(sync_state(), request(filter_regex, cargo, n_stop, max_range, "decompose"))
+    assert len(future.parts) == len(clusters)
+    plan, _, status, _ = future.result()[0]
+    exact, _, exact_status, _ = job_manager.run(*request(filter_regex, cargo, n_stop, max_range, "exact"))[0]
+
+    assert plan.revenue - plan.cost == pytest.approx(exact.revenue - exact.cost, abs=1e-2)
+    assert len(plan.buy) > 0
+    assert status["plan"].optimal and exact_status["plan"].optimal
@@ -0,0 +1,62 @@
+"""
+Checks that the location index selects the shops re.search does on the bundled shops.json, and that the filters that
+can backtrack catastrophically are refused before they run.
+Run from the repository root with: python -m pytest tests
+"""
+import re
+
+import pytest
+
+from optimize import LocationIndex, current_snapshot
+
+FILTERS = [
+    r".*",
+    r"",
+    r"Crusader",
+    r"^Stanton > Crusader",
+    r"^Stanton > Crusader > ",
+    r"Yela",
+    r"Stanton > ArcCorp",
+    r"(?i)stanton",
+    r"(?i)^stanton",
+    r"(?i)crusader > yela",
+    r"(?i:crusader)",
+    r"Station$",
+    r"Hurston|ArcCorp",
+    r"^Stanton > (Crusader|microTech) > .*",
+    r"L[1-5] ",
+    r"Stations?",
+    r"no such place",
+]
+
+REFUSED = [
+    r"(a*)*b",
+    r"(.|.)*Z",
+    r"(\w|\w)*Q",
+    r"(a?a)*b",
+    r"(?i)(ab|AB)+c",
+    r".*.*.*.*Z",
+    r"(.|.)(.|.)(.|.)(.|.)Z",
+    r"(a)\1",
+]
+
+
+@pytest.fixture(scope="module")
+def shops():
+    return current_snapshot().shops
+
+
+@pytest.mark.parametrize("regex", FILTERS)
+def test_index_matches_search(shops, regex):
+    locations = LocationIndex(shops)
+    selected, coms = locations.match(regex)
+    expected = [i for i, s in enumerate(shops) if re.search(regex, s.path)]
+    assert locations.indices(selected) == expected
+    assert sorted(locations.commodities[i] for i in locations.indices(coms)) == \
+           sorted({c.name for i in expected for c in shops[i].buys + shops[i].sells})
+
+
+@pytest.mark.parametrize("regex", REFUSED)
+def test_backtracking_filters_are_refused(shops, regex):
+    with pytest.raises(re.error):
+        LocationIndex(shops).match(regex)
@@ -0,0 +1,73 @@
+"""
+Checks that live market updates reach the stock lookups and the solves of pooled planners, both in the server process
+and in the worker processes, on the bundled shops.json.
+Run from the repository root with: python -m pytest tests
+"""
+import pytest
+
+import optimize
+from optimize import JobManager, apply_market_updates, current_state, get_solver, get_stocks, reload_snapshot
+
+# the cargo, the number of stops and the maximum range
+REQUEST = (456, 3, 2)
+
+
+@pytest.fixture(autouse=True)
+def fresh_snapshot():
+    yield
+    # drops the updates of the test along with the planners they were applied to
+    reload_snapshot(optimize.SHOPS_PATH, force=True)
+
+
+def solve():
+    plan, _, _, _ = get_solver(r".*")(*REQUEST, [], {}, {})
+    return plan
+
+
+def test_updates_reach_the_stocks():
+    current, _ = current_state()
+    shop = current.shops[0]
+    good = shop.sells[0]
+    version = apply_market_updates([("supply", good.name, shop.path, good.stock + 7)])
+
+    assert current_state()[1] == version
+    assert get_stocks("buy", {shop.path: [good.name]}) == {shop.path: {good.name: good.stock + 7}}
+    # the snapshot a request started from keeps the stock it had
+    assert get_stocks("buy", {shop.path: [good.name]}, current) == {shop.path: {good.name: good.stock}}
+
+
+def test_invalid_batches_are_not_applied():
+    current, version = current_state()
+    shop = current.shops[0]
+    good = shop.sells[0]
+    with pytest.raises(KeyError):
+        apply_market_updates([("supply", good.name, shop.path, 1.0), ("supply", good.name, "nowhere", 1.0)])
+    with pytest.raises(ValueError):
+        apply_market_updates([("supply", good.name, shop.path, -1.0)])
+    assert current_state() == (current, version)
+
+
+def test_updates_reach_pooled_planners():
+    before = solve()
+    assert len(before.buy) > 0
+    pooled = optimize.planner_pool.planners()
+
+    # empties the supply of everything the plan buys, which the pooled planner must not buy again
+    apply_market_updates([("supply", t.com, t.loc, 0) for t in before.buy])
+    after = solve()
+    assert optimize.planner_pool.planners() == pooled
+    assert not {(t.loc, t.com) for t in before.buy} & {(t.loc, t.com) for t in after.buy}
+    assert after.revenue - after.cost < before.revenue - before.cost
+
+
+def test_updates_reach_workers():
+    with_workers = JobManager(max_workers=1)
+    try:
+        before = with_workers.run(r".*", *REQUEST, [], {}, {})[0][0]
+        apply_market_updates([("supply", t.com, t.loc, 0) for t in before.buy])
+        after = with_workers.run(r".*", *REQUEST, [], {}, {})[0][0]
+    finally:
+        with_workers.shutdown()
+    assert not {(t.loc, t.com) for t in before.buy} & {(t.loc, t.com) for t in after.buy}
+    expected = solve()
+    assert after.revenue - after.cost == pytest.approx(expected.revenue - expected.cost, abs=1e-2)
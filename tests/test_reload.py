@@ -0,0 +1,54 @@
+"""
+Checks that reloading the shops swaps in a new data version only when the file changed, dropping the live updates
+and the pooled planners of the old one.
+Run from the repository root with: python -m pytest tests
+"""
+import json
+import shutil
+
+import pytest
+
+import optimize
+from optimize import apply_market_updates, current_state, get_solver, get_stocks, reload_snapshot
+
+
+@pytest.fixture
+def shops_file(tmp_path):
+    path = str(tmp_path / "shops.json")
+    shutil.copyfile(optimize.SHOPS_PATH, path)
+    yield path
+    reload_snapshot(optimize.SHOPS_PATH, force=True)
+
+
+def test_reload_follows_the_digest(shops_file):
+    loaded = reload_snapshot(shops_file)
+    assert reload_snapshot() is loaded
+
+    with open(shops_file) as fp:
+        shops = json.load(fp)
+    path, good = shops[0][0], shops[0][2][0]
+    good[2] = good[2] + 11
+    with open(shops_file, "w") as fp:
+        json.dump(shops, fp)
+
+    reloaded = reload_snapshot()
+    assert reloaded.version == loaded.version + 1
+    assert reloaded.digest != loaded.digest
+    assert get_stocks("buy", {path: [good[0]]}) == {path: {good[0]: good[2]}}
+    assert get_stocks("buy", {path: [good[0]]}, loaded) == {path: {good[0]: good[2] - 11}}
+
+
+def test_reload_drops_updates_and_planners(shops_file):
+    loaded = reload_snapshot(shops_file)
+    shop = loaded.shops[0]
+    good = shop.sells[0]
+    get_solver(r".*")
+    apply_market_updates([("supply", good.name, shop.path, good.stock + 5)])
+    assert len(optimize.planner_pool.planners()) == 1
+
+    reloaded = reload_snapshot(force=True)
+    _, version = current_state()
+    assert reloaded.version == loaded.version + 1
+    assert len(optimize.market_updates) == 0 and len(optimize.planner_pool.planners()) == 0
+    assert get_stocks("buy", {shop.path: [good.name]}) == {shop.path: {good.name: good.stock}}
+    assert optimize.sync_state() == (reloaded.version, shops_file, reloaded.digest, version, [])
@@ -0,0 +1,51 @@
+"""
+Checks that ordering the stops of a refinement by enumeration finds the same profit and route as the MIP on the
+bundled shops.json.
+Run from the repository root with: python -m pytest tests
+"""
+import pytest
+
+from optimize import SEQUENCE_STOPS, TwoStagePlanner, current_snapshot
+
+# the cargo, the number of stops, the maximum level and whether the best order is unique, where routes visiting
+# independent pairs of stops can swap the pairs at the same profit
+CASES = [
+    (456, 2, 2, True),
+    (456, 3, 2, True),
+    (96, 3, 3, True),
+    (696, 4, 3, False),
+    (200, 4, 3, False),
+    (696, 5, 3, False),
+    (300, 5, 4, False),
+]
+
+
+@pytest.fixture(scope="module")
+def planner():
+    return TwoStagePlanner(current_snapshot().shops, solver="SCIP", backend="scip")
+
+
+def refine(planner: TwoStagePlanner, plan, cargo: int, sequence_stops: int):
+    planner.sequence_stops = sequence_stops
+    try:
+        return planner.plan_refinement(plan, cargo, max_percent=1)
+    finally:
+        planner.sequence_stops = SEQUENCE_STOPS
+
+
+@pytest.mark.parametrize("cargo,n_stop,max_level,unique", CASES)
+def test_orders_match_mip(planner, cargo, n_stop, max_level, unique):
+    _, plan = planner.plan_stage_one(cargo, max_percent=1, max_level=max_level, n_stop=n_stop, warm_start=False)
+    stops = {t.loc for t in plan.buy} | {t.loc for t in plan.sell}
+    mip_profit, mip_routes = refine(planner, plan, cargo, 0)
+    profit, routes = refine(planner, plan, cargo, len(stops))
+
+    assert profit == pytest.approx(mip_profit, abs=1e-2)
+    assert planner.solve_status.optimal
+    assert routes[0].start == "start" and [r.end for r in routes[:-1]] == [r.start for r in routes[1:]]
+    assert sorted(r.end for r in routes) == sorted(stops)
+    if unique:
+        assert [r.end for r in routes] == [r.end for r in mip_routes]
+        for route, mip_route in zip(routes, mip_routes):
+            assert sorted((t.com, round(t.amount, 4)) for t in route.buy + route.sell) == \
+                   sorted((t.com, round(t.amount, 4)) for t in mip_route.buy + mip_route.sell)
@@ -0,0 +1,56 @@
+"""
+Checks that the bulk stock lookup returns the stocks of the shops on the bundled shops.json, and that its responses
+are revalidated until the market changes.
+Run from the repository root with: python -m pytest tests
+"""
+import pytest
+
+import optimize
+from app import app
+from optimize import apply_market_updates, current_snapshot, get_stocks, reload_snapshot
+
+
+@pytest.fixture
+def client():
+    yield app.test_client()
+    reload_snapshot(optimize.SHOPS_PATH, force=True)
+
+
+@pytest.mark.parametrize("ops,side", [("buy", "sells"), ("sell", "buys")])
+def test_stocks_match_the_shops(ops, side):
+    shops = current_snapshot().shops
+    request = {shop.path: {good.name: good.stock for good in getattr(shop, side)} for shop in shops}
+    assert get_stocks(ops, {loc: list(goods) for loc, goods in request.items()}) == request
+
+
+def test_unknown_goods_are_refused():
+    shop = current_snapshot().shops[0]
+    with pytest.raises(KeyError):
+        get_stocks("buy", {shop.path: ["no such good"]})
+    with pytest.raises(KeyError):
+        get_stocks("buy", {"no such place": [shop.sells[0].name]})
+    with pytest.raises(ValueError):
+        get_stocks("steal", {})
+
+
+def test_responses_revalidate_until_the_market_changes(client):
+    shop = current_snapshot().shops[0]
+    good = shop.sells[0]
+    body = {shop.path: [good.name]}
+
+    first = client.post("/buy/stocks", json=body)
+    assert first.status_code == 200 and first.json == {shop.path: {good.name: good.stock}}
+    etag = first.headers["ETag"]
+    assert client.post("/buy/stocks", json=body, headers={"If-None-Match": etag}).status_code == 304
+    assert client.post("/sell/stocks", json=body, headers={"If-None-Match": etag}).status_code != 304
+
+    apply_market_updates([("supply", good.name, shop.path, good.stock + 3)])
+    changed = client.post("/buy/stocks", json=body, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.json == {shop.path: {good.name: good.stock + 3}}
+    assert changed.headers["ETag"] != etag
+
+
+def test_bad_requests_are_refused(client):
+    shop = current_snapshot().shops[0]
+    assert client.post("/buy/stocks", json={shop.path: ["no such good"]}).status_code == 400
+    assert client.post("/steal/stocks", json={shop.path: []}).status_code == 400
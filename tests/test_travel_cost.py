@@ -0,0 +1,67 @@
+"""
+Checks that compute_travel_cost returns exactly the matrices of the string matching loop it replaced.
+Run from the repository root with: python -m pytest tests
+"""
+import random
+from itertools import product, zip_longest
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_universe
+from optimize import compute_travel_cost, current_snapshot
+
+
+def reference_travel_cost(paths, path_idx):
+    """
+    The original implementation of compute_travel_cost, kept as the reference.
+    """
+    result = np.zeros((len(paths), len(paths)))
+    max_level = -1
+    for p in paths:
+        p_pars = p.split(">")
+        if len(p_pars) >= max_level:
+            max_level = len(p_pars)
+
+    for shop_a, shop_b in product(paths, paths):
+        ix_a, ix_b = path_idx[shop_a], path_idx[shop_b]
+        if shop_a == shop_b:
+            result[ix_a, ix_b] = 0
+        parts_a = shop_a.split(">")
+        parts_b = shop_b.split(">")
+        curr_level = max_level
+        for a, b in zip_longest(parts_a, parts_b, fillvalue="-1"):
+            if a.strip() != b.strip():
+                result[ix_a, ix_b] = curr_level
+                break
+            curr_level = curr_level - 1
+    return result
+
+
+def _shops_paths():
+    return [s.path for s in current_snapshot().shops]
+
+
+def _synthetic_paths():
+    return [path for path, _, _ in generate_universe(0, systems=3, depth=5, shops=150)]
+
+
+def _ragged_paths():
+    # paths of different depths, paths that are prefixes of others and inconsistent spacing around the separators
+    return ["Stanton", "Stanton > Crusader", "Stanton > Crusader > Yela", "Stanton>Crusader>Daymar",
+            "Stanton > Crusader > Yela > Grim HEX > Admin", "Stanton > Hurston", "Pyro > Pyro I", "Pyro"]
+
+
+@pytest.mark.parametrize("paths", [_shops_paths(), _synthetic_paths(), _ragged_paths()],
+                         ids=["shops", "synthetic", "ragged"])
+@pytest.mark.parametrize("shuffle", [False, True], ids=["ordered", "shuffled"])
+def test_matches_reference(paths, shuffle):
+    order = list(range(len(paths)))
+    if shuffle:
+        random.Random(0).shuffle(order)
+    path_idx = {p: i for p, i in zip(paths, order)}
+
+    expected = reference_travel_cost(paths, path_idx)
+    actual = compute_travel_cost(paths, path_idx)
+    assert actual.dtype == expected.dtype
+    assert actual.tobytes() == expected.tobytes()